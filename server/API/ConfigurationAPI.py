@@ -10,7 +10,7 @@ from fastapi import APIRouter, HTTPException, BackgroundTasks
 
 from pydantic import BaseModel, ValidationError
 
-from server.Interface import toplevelinterface
+from server.Interface import toplevelinterface, PIinterface
 from server.Settings import SettingsVault
 from server.StageControl.DataTypes import updateResponse
 
@@ -99,6 +99,15 @@ async def getRemoveConfiguration(controllername:str, identifier:int):
     # if we are here, we haven't found anything
     raise HTTPException(status_code=404, detail=f"Controller interface {controllername} cannot be found")
 
+@router.get("/get/CancelReferencing")
+async def getCancelReferencing(SN: int = None) -> list[int]:
+    """
+    Stops referencing PI stages, they stop where they are and stay unreferenced
+    :param SN: serial number of the controller, leave out to stop all of them
+    :return: serial numbers of the controllers stopped
+    """
+    return await PIinterface.cancelReferencing(SN)
+
 
 class SettingsResponse(BaseModel):
     success: bool
@@ -106,7 +115,7 @@ class SettingsResponse(BaseModel):
     configuration: dict[str, Any] = {}
 
 async def getStore(storename: str):
-    SV = SettingsVault()
+    SV = SettingsVault.shared()
     await SV.load_all()
     if SV.stores.keys().__contains__(storename):
         config = SV.stores[storename]
@@ -132,7 +141,7 @@ async def getSaveCurrentConfiguration(name: str):
     to_save[name] = getCurrentConfig()
     # save to disk
     try:
-        SV = SettingsVault()
+        SV = SettingsVault.shared()
         await SV.saveToDisk("configuration", to_save)
         return SettingsResponse(success=True, configuration = to_save)
     except Exception as e:
@@ -151,7 +160,7 @@ async def getRemoveSavedConfiguration(name: str):
 
     try:
         del loaded.configuration[name]
-        SV = SettingsVault()
+        SV = SettingsVault.shared()
         await SV.saveToDisk("configuration", loaded.configuration)
         return SettingsResponse(success=True, configuration=loaded.configuration)
     except Exception as e:
@@ -114,7 +114,7 @@ async def savecurrentassembly(name: str):
     :param name: Name to save under
     :return:
     """
-    SV = SettingsVault()
+    SV = SettingsVault.shared()
     await SV.load_all()
     jason = assembly.getJson()
     if SV.stores.__contains__("assemblies"):
@@ -132,7 +132,7 @@ async def loadAssembly(name: str):
     :param name: name of the assembly saved on disk
     :return:
     """
-    SV = SettingsVault()
+    SV = SettingsVault.shared()
     await SV.load_all()
     if SV.stores.keys().__contains__("assemblies"):
         if SV.stores["assemblies"].__contains__(name):
@@ -145,7 +145,7 @@ async def loadAssembly(name: str):
 
 @router.get("/get/kinematics/getSavedAssemblies")
 async def getsavedassemblies():
-    SV = SettingsVault()
+    SV = SettingsVault.shared()
     await SV.load_all()
     if SV.stores.keys().__contains__("assemblies"):
         return SV.stores["assemblies"]
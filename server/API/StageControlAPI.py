@@ -1,10 +1,11 @@
 import asyncio
 
-from fastapi import APIRouter, HTTPException, BackgroundTasks
+from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel, Field, model_validator
 
 from server.Interface import toplevelinterface
 from server.StageControl.DataTypes import StageInfo, StageStatus, StageKind
+from server.StageControl.StateStore import StageChanges, StageState
 
 router = APIRouter(tags=["control"])
 
@@ -25,50 +26,23 @@ def getAllStageStatus() -> dict[int, StageStatus]:
     return toplevelinterface.StageStatus
 
 
-async def checkUntilOnTarget(background_tasks: BackgroundTasks, checkIDs: list[int] = None):
-    print("checkuntilontarget for ", checkIDs)
-
-    # go to sleep :)
-    await asyncio.sleep(0.2)
-
-    if checkIDs is None:
-        checkIDs = toplevelinterface.allIdentifiers
-    elif len(checkIDs) == 0:
-        # If there's nothing to check, then don't check :)
-        return
-
-    # Refresh relevant statuses
-    await toplevelinterface.updateStageStatus(checkIDs)
-
-    # Construct a list of IDs that aren't on target
-    toUpdate: list[int] = []
-    # Check if we are on target
-    print(toplevelinterface.StageStatus)
-    for id in checkIDs:
-        if not toplevelinterface.StageStatus[id].ontarget:
-            toUpdate.append(id)
-
-    # reschedule the task - since we are passing IDs we know are not on target, the list will naturally dwindle
-    background_tasks.add_task(checkUntilOnTarget, background_tasks, toUpdate)
-
-
 @router.get("/get/stage/update/status")
-async def updateStageStatus(background_tasks: BackgroundTasks, identifiers: list[int] = None):
+async def updateStageStatus(identifiers: list[int] = None):
     """
-    Updates the status of all connected stages
+    Updates the status of all connected stages, and keeps watching the ones that aren't on target
     """
     await toplevelinterface.updateStageStatus(identifiers=identifiers)
-    background_tasks.add_task(checkUntilOnTarget, background_tasks)
+    toplevelinterface.supervisor.watch(toplevelinterface.allIdentifiers if identifiers is None else identifiers)
     return
 
 
 @router.get("/get/stage/update/info")
-async def updateStageInfo(background_tasks: BackgroundTasks, identifiers: list[int] = None):
+async def updateStageInfo(identifiers: list[int] = None):
     """
     Updates the info of all connected stages
     """
     await toplevelinterface.updateStageInfo()
-    background_tasks.add_task(checkUntilOnTarget, background_tasks, identifiers)
+    toplevelinterface.supervisor.watch(toplevelinterface.allIdentifiers if identifiers is None else identifiers)
     return
 
 class FullState(BaseModel):
@@ -83,49 +57,101 @@ class FullState(BaseModel):
     ontarget: bool
 
 
-@router.get("/get/stage/fullstate")
-async def getStageFullstate():
-    info = toplevelinterface.StageInfo
-    stat = toplevelinterface.StageStatus
+def fullStateView(stages: dict[int, StageState]) -> dict[int, FullState]:
+    """identifier -> FullState of the stages we have both info and status of, for StageStateStore.view"""
     res: dict[int, FullState] = {}
-    for key in info.keys():
+    for key, state in stages.items():
+        if state.info is None or state.status is None:
+            continue
         res[key] = FullState(
-            identifier=info[key].identifier,
-            model=info[key].model,
-            kind=info[key].kind,
-            minimum=info[key].minimum,
-            maximum=info[key].maximum,
-            connected=stat[key].connected,
-            ready=stat[key].ready,
-            position=stat[key].position,
-            ontarget=stat[key].ontarget,
+            identifier=state.info.identifier,
+            model=state.info.model,
+            kind=state.info.kind,
+            minimum=state.info.minimum,
+            maximum=state.info.maximum,
+            connected=state.status.connected,
+            ready=state.status.ready,
+            position=state.status.position,
+            ontarget=state.status.ontarget,
         )
     return res
 
+
+@router.get("/get/stage/fullstate")
+async def getStageFullstate():
+    return toplevelinterface.state.view(fullStateView)
+
+
+@router.get("/get/stage/changes")
+async def getStageChanges(since: int = 0, epoch: str | None = None, timeout: float | None = None) -> StageChanges:
+    """
+    Gets the stages which changed after the given version of the stage state
+    :param since: version the client last saw, 0 for everything
+    :param epoch: epoch the client got along with that version. If it isn't the server's, everything is sent
+    :param timeout: if given and nothing changed yet, wait up to this many seconds for a change before answering
+    :return: the changes, and the epoch and version they bring the client up to
+    """
+    if timeout is None:
+        return toplevelinterface.state.changes(since, epoch)
+    return await toplevelinterface.state.wait(since, epoch, timeout)
+
+
 class MoveStageResponse(BaseModel):
     success: bool = Field(description="Whether the stage successfully received the move command")
     error: str = Field(description="The error message in case of failure", default=None)
+    ontarget: bool | None = Field(default=None, description="When waiting, whether the stage got on target in time")
 
 
 @router.get("/get/stage/move")
-async def moveStage(background_tasks: BackgroundTasks, identifier: int, position: float) -> MoveStageResponse:
+async def moveStage(identifier: int, position: float, wait: bool = False, timeout: float | None = None) -> MoveStageResponse:
     """
     Moves the indicated stage
+    :param wait: respond only once the stage is on target
+    :param timeout: seconds to wait for the stage at most
     :return: Response
     """
     try:
+        if wait:
+            ontarget = await toplevelinterface.moveStage(identifier, position, wait=True, timeout=timeout)
+            return MoveStageResponse(success=True, ontarget=ontarget)
         await toplevelinterface.moveStage(identifier, position)
-        background_tasks.add_task(checkUntilOnTarget, background_tasks, [identifier])
         return MoveStageResponse(success=True)
+    except asyncio.TimeoutError:
+        return MoveStageResponse(success=True, ontarget=False, error=f"Not on target after {timeout}s")
     except Exception as error:
         return MoveStageResponse(success=False, error=str(error))
 
 
+@router.post("/post/stage/moves")
+async def moveStages(targets: dict[int, float], wait: bool = False,
+                     timeout: float | None = None) -> dict[int, MoveStageResponse]:
+    """
+    Moves several stages at once, with one command per controller so they start together
+    :param targets: identifier -> position to move to
+    :param wait: respond only once the stages are on target
+    :param timeout: seconds to wait for the stages at most
+    :return: Response per stage
+    """
+    res = {}
+    for identifier, result in (await toplevelinterface.moveStages(targets, wait=wait, timeout=timeout)).items():
+        if isinstance(result, asyncio.TimeoutError):
+            res[identifier] = MoveStageResponse(success=True, ontarget=False, error=f"Not on target after {timeout}s")
+        elif isinstance(result, Exception):
+            res[identifier] = MoveStageResponse(success=False, error=str(result))
+        else:
+            res[identifier] = MoveStageResponse(success=True, ontarget=result if wait else None)
+    return res
+
+
 @router.get("/get/stage/step")
-async def stepStage(background_tasks: BackgroundTasks, identifier: int, step: float) -> MoveStageResponse:
+async def stepStage(identifier: int, step: float, wait: bool = False, timeout: float | None = None) -> MoveStageResponse:
     try:
+        if wait:
+            ontarget = await toplevelinterface.stepStage(identifier, step, wait=True, timeout=timeout)
+            return MoveStageResponse(success=True, ontarget=ontarget)
         await toplevelinterface.stepStage(identifier, step)
-        background_tasks.add_task(checkUntilOnTarget, background_tasks, [identifier])
         return MoveStageResponse(success=True)
+    except asyncio.TimeoutError:
+        return MoveStageResponse(success=True, ontarget=False, error=f"Not on target after {timeout}s")
     except Exception as error:
         return MoveStageResponse(success=False, error=str(error))
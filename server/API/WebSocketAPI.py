@@ -1,19 +1,35 @@
+from __future__ import annotations
+
 import asyncio
-import json
+import math
+import struct
+import uuid
+from collections import deque
 from enum import Enum
-from typing import Dict, Any
+from typing import Dict, Any, Callable, Awaitable
 
 from fastapi import WebSocket
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError, model_validator
 
 from server.Interface import toplevelinterface
 from server.StageControl.DataTypes import EventAnnouncer, StageStatus, StageInfo, StageRemoved, Notice, \
-    ConfigurationUpdate, Configuration
+    ConfigurationUpdate, Configuration, Conflator, eventKey, \
+    Subscription
 
 
 class ReqTypes(Enum):
     """Enumerates request types for websocket connections"""
     ping = "ping"
+    subscribe = "subscribe"
+    unsubscribe = "unsubscribe"
+    move = "move"
+    step = "step"
+    batch = "batch"
+    stop = "stop"
+
+
+COMMANDS: set[ReqTypes] = {ReqTypes.move, ReqTypes.step, ReqTypes.batch, ReqTypes.stop}
+"""Requests which drive stages, acknowledged asynchronously once the controller accepted them"""
 
 
 class ErrTypes(Enum):
@@ -26,11 +42,45 @@ class ErrTypes(Enum):
 class Req(BaseModel):
     """Websocket request from client"""
     request: ReqTypes
+    id: int | str | None = Field(default=None, description="Chosen by the client, echoed in the response so it can "
+                                                           "be matched to the request", examples=[42])
+    events: list[str] | None = Field(default=None, description="Event types to (un)subscribe",
+                                     examples=[["StageStatus", "StageInfo"]])
+    interfaces: list[str] | None = Field(default=None, description="Interface names to (un)subscribe",
+                                         examples=[["PI", "Standa"]])
+    identifiers: list[int] | None = Field(default=None, description="Stage identifiers (or controller SNs for "
+                                                                     "ConfigurationUpdate) to (un)subscribe",
+                                          examples=[[4250030443, 4250030444]])
+    identifier: int | None = Field(default=None, description="Stage to move, step or stop. Stop without an "
+                                                             "identifier stops every stage", examples=[4250030443])
+    position: float | None = Field(default=None, description="Position to move to", examples=[12.5])
+    step: float | None = Field(default=None, description="Distance to step by", examples=[-0.1])
+    moves: dict[int, float] | None = Field(default=None, description="Batch of identifier -> position to move to",
+                                           examples=[{4250030443: 12.5, 4250030444: 3}])
+    wait: bool = Field(default=False, description="Acknowledge a move, step or batch only once the stages are on "
+                                                  "target")
+    timeout: float | None = Field(default=None, description="Seconds to wait for the stages at most", examples=[10])
+
+    @model_validator(mode="after")
+    def check_arguments(self):
+        """Commands need their arguments"""
+        match self.request:
+            case ReqTypes.move:
+                if self.identifier is None or self.position is None:
+                    raise ValueError("move needs an identifier and a position")
+            case ReqTypes.step:
+                if self.identifier is None or self.step is None:
+                    raise ValueError("step needs an identifier and a step")
+            case ReqTypes.batch:
+                if not self.moves:
+                    raise ValueError("batch needs moves")
+        return self
 
 
 class WsResponse(BaseModel):
     """Websocket response to client"""
     response: str
+    id: int | str | None = Field(default=None, description="id of the request this responds to")
     data: Dict[str, Any]
 
 
@@ -66,6 +116,167 @@ class ErrorUpdate(Update):
     errormsg: str = Field(default="Unknown error", description="Error message")
 
 
+EVENTS: list[str] = ["StageStatus", "StageInfo", "StageRemoved", "Notice", "ConfigurationUpdate"]
+"""Names of the events sent over the websocket"""
+
+SNAPSHOT_EVENTS: list[str] = ["StageInfo", "StageStatus", "ConfigurationUpdate"]
+"""Events whose latest state per stage (or controller) makes up a snapshot"""
+
+
+class Encoding(Enum):
+    """Frame encodings a client can choose when connecting, i.e. /ws/?encoding=binary"""
+    json = "json"
+    """Every event as a JSON text frame, {"event": ..., "data": {...}}"""
+    binary = "binary"
+    """StageStatus as a fixed size binary frame, see STAGESTATUS_FRAME, everything else as JSON text frames"""
+
+
+STAGESTATUS_FRAME = struct.Struct("<BQqdB")
+"""
+Binary StageStatus frame, little endian, 26 bytes: frame type (STAGESTATUS_TYPE), sequence number as uint64,
+identifier as int64, position as float64 (NaN if unknown) and flags, bit 0 connected, bit 1 ready, bit 2 ontarget.
+"""
+STAGESTATUS_TYPE = 1
+
+
+class SlowClientPolicy(Enum):
+    """What to do with a client whose outbound queue reaches the high-water mark"""
+    drop_oldest = "drop_oldest"
+    """Drop its oldest queued frame"""
+    disconnect = "disconnect"
+    """Give up on the client and close the connection"""
+
+
+class WsClient:
+    """
+    A single websocket connection and what it is subscribed to. For each dimension None means everything, a new
+    client receives every event. Filters only apply to events carrying that information, i.e. a Notice without
+    an identifier goes to every client subscribed to Notice events.
+
+    Everything sent to the client goes through its own ordered queue, written out by its own writer task, so a slow
+    or dead connection only ever holds itself up.
+    """
+
+    def __init__(self, websocket: WebSocket, high_water: int = 256, send_timeout: float = 5,
+                 policy: SlowClientPolicy = SlowClientPolicy.drop_oldest,
+                 on_dead: Callable[[WsClient], None] = None, encoding: Encoding = Encoding.json):
+        """
+        :param websocket: the connection
+        :param high_water: how many frames may wait in the queue
+        :param send_timeout: seconds a single send may take before we consider the connection stuck
+        :param policy: what to do when the queue is full
+        :param on_dead: called when the connection turns out stuck or closed
+        :param encoding: how events are encoded for this client
+        """
+        self.websocket = websocket
+        self.encoding = encoding
+        self.outbox: asyncio.Queue[str | bytes] = asyncio.Queue(high_water)
+        """Frames waiting to be sent"""
+        self.send_timeout = send_timeout
+        self.policy = policy
+        self.on_dead = on_dead
+        self.dropped: int = 0
+        """Frames dropped because the queue was full"""
+        self.alive: bool = True
+        self.commandLock = asyncio.Lock()
+        """Held while one of the client's move commands runs, so they reach the controllers in order"""
+        self.writer: asyncio.Task = asyncio.create_task(self.write())
+        self.events: set[str] | None = None
+        """Event names to receive"""
+        self.interfaces: set[str] | None = None
+        """Interface names (PI, Standa, Virtual) to receive events from"""
+        self.identifiers: set[int] | None = None
+        """Stage identifiers, or controller SNs, to receive events for"""
+
+    def subscribe(self, events: list[str] = None, interfaces: list[str] = None, identifiers: list[int] = None):
+        """Adds to the subscription. The first subscription in a dimension narrows it down from everything"""
+        if events is not None:
+            self.events = set(events) if self.events is None else self.events | set(events)
+        if interfaces is not None:
+            self.interfaces = set(interfaces) if self.interfaces is None else self.interfaces | set(interfaces)
+        if identifiers is not None:
+            self.identifiers = set(identifiers) if self.identifiers is None else self.identifiers | set(identifiers)
+
+    def unsubscribe(self, events: list[str] = None, interfaces: list[str] = None, identifiers: list[int] = None,
+                    allInterfaces: list[str] = None, allIdentifiers: list[int] = None):
+        """
+        Removes from the subscription. Unsubscribing from part of everything leaves everything else that is known
+        right now, which is why the currently known interfaces and identifiers are needed.
+        """
+        if events is not None:
+            self.events = (set(EVENTS) if self.events is None else self.events) - set(events)
+        if interfaces is not None:
+            self.interfaces = (set(allInterfaces or []) if self.interfaces is None else self.interfaces) - set(interfaces)
+        if identifiers is not None:
+            self.identifiers = (set(allIdentifiers or []) if self.identifiers is None else self.identifiers) - set(identifiers)
+
+    def wants(self, event: str, interface: str | None, key: int | None) -> bool:
+        """
+        Whether the client is subscribed to this event, the same decision the index makes for live events
+        :param event: name of the event
+        :param interface: interface the event came from, if known
+        :param key: identifier (or controller SN) of the event, if it has one
+        """
+        if self.events is not None and event not in self.events:
+            return False
+        if key is None:
+            return True
+        if self.interfaces is not None and interface not in self.interfaces:
+            return False
+        return self.identifiers is None or key in self.identifiers
+
+    def send(self, frame: str | bytes):
+        """Queue a frame for sending, without waiting. Text frames are str, binary frames bytes"""
+        if not self.alive:
+            return
+        if self.outbox.full():
+            if self.policy is SlowClientPolicy.disconnect:
+                self.die(f"{self.outbox.qsize()} frames waiting")
+                return
+            self.outbox.get_nowait()
+            self.dropped += 1
+        self.outbox.put_nowait(frame)
+
+    async def write(self):
+        """Writer task, sends queued frames in order"""
+        try:
+            while True:
+                frame = await self.outbox.get()
+                # asyncio.wait rather than wait_for, which can swallow our own cancellation if the send
+                # finishes at the same moment
+                if isinstance(frame, bytes):
+                    sending = asyncio.ensure_future(self.websocket.send_bytes(frame))
+                else:
+                    sending = asyncio.ensure_future(self.websocket.send_text(frame))
+                try:
+                    done, _ = await asyncio.wait({sending}, timeout=self.send_timeout)
+                except asyncio.CancelledError:
+                    sending.cancel()
+                    raise
+                if not done:
+                    sending.cancel()
+                    self.die(f"send took longer than {self.send_timeout}s")
+                    return
+                sending.result()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.die(str(e))
+
+    def die(self, reason: str):
+        """The connection is stuck or closed, stop sending and let the owner reap it"""
+        if not self.alive:
+            return
+        print(f"Dropping websocket client: {reason}")
+        self.alive = False
+        if self.on_dead is not None:
+            self.on_dead(self)
+
+    def close(self):
+        """Stop the writer, anything still queued is discarded"""
+        self.alive = False
+        if asyncio.current_task() is not self.writer:
+            self.writer.cancel()
 
 
 
@@ -75,101 +286,424 @@ class WebSocketAPI:
     This class will push updates to the client, i.e. position updates from the controllers.
     """
 
-    def __init__(self):
-        self.active_connections: list[WebSocket] = []
-        self.EA: EventAnnouncer = EventAnnouncer(WebSocketAPI, StageStatus)
-        # Subscribe to stage status changes
-        self.EA.patch_through_from([StageStatus, StageInfo, StageRemoved, Notice, ConfigurationUpdate], toplevelinterface.EventAnnouncer)
-        sub = toplevelinterface.EventAnnouncer.subscribe(StageStatus, StageInfo, StageRemoved, Notice, ConfigurationUpdate)
+    def __init__(self, conflation_window: float = 0.05, high_water: int = 256, send_timeout: float = 5,
+                 slow_client_policy: SlowClientPolicy = SlowClientPolicy.drop_oldest, replay_size: int = 1024):
+        """
+        :param conflation_window: seconds during which StageStatus/StageInfo updates of a stage following the first
+        one are merged into one
+        :param high_water: how many frames may wait for each client
+        :param send_timeout: seconds a send may take before a client is considered stuck and disconnected
+        :param slow_client_policy: what to do with a client whose queue is full
+        :param replay_size: how many past events are kept for clients resuming after a reconnect
+        """
+        self.epoch: str = uuid.uuid4().hex
+        """Tells this run of the server apart from the others, sequence numbers only mean something along with it"""
+        self.seq: int = 0
+        """Sequence number of the last event, every event gets the next one"""
+        self.log: deque[tuple[int, str, BaseModel]] = deque(maxlen=replay_size)
+        """The last events as (seq, event name, event), for resuming clients"""
+        self.latest: dict[str, dict[int, BaseModel]] = {event: {} for event in SNAPSHOT_EVENTS}
+        """event name -> identifier (or SN) -> latest event, for snapshots"""
+        self.high_water = high_water
+        self.send_timeout = send_timeout
+        self.slow_client_policy = slow_client_policy
+        self.commands: set[asyncio.Task] = set()
+        """Commands being executed"""
+        self.clients: dict[WebSocket, WsClient] = {}
+        """Connected clients"""
+        self._index: dict[tuple[str, str | None, int | None], list[WsClient]] = {}
+        """(event, interface, identifier) -> clients, with None for clients not filtering on that dimension"""
+        self._byEvent: dict[str, list[WsClient]] = {}
+        """event -> clients, for events without an identifier"""
+        self.interfaceOf: dict[int, str] = {}
+        """Identifier (or controller SN) -> name of the interface its events come from"""
+        self.EA: EventAnnouncer = EventAnnouncer(WebSocketAPI, StageStatus, StageInfo, StageRemoved, Notice, ConfigurationUpdate)
+        # Stage updates pass through the conflator, so clients get at most one per stage per window and no repeats.
+        # It's the only conflation on the way, the queue below just keeps slow clients from holding up the producers.
+        self.conflator = Conflator(self.EA.event, window=conflation_window)
+        self.subscriptions: list[Subscription] = []
+        """Our subscriptions, kept so we can unsubscribe on shutdown"""
+        # Subscribe to each interface separately, so we know where events came from for interface filters
+        for intf in toplevelinterface.interfaces:
+            upstream = intf.EventAnnouncer.subscribe(StageStatus, StageInfo, StageRemoved, Notice, ConfigurationUpdate)
+            tagger = self.tagger(intf.name)
+            for datatype in upstream.datatypes:
+                upstream.deliverTo(datatype, tagger)
+            self.subscriptions.append(upstream)
+
+        sub = self.EA.subscribe(StageStatus, StageInfo, StageRemoved, Notice, ConfigurationUpdate)
+        # Deliver through a bounded queue so slow clients don't hold up the hardware polling emitting the events
+        sub.queued(maxsize=1024)
         sub.deliverTo(StageStatus,self.broadcastStageStatus)
         sub.deliverTo(StageInfo,self.broadcastStageInfo)
         sub.deliverTo(StageRemoved, self.broadcastStageRemoved)
         sub.deliverTo(Notice, self.broadcastNotice)
         sub.deliverTo(ConfigurationUpdate, self.broadcastConfigurationUpdate)
-
-    async def receive(self, msg: Req, websocket: WebSocket) -> None:
+        self.subscriptions.append(sub)
+
+    def shutdown(self):
+        """Stop receiving and broadcasting events, and stop writing to the connected clients"""
+        for sub in self.subscriptions:
+            sub.unsubscribe()
+        self.subscriptions = []
+        for websocket in list(self.clients.keys()):
+            self.disconnect(websocket)
+        for task in self.commands:
+            task.cancel()
+
+    def tagger(self, name: str) -> Callable[[Any], None]:
+        """Returns a destination which notes the events are from the given interface, then passes them on"""
+        def tag(event: Any):
+            key = eventKey(event)
+            if key is not None:
+                self.interfaceOf[key] = name
+            self.conflator(event)
+        return tag
+
+    async def receive(self, msg: Req | dict, websocket: WebSocket) -> None:
         """
         Receives and reacts to websocket messages
-        :param msg: request parsed from json into a python object
+        :param msg: request parsed from json, either still a dict or already validated
         :param websocket: websocket which sent the request
         :return: none
         """
         print(f"Received WS: {msg}")
+        client = self.clients.get(websocket)
+        if client is None:
+            # reaped for being too slow, its connection is on its way out
+            return
+        try:
+            if not isinstance(msg, Req):
+                msg = Req.model_validate(msg)
+        except ValidationError as e:
+            # Answer with the id if we can find one, so the client knows which request it was
+            reqid = msg.get("id") if isinstance(msg, dict) and isinstance(msg.get("id"), (int, str)) else None
+            client.send(WsErrResponse(id=reqid, errortype=ErrTypes.malformed_request, errormsg=str(e),
+                                      data={}).model_dump_json())
+            return
+
+        if msg.request in COMMANDS:
+            # The controllers can take their time, answer once they're done without holding up this connection
+            task = asyncio.create_task(self.command(msg, client))
+            self.commands.add(task)
+            task.add_done_callback(self.commands.discard)
+            return
+
         # Prepopulate the response var as an unknown request error
-        response: WsResponse = WsErrResponse(errortype = ErrTypes.unknown_request, errormsg = f"Unknown request '{msg.request}'")
+        response: WsResponse = WsErrResponse(id=msg.id, errortype = ErrTypes.unknown_request, errormsg = f"Unknown request '{msg.request}'", data={})
         try:
             match msg.request:
                 case ReqTypes.ping:
-                    response = WsResponse(response="pong", data={})
+                    response = WsResponse(response="pong", id=msg.id, data={})
+                case ReqTypes.subscribe:
+                    client.subscribe(msg.events, msg.interfaces, msg.identifiers)
+                    self.rebuildIndex()
+                    response = WsResponse(response="subscribed", id=msg.id, data=self.subscriptionOf(client))
+                case ReqTypes.unsubscribe:
+                    client.unsubscribe(msg.events, msg.interfaces, msg.identifiers,
+                                       [intf.name for intf in toplevelinterface.interfaces],
+                                       toplevelinterface.allIdentifiers)
+                    self.rebuildIndex()
+                    response = WsResponse(response="unsubscribed", id=msg.id, data=self.subscriptionOf(client))
         except Exception as e:
             # We ran into something weird, send the error message and return
-            await websocket.send_json(WsErrResponse(errortype= ErrTypes.unknown_request, errormsg= str(e)))
+            client.send(WsErrResponse(id=msg.id, errortype= ErrTypes.other_error, errormsg= str(e), data={}).model_dump_json())
             return
 
         # No exceptions, lets send the response
-        await websocket.send_json(response)
+        client.send(response.model_dump_json())
 
-    async def connect(self, websocket: WebSocket):
+    def reject(self, websocket: WebSocket, error: Exception) -> bool:
+        """
+        Answers a message which couldn't even be read as a request, through the client's outbox like any other answer
+        :param websocket: websocket which sent the message
+        :param error: what was wrong with it
+        :return: False if the client isn't connected anymore, i.e. reaped for being too slow, so stop listening to it
+        """
+        client = self.clients.get(websocket)
+        if client is None or not client.alive:
+            return False
+        client.send(WsErrResponse(errortype=ErrTypes.malformed_request, errormsg=str(error), data={}).model_dump_json())
+        return True
+
+    async def command(self, msg: Req, client: WsClient):
+        """
+        Executes a move, step, batch or stop command and acknowledges it to the client. A client's moves reach the
+        controllers in the order they were sent, stop doesn't wait for them.
+        :param msg: the command
+        :param client: who sent it
+        """
+        try:
+            if msg.request is ReqTypes.stop:
+                data = await self.execute(msg)
+            else:
+                async with client.commandLock:
+                    data = await self.execute(msg)
+        except Exception as e:
+            client.send(WsErrResponse(id=msg.id, errortype=ErrTypes.other_error, errormsg=str(e),
+                                      data={}).model_dump_json())
+            return
+
+        if len(data["errors"]) > 0:
+            response = WsErrResponse(id=msg.id, errortype=ErrTypes.other_error, data=data,
+                                     errormsg="; ".join(f"{ident}: {err}" for ident, err in data["errors"].items()))
+        else:
+            response = WsResponse(response="ack", id=msg.id, data=data)
+        client.send(response.model_dump_json())
+
+    async def execute(self, msg: Req) -> dict[str, Any]:
+        """
+        Sends a command to the controllers, and waits for the stages to get on target if asked to
+        :param msg: move, step, batch or stop command
+        :return: {"accepted": identifiers which took the command, "errors": identifier -> error of those which didn't},
+        plus "ontarget": identifier -> whether it got there, when waiting
+        """
+        match msg.request:
+            case ReqTypes.move:
+                results = await self.gathered({msg.identifier: toplevelinterface.moveStage(msg.identifier,
+                                                                                          msg.position)})
+            case ReqTypes.step:
+                results = await self.gathered({msg.identifier: toplevelinterface.stepStage(msg.identifier, msg.step)})
+            case ReqTypes.batch:
+                # one command per controller, so the stages start together
+                results = await toplevelinterface.moveStages(msg.moves)
+            case ReqTypes.stop:
+                identifiers = toplevelinterface.allIdentifiers if msg.identifier is None else [msg.identifier]
+                results = await self.gathered({identifier: toplevelinterface.stopStage(identifier)
+                                               for identifier in identifiers})
+            case _:
+                raise Exception(f"{msg.request} is not a command")
+
+        accepted: list[int] = []
+        errors: dict[int, str] = {}
+        for identifier, result in results.items():
+            if isinstance(result, Exception):
+                errors[identifier] = str(result)
+            else:
+                accepted.append(identifier)
+
+        # Moved stages are watched by the motion supervisor, stopped stages won't reach their target, so just update
+        # them once
+        if msg.request is ReqTypes.stop:
+            if len(accepted) > 0:
+                await toplevelinterface.updateStageStatus(accepted)
+            return {"accepted": accepted, "errors": errors}
+        if not msg.wait:
+            return {"accepted": accepted, "errors": errors}
+
+        # Each on its own, so a stage that doesn't make it doesn't hide the ones that did
+        arrivals = await asyncio.gather(*[toplevelinterface.supervisor.untilOnTarget([identifier], msg.timeout)
+                                          for identifier in accepted], return_exceptions=True)
+        ontarget: dict[int, bool] = {}
+        for identifier, arrival in zip(accepted, arrivals):
+            if isinstance(arrival, asyncio.TimeoutError):
+                ontarget[identifier] = False
+                errors[identifier] = f"Not on target after {msg.timeout}s"
+            elif isinstance(arrival, Exception):
+                ontarget[identifier] = False
+                errors[identifier] = str(arrival)
+            else:
+                ontarget[identifier] = arrival[identifier]
+        return {"accepted": accepted, "errors": errors, "ontarget": ontarget}
+
+    @staticmethod
+    async def gathered(calls: dict[int, Awaitable]) -> dict[int, Any]:
+        """Runs the calls side by side, identifier -> result, or the exception it raised"""
+        return dict(zip(calls.keys(), await asyncio.gather(*calls.values(), return_exceptions=True)))
+
+    @staticmethod
+    def subscriptionOf(client: WsClient) -> dict[str, Any]:
+        """Current subscription of the client, for responses"""
+        def listed(values: set | None):
+            return None if values is None else sorted(values)
+        return {
+            "events": listed(client.events),
+            "interfaces": listed(client.interfaces),
+            "identifiers": listed(client.identifiers),
+        }
+
+    async def connect(self, websocket: WebSocket, encoding: Encoding = Encoding.json, since: int | None = None,
+                      epoch: str | None = None):
+        """
+        Accepts the connection and starts sending it events, beginning with either a snapshot of the current state
+        or, for a client resuming after a reconnect, the events it missed
+        :param websocket: the new connection
+        :param encoding: encoding the client asked for
+        :param since: sequence number of the last event the client received before reconnecting
+        :param epoch: epoch of the snapshot the client got, its sequence numbers are from another run if it isn't ours
+        """
         await websocket.accept()
-        self.active_connections.append(websocket)
+        client = WsClient(websocket, self.high_water, self.send_timeout, self.slow_client_policy,
+                          on_dead=self.reap, encoding=encoding)
+        self.clients[websocket] = client
+        self.rebuildIndex()
+        # Nothing can be broadcast between here and the end of the replay/snapshot, so the client doesn't miss
+        # anything or get it twice
+        if since is None or epoch != self.epoch or not self.replay(client, since):
+            client.send(self.snapshot(client))
+
+    def replay(self, client: WsClient, since: int) -> bool:
+        """
+        Sends the client the events after the given sequence number
+        :param client: a resuming client
+        :param since: the last sequence number the client received
+        :return: False if we can't, because the events are no longer in the log, there are too many of them to queue,
+        or the client's sequence number is ahead of ours. Check the epoch first, a sequence number from another run
+        looks like one of ours.
+        """
+        if since > self.seq:
+            return False
+        missed = self.seq - since
+        if missed == 0:
+            return True
+        if missed > len(self.log) or missed > self.high_water:
+            return False
+        for seq, event, message in list(self.log)[-missed:]:
+            key = eventKey(message)
+            if client.wants(event, self.interfaceOf.get(key), key):
+                client.send(self.encode(client, seq, event, message))
+        return True
+
+    def snapshot(self, client: WsClient) -> str:
+        """
+        Frame with the latest StageInfo, StageStatus and ConfigurationUpdate of everything the client is subscribed
+        to, {"seq": ..., "epoch": ..., "event": "Snapshot", "data": {"StageInfo": [...], ...}}. The seq is that of
+        the last event included, so the client can resume from it by sending it back along with the epoch.
+        """
+        parts = []
+        for event, latest in self.latest.items():
+            messages = [message.model_dump_json(serialize_as_any=True) for key, message in latest.items()
+                        if client.wants(event, self.interfaceOf.get(key), key)]
+            parts.append(f'"{event}":[{",".join(messages)}]')
+        return f'{{"seq":{self.seq},"epoch":"{self.epoch}","event":"Snapshot","data":{{{",".join(parts)}}}}}'
+
+    def remember(self, seq: int, event: str, message: BaseModel):
+        """Keeps the event for replays and snapshots"""
+        # a copy, the interfaces are free to keep changing the objects they emitted
+        message = message.model_copy()
+        self.log.append((seq, event, message))
+        key = eventKey(message)
+        if event in self.latest and key is not None:
+            self.latest[event][key] = message
+        elif event == "StageRemoved":
+            self.latest["StageInfo"].pop(key, None)
+            self.latest["StageStatus"].pop(key, None)
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        client = self.clients.pop(websocket, None)
+        if client is not None:
+            client.close()
+        self.rebuildIndex()
+
+    def reap(self, client: WsClient):
+        """Removes a stuck or closed client and closes its connection"""
+        self.disconnect(client.websocket)
+
+        async def close():
+            try:
+                await asyncio.wait_for(client.websocket.close(), self.send_timeout)
+            except Exception:
+                # it's dead either way
+                pass
+        asyncio.create_task(close())
+
+    def rebuildIndex(self):
+        """Rebuild the index of who receives what, run whenever a client connects or changes its subscription"""
+        index: dict[tuple[str, str | None, int | None], list[WsClient]] = {}
+        byEvent: dict[str, list[WsClient]] = {}
+        for client in self.clients.values():
+            events = EVENTS if client.events is None else client.events
+            interfaces = [None] if client.interfaces is None else client.interfaces
+            identifiers = [None] if client.identifiers is None else client.identifiers
+            for event in events:
+                byEvent.setdefault(event, []).append(client)
+                for interface in interfaces:
+                    for identifier in identifiers:
+                        index.setdefault((event, interface, identifier), []).append(client)
+        self._index = index
+        self._byEvent = byEvent
+
+    def recipients(self, event: str, key: int | None) -> list[WsClient]:
+        """Clients subscribed to this event, looked up in the index"""
+        if key is None:
+            return self._byEvent.get(event, [])
+
+        interface = self.interfaceOf.get(key)
+        # A client only filters each dimension or doesn't, so it shows up in exactly one of these
+        res = self._index.get((event, None, None), []) + self._index.get((event, None, key), [])
+        if interface is not None:
+            res = res + self._index.get((event, interface, None), []) + self._index.get((event, interface, key), [])
+        return res
+
+    @staticmethod
+    def frame(seq: int, event: str, message: BaseModel) -> str:
+        """
+        Serializes an event into the final websocket frame, {"seq": ..., "event": ..., "data": {...}}. The data is
+        embedded as a JSON object rather than a JSON string, so it is encoded exactly once.
+        :param seq: sequence number of the event
+        :param event: name of the event, i.e. StageStatus
+        :param message: the event itself
+        :return: the frame, ready to send to every client
+        """
+        # serialize_as_any dumps subclasses in nested fields too, i.e. the configuration in ConfigurationUpdate
+        return f'{{"seq":{seq},"event":"{event}","data":{message.model_dump_json(serialize_as_any=True)}}}'
+
+    @staticmethod
+    def binaryFrame(seq: int, message: StageStatus) -> bytes:
+        """
+        Packs a StageStatus into the fixed binary layout of STAGESTATUS_FRAME
+        :param seq: sequence number of the event
+        :param message: the status
+        :return: the frame, ready to send to every client using the binary encoding
+        """
+        flags = message.connected | message.ready << 1 | message.ontarget << 2
+        position = math.nan if message.position is None else message.position
+        return STAGESTATUS_FRAME.pack(STAGESTATUS_TYPE, seq, message.identifier, position, flags)
+
+    def encode(self, client: WsClient, seq: int, event: str, message: BaseModel) -> str | bytes:
+        """Frame of the event in the client's encoding"""
+        if client.encoding is Encoding.binary and isinstance(message, StageStatus):
+            return self.binaryFrame(seq, message)
+        return self.frame(seq, event, message)
 
     def broadcastStageRemoved(self, message: StageRemoved):
-        asyncio.create_task(
-            self.broadcast({
-                "event": "StageRemoved",
-                "data": message.model_dump_json()
-            })
-        )
+        self.broadcast("StageRemoved", message)
+
     def broadcastStageStatus(self, message: StageStatus):
-        asyncio.create_task(
-            self.broadcast({
-            "event": "StageStatus",
-            "data": message.model_dump_json()
-        }))
+        self.broadcast("StageStatus", message)
 
     def broadcastStageInfo(self, message: StageInfo):
-        asyncio.create_task(self.broadcast({
-            "event": "StageInfo",
-            "data": message.model_dump_json()
-        }))
+        self.broadcast("StageInfo", message)
 
     def broadcastNotice(self, message: Notice):
-        asyncio.create_task(self.broadcast({
-            "event": "Notice",
-            "data": message.model_dump_json()
-        }))
+        self.broadcast("Notice", message)
 
     def broadcastConfigurationUpdate(self, message: ConfigurationUpdate):
-        print("configurationupdate broadcast")
-        # Because pydantic will only dump to the base class in nested objects, we need to do it manually
-        if message.configuration is not None: # because we don't need to pass in a configuration
-            config = message.configuration.model_dump_json() # this will dump subclasses properly
-            message = message.model_dump_json() # pydantic says no I won't dump subclasses in properties
-
-            # force-feed into dicts
-            message = json.loads(message)
-            config = json.loads(config)
+        self.broadcast("ConfigurationUpdate", message)
 
-            message["configuration"] = config # we now have a proper json-ready dict
+    def broadcast(self, event: str, message: BaseModel):
+        """
+        Numbers the event, then serializes it once per encoding in use and queues it for every client subscribed to it
+        """
+        self.seq += 1
+        seq = self.seq
+        self.remember(seq, event, message)
+        recipients = self.recipients(event, eventKey(message))
+        if len(recipients) == 0:
+            return
 
-        else:
-            # just do a regular JSON serialization
-            message = json.loads(message.model_dump_json())
-
-        asyncio.create_task(self.broadcast({
-            "event": "ConfigurationUpdate",
-            "data": message
-        }))
-
-    async def broadcast(self, json: dict[str, str]):
-        print(f"Broadcasting event {json} to {len(self.active_connections)} active clients")
-        awaiters = []
-        for connection in self.active_connections:
-            awaiters.append(connection.send_json(json))
-        await asyncio.gather(*awaiters)
+        packable = isinstance(message, StageStatus)
+        text: str | None = None
+        binary: bytes | None = None
+        for client in recipients:
+            if packable and client.encoding is Encoding.binary:
+                if binary is None:
+                    binary = self.binaryFrame(seq, message)
+                client.send(binary)
+            else:
+                if text is None:
+                    text = self.frame(seq, event, message)
+                client.send(text)
 
 
 websocketapi = WebSocketAPI()
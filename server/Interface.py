@@ -6,6 +6,9 @@ from pipython import GCSDevice
 from .StageControl.PI.Interface import PIControllerInterface
 from .StageControl.Standa.Interface import StandaInterface
 from .StageControl.Virtual import VirtualControllerInterface
+from .StageControl.MotionSupervisor import MotionSupervisor
+from .StageControl.Registry import StageRegistry
+from .StageControl.StateStore import StageStateStore, infoView, statusView
 from .StageControl.DataTypes import StageInfo, ControllerInterface, EventAnnouncer, StageStatus, StageRemoved, Notice, \
     ConfigurationUpdate
 
@@ -29,6 +32,14 @@ class MainInterface:
         """Pass in all additional Controller Interfaces in the constructor"""
         self.EventAnnouncer: EventAnnouncer = EventAnnouncer(MainInterface, StageInfo, StageStatus, StageRemoved, Notice, ConfigurationUpdate)
         self._interfaces: list[ControllerInterface] = []
+        self.registry: StageRegistry = StageRegistry(self.EventAnnouncer)
+        """Which interface each stage belongs to"""
+        self.supervisor: MotionSupervisor = MotionSupervisor(self._interfaces, registry=self.registry,
+                                                             EA=self.EventAnnouncer)
+        """Watches moving stages until they're on target"""
+        self.state: StageStateStore = StageStateStore()
+        """Latest info and status of every stage, for reading them without asking the controllers"""
+        self.state.watch(self.EventAnnouncer)
         for intf in controller_interfaces:
             self.addInterface(intf)
 
@@ -48,6 +59,8 @@ class MainInterface:
             return
         # New interface, lets sub to their event announcer and feed it directly into ours
         self.EventAnnouncer.patch_through_from(self.EventAnnouncer.availableDataTypes, intf.EventAnnouncer)
+        self.registry.watch(intf)
+        self.state.seed(intf)
 
         # All done, finally append to the list
         self._interfaces.append(intf)
@@ -66,14 +79,10 @@ class MainInterface:
     @property
     def StageInfo(self) -> dict[int, StageInfo]:
         """
-        Returns the stage info from each controller.
+        Returns the latest stage info announced by the controllers. Shared until the next change, don't modify it.
         :return: dict of identifier -> StageInfo
         """
-        res: dict[int, StageInfo] = {}
-        for cnt in self.interfaces:
-            res.update(cnt.stageInfo)
-
-        return res
+        return self.state.view(infoView)
 
     async def updateStageStatus(self, identifiers: list[int] = None):
         """
@@ -89,61 +98,154 @@ class MainInterface:
     @property
     def StageStatus(self) -> dict[int, StageStatus]:
         """
-        Returns the stage status from each controller.
-        :return: dict of identifier -> StageInfo
+        Returns the latest stage status announced by the controllers. Shared until the next change, don't modify it.
+        :return: dict of identifier -> StageStatus
         """
-        res: dict[int, StageStatus] = {}
-        for cnt in self.interfaces:
-            res.update(cnt.stageStatus)
-
-        return res
+        return self.state.view(statusView)
 
     def getRelevantInterface(self, identifier: int) -> ControllerInterface | None:
         """
         Returns relevant controller interface for given stage identifier.
         :param identifier: stage identifier to look for
         :return: ControllerInterface, or if the identifier isn't found, None.
+        :raises Exception: if more than one interface uses the identifier
         """
+        route = self.registry.lookup(identifier)
+        if route is not None:
+            return route.interface
+
+        # Not announced (yet), ask around
         for interface in self.interfaces:
             if interface.stages.__contains__(identifier):
                 return interface
         # We haven't found anything, return none.
         return None
 
-    async def moveStage(self, identifier: int, position: float) -> bool:
+    async def moveStage(self, identifier: int, position: float, wait: bool = False,
+                        timeout: float | None = None) -> bool:
         """
-        Move the stage to the given position. Returns True if the stage was moved, raises and
-        exception in all other cases.
+        Move the stage to the given position, and watch it until it is on target. Returns True if the stage was
+        moved, raises and exception in all other cases.
         :param identifier: identifier of the stage.
         :param position: position to move to
-        :return: True, or exception.
+        :param wait: return only once the stage is on target
+        :param timeout: seconds to wait at most, raises asyncio.TimeoutError if the stage isn't there by then
+        :return: True, or exception. When waiting, False if the stage was stopped before it got there.
         """
         interface = self.getRelevantInterface(identifier)
         if interface is None:
             raise Exception(f"Stage {identifier} doesn't exist")
 
+        start = self.state.status(identifier)
         await interface.moveTo(identifier, position)
+        await self.expectMove(interface, identifier, None if start is None else position - start.position)
+        if wait:
+            return (await self.supervisor.untilOnTarget([identifier], timeout))[identifier]
 
         # if we're here, no exception was thrown, so it worked.
         return True
 
-    async def stepStage(self, identifier: int, position: float) -> bool:
+    async def stepStage(self, identifier: int, position: float, wait: bool = False,
+                        timeout: float | None = None) -> bool:
         """
-        Move the stage to the given position. Returns True if the stage was moved, raises and
-        exception in all other cases.
+        Move the stage by the given step, and watch it until it is on target. Returns True if the stage was moved,
+        raises and exception in all other cases.
         :param identifier: identifier of the stage.
         :param position: position to move to
-        :return: True, or exception.
+        :param wait: return only once the stage is on target
+        :param timeout: seconds to wait at most, raises asyncio.TimeoutError if the stage isn't there by then
+        :return: True, or exception. When waiting, False if the stage was stopped before it got there.
         """
         interface = self.getRelevantInterface(identifier)
         if interface is None:
             raise Exception(f"Stage {identifier} doesn't exist")
 
         await interface.moveBy( identifier, position)
+        await self.expectMove(interface, identifier, position)
+        if wait:
+            return (await self.supervisor.untilOnTarget([identifier], timeout))[identifier]
 
         # if we're here, no exception was thrown, so it worked.
         return True
 
+    async def moveStages(self, targets: dict[int, float], wait: bool = False,
+                         timeout: float | None = None) -> dict[int, bool | Exception]:
+        """
+        Move several stages at once, and watch them until they are on target. The moves are grouped per controller
+        interface, which sends one command per controller where it can, and all of them are sent at the same time.
+        :param targets: identifier -> position to move to
+        :param wait: return only once the stages are on target
+        :param timeout: seconds to wait at most
+        :return: identifier -> True if the stage took the move, or the exception why it didn't. When waiting, False
+        if the stage was stopped before it got there, asyncio.TimeoutError if it wasn't there in time.
+        """
+        res: dict[int, bool | Exception] = {}
+        grouped: dict[ControllerInterface, dict[int, float]] = {}
+        for identifier, position in targets.items():
+            interface = self.getRelevantInterface(identifier)
+            if interface is None:
+                res[identifier] = Exception(f"Stage {identifier} doesn't exist")
+            else:
+                grouped.setdefault(interface, {})[identifier] = position
+
+        starts = {identifier: self.state.status(identifier) for moves in grouped.values() for identifier in moves}
+        results = await asyncio.gather(*[interface.moveToMany(moves) for interface, moves in grouped.items()],
+                                       return_exceptions=True)
+        moved: list[int] = []
+        for (interface, moves), result in zip(grouped.items(), results):
+            for identifier, position in moves.items():
+                error = result if isinstance(result, Exception) else result.get(identifier)
+                if error is not None:
+                    res[identifier] = error
+                    continue
+                start = starts[identifier]
+                await self.expectMove(interface, identifier, None if start is None else position - start.position)
+                moved.append(identifier)
+                res[identifier] = True
+
+        if wait:
+            # each on its own, so a stage that doesn't make it doesn't hide the ones that did
+            arrivals = await asyncio.gather(*[self.supervisor.untilOnTarget([identifier], timeout)
+                                              for identifier in moved], return_exceptions=True)
+            for identifier, arrival in zip(moved, arrivals):
+                res[identifier] = arrival if isinstance(arrival, Exception) else arrival[identifier]
+        return res
+
+    async def expectMove(self, interface: ControllerInterface, identifier: int, distance: float | None):
+        """
+        Has the supervisor watch a stage which just started moving, telling it how far it's going if we know how fast
+        the stage is, so it knows when to look
+        :param interface: interface of the stage
+        :param identifier: identifier of the stage
+        :param distance: how far it's going, None if we don't know
+        """
+        parameters = None
+        if distance is not None:
+            try:
+                parameters = await interface.motionParameters(identifier)
+            except Exception as e:
+                print(f"No motion parameters for stage {identifier}: {e}")
+        if parameters is None:
+            self.supervisor.watch([identifier])
+        else:
+            self.supervisor.expect(identifier, distance, parameters)
+
+    async def stopStage(self, identifier: int) -> bool:
+        """
+        Stops the stage, and stops watching it since it won't reach its target. Returns True if the stage was told to
+        stop, raises an exception in all other cases.
+        :param identifier: identifier of the stage.
+        :return: True, or exception.
+        """
+        interface = self.getRelevantInterface(identifier)
+        if interface is None:
+            raise Exception(f"Stage {identifier} doesn't exist")
+
+        await interface.stop(identifier)
+        self.supervisor.unwatch([identifier])
+
+        return True
+
     @property
     async def configSchema(self):
         """Returns list of JSON schemas of configuration objects"""
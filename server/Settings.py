@@ -1,12 +1,45 @@
+import copy
+import hashlib
 import json
+import threading
 from pathlib import Path
 import asyncio
+from typing import Any, TypeVar
 
 from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel
+
+try:
+    from watchfiles import awatch
+except ImportError:
+    # no filesystem notifications, the watcher checks the files every so often instead
+    awatch = None
+
+M = TypeVar("M", bound=BaseModel)
 
 
 class SettingsVault:
-    """Object that handles saving/loading JSON-formatted settings on disk"""
+    """
+    Object that handles saving/loading JSON-formatted settings on disk. Each file is parsed once, and only again when
+    its modification time or size changes and its content with it. Use SettingsVault.shared() to share that between
+    everyone reading the same settings. The stores are copies of what was parsed, free to be changed before saving
+    them, the read only stores are shared and must not be changed.
+    """
+
+    _shared: dict[Path, "SettingsVault"] = {}
+    """Absolute settings directory -> the vault everyone reading it shares"""
+
+    @classmethod
+    def shared(cls, dir_path: str = "settings") -> "SettingsVault":
+        """
+        The vault of the given settings directory shared by the whole process
+        :param dir_path: settings directory, relative to the working directory
+        """
+        key = Path(dir_path).resolve()
+        if key not in cls._shared:
+            cls._shared[key] = cls(str(key))
+        return cls._shared[key]
+
     def __init__(self, dir_path: str = "settings"):
 
         self.dir_path: Path = Path(dir_path)
@@ -15,6 +48,16 @@ class SettingsVault:
         """Dictionary of loaded settings python object representation"""
         self._readonly: dict[str, bool] = {}
         """Dictionary of read only settings, stored in the subfolder 'readonly'"""
+        self._files: dict[Path, tuple[tuple[int, int], str, Any]] = {}
+        """path -> ((modification time, size), content hash, parsed content) of the files read so far"""
+        self._catalogs: dict[tuple[str, type], tuple[Any, dict]] = {}
+        """(readonly store, model) -> (parsed content it was made from, typed view), see catalog"""
+        self.loaded: bool = False
+        """Whether load_all has run at least once"""
+        self.watcher: asyncio.Task | None = None
+        """Task reloading the settings when they change, see watch"""
+        self._reading = threading.Lock()
+        """Held while reading files on a worker thread, so two loads don't both update _files"""
         #Ensure the settings directory exists
         self.dir_path.mkdir(exist_ok=True)
 
@@ -51,7 +94,10 @@ class SettingsVault:
         :param value: python object, or string in json format
         """
 
-        with open(Path(f"{self.dir_path}/{name}.json"), "w+") as f:
+        path = Path(f"{self.dir_path}/{name}.json")
+        # don't trust the modification time to tell this write apart from what we read before
+        self._files.pop(path, None)
+        with open(path, "w+") as f:
             if type(value) == str:
                 # if string, write directly
                 f.write(value)
@@ -61,50 +107,136 @@ class SettingsVault:
             f.close() # politely close the file
 
     async def reload_all(self):
-        """Removes all stores and loads them in again from disk"""
+        """Removes all stores and loads them in again from disk, files which didn't change aren't parsed again"""
         self.removeAllStores()
         await self.load_all()
 
     async def load_all(self):
-        """Loads all settings files present on disk"""
-
-        # quick async function for reading
-        async def ld(fl: Path):
-            try:
-                with open(fl) as f:
-                    data = json.load(f)
-                    f.close()
-                self._stores[fl.name[:-5]] = data
-            except Exception as e:
-                print(f"Failed to load {fl}: {e}")
-
-        # i know i don't need to copy the whole thing, but i cannot be bothered to debug it
-        async def ld_readonly(fl: Path):
-            try:
-                with open(fl) as f:
-                    data = json.load(f)
-                    f.close()
-                self._readonly[fl.name[:-5]] = data
-            except Exception as e:
-                print(f"Failed to load {fl}: {e}")
-
-        # Foreach start off the async reading process and then gather
-        awaiters = []
-        for file in self.dir_path.glob("*.json"):
-            awaiters.append(ld(file))
-        # now for readonly settings
-        if self.dir_path.joinpath("readonly").exists():
-            for file in self.dir_path.joinpath("readonly").glob("*.json"):
-                awaiters.append(ld_readonly(file))
+        """Loads all settings files present on disk, parsing only the ones which changed since we last read them"""
+        # the disk is only touched on a worker thread, not to hold up the event loop
+        stores, readonly = await asyncio.to_thread(self._scan)
+        self._stores.update(stores)
+        self._readonly.update(readonly)
+        self.loaded = True
 
-        await asyncio.gather(*awaiters)
+    def _scan(self) -> tuple[dict[str, object], dict[str, object]]:
+        """Reads all settings files, runs on a worker thread. Returns the stores and the read only stores."""
+        with self._reading:
+            stores: dict[str, object] = {}
+            readonly: dict[str, object] = {}
+            seen: set[Path] = set()
+            for file in self.dir_path.glob("*.json"):
+                self._load_into(stores, file, shared=False)
+                seen.add(file)
+            # now for readonly settings
+            if self.dir_path.joinpath("readonly").exists():
+                for file in self.dir_path.joinpath("readonly").glob("*.json"):
+                    self._load_into(readonly, file, shared=True)
+                    seen.add(file)
+
+            # forget files which are gone
+            # a copy of the keys, a save on the event loop may drop one meanwhile
+            for file in [file for file in list(self._files) if file not in seen]:
+                self._files.pop(file, None)
+            return stores, readonly
+
+    def _load_into(self, stores: dict[str, object], fl: Path, shared: bool):
+        try:
+            stores[fl.name[:-5]] = self._read(fl, shared)
+        except Exception as e:
+            print(f"Failed to load {fl}: {e}")
+
+    def _read(self, fl: Path, shared: bool = False) -> Any:
+        """
+        Parsed content of the file, from what we read before if it didn't change
+        :param shared: hand out what we keep rather than a copy, only for content nobody changes
+        """
+        data = self._parsed(fl)
+        return data if shared else copy.deepcopy(data)
+
+    def _parsed(self, fl: Path) -> Any:
+        """What we keep of the file, parsed again only if it changed"""
+        stat = fl.stat()
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        known = self._files.get(fl)
+        if known is not None and known[0] == stamp:
+            return known[2]
+
+        raw = fl.read_bytes()
+        digest = hashlib.sha1(raw).hexdigest()
+        if known is not None and known[1] == digest:
+            # touched, but the same
+            self._files[fl] = (stamp, digest, known[2])
+            return known[2]
+
+        data = json.loads(raw)
+        self._files[fl] = (stamp, digest, data)
+        return data
+
+    async def ensureLoaded(self):
+        """Loads the settings if they never were, otherwise does nothing, not even look at the disk"""
+        if not self.loaded:
+            await self.load_all()
+
+    def catalog(self, name: str, model: type[M], key: str | None = None) -> dict[str, M]:
+        """
+        A read only settings file of entries by name, i.e. PIStages, as validated models. Made once per version of the
+        file and shared, so don't modify it.
+        :param name: name of the read only store
+        :param model: model of each entry
+        :param key: field of the model to put the name of the entry in, if it has one
+        :raises KeyError: if the store isn't loaded
+        """
+        data = self._readonly[name]
+        made = self._catalogs.get((name, model))
+        if made is not None and made[0] is data:
+            return made[1]
+
+        view = {}
+        for entry, value in dict(data).items():
+            view[entry] = model.model_validate(value if key is None else {**value, key: entry})
+        self._catalogs[(name, model)] = (data, view)
+        return view
+
+    def watch(self, interval: float = 2):
+        """
+        Keep the settings up to date in the background, through filesystem notifications if watchfiles is installed
+        (see requirements.txt), otherwise by checking the files every interval seconds
+        :param interval: seconds between checks without notifications
+        """
+        if self.watcher is not None and not self.watcher.done():
+            return
+
+        async def run():
+            await self.load_all()
+            if awatch is not None:
+                async for _ in awatch(self.dir_path, recursive=True):
+                    await self.load_all()
+            while True:
+                await asyncio.sleep(interval)
+                await self.load_all()
+
+        self.watcher = asyncio.get_running_loop().create_task(run())
+
+    async def unwatch(self):
+        if self.watcher is None:
+            return
+        self.watcher.cancel()
+        try:
+            await self.watcher
+        except asyncio.CancelledError:
+            pass
+        self.watcher = None
 
     async def load(self, name: str):
         """Loads given settings from disk"""
         if self.dir_path.glob(f"{name}.json"):
-            with open(Path(f"{self.dir_path}/{name}.json")) as f:
-                self._stores[name] = json.load(f)
-                f.close()
+            path = Path(f"{self.dir_path}/{name}.json")
+
+            def read():
+                with self._reading:
+                    return self._read(path)
+            self._stores[name] = await asyncio.to_thread(read)
         else:
             raise FileNotFoundError(f"{name} settings not on disk")
 
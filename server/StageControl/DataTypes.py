@@ -1,7 +1,12 @@
 from __future__ import annotations
 
+import asyncio
+import copy
 import glob
+import inspect
+import math
 import sys
+import weakref
 from enum import Enum
 from typing import Any, Callable
 
@@ -57,6 +62,13 @@ class StageStatus(BaseModel):
     position: float = Field(default=0.0, description="Position of the stage in mm.")
     ontarget: bool = Field(default=False, description="Whether the stage is on target.")
 
+class MotionParameters(BaseModel):
+    """How fast a stage moves, used to estimate how long a move will take"""
+    velocity: float = Field(gt=0, description="Velocity in mm/s.")
+    acceleration: float = Field(gt=0, description="Acceleration in mm/s².")
+    deceleration: float | None = Field(default=None, gt=0, description="Deceleration in mm/s², same as the "
+                                                                          "acceleration if not given.")
+
 class StageRemoved(BaseModel):
     """Indicates that the stage has been removed."""
     identifier: int = Field(description='Unique identifier for the stage')
@@ -102,6 +114,26 @@ class ControllerInterface:
         """Move stage by offset"""
         raise NotImplementedError
 
+    async def moveToMany(self, targets: dict[int, float]) -> dict[int, Exception | None]:
+        """
+        Move several stages at once. Interfaces that can send one command for several stages should override this, by
+        default each stage is sent its move on its own, all at the same time.
+        :param targets: identifier -> position to move to
+        :return: identifier -> None if it took the move, or the exception why it didn't
+        """
+        results = await asyncio.gather(*[self.moveTo(identifier, position) for identifier, position in targets.items()],
+                                       return_exceptions=True)
+        return {identifier: result if isinstance(result, Exception) else None
+                for identifier, result in zip(targets.keys(), results)}
+
+    async def stop(self, identifier: int):
+        """Stop the stage, wherever it is"""
+        raise NotImplementedError
+
+    async def motionParameters(self, identifier: int) -> MotionParameters | None:
+        """Velocity and acceleration of the stage, None if we don't know them"""
+        return None
+
     @property
     def stageInfo(self) -> dict[int, StageInfo]:
         """Returns StageInfo of connected stages"""
@@ -208,6 +240,35 @@ def getComPorts() -> list[int]:
 
 
 
+def eventKey(event: Any) -> int | None:
+    """
+    Returns the key an event is filed under: the stage identifier for StageStatus, StageInfo etc., or the
+    controller SN for ConfigurationUpdate. Events carrying neither are filed under None.
+    """
+    key = getattr(event, "identifier", None)
+    if key is None:
+        key = getattr(event, "SN", None)
+    return key
+
+
+def forwardingTarget(destination: Callable[[Any], None]) -> EventAnnouncer | None:
+    """Returns the EventAnnouncer if the destination is its event function, i.e. it only forwards events"""
+    target = getattr(destination, "__self__", None)
+    if isinstance(target, EventAnnouncer) and getattr(destination, "__func__", None) is EventAnnouncer.event:
+        return target
+    return None
+
+
+class DeliveryPolicy(str, Enum):
+    """How an EventQueue handles new events of a data type"""
+    drop = "drop"
+    """Drop the oldest queued event to make room"""
+    block = "block"
+    """EventAnnouncer.publish waits until there is room. Plain EventAnnouncer.event cannot wait, and drops instead"""
+    conflate = "conflate"
+    """Only the newest queued event per type and key is kept, when full the oldest event is dropped"""
+
+
 class Subscription:
 
     def __init__(self, ea: EventAnnouncer, datatypes: list[type]):
@@ -215,46 +276,278 @@ class Subscription:
         """EventAnnouncer we are subscribed to"""
         self.datatypes = datatypes
         """Supported datatypes"""
-        self.deliveries: dict[type, list[Callable[[Any], None]]] = {}
-        """Dict of data type -> list of callables"""
+        self.deliveries: dict[type, dict[int | None, list[Callable[[Any], None]]]] = {}
+        """Dict of data type -> key -> list of callables. Callables under the None key receive every event"""
+        self.queue: EventQueue | None = None
+        """If set, events are delivered asynchronously through this queue, see queued()"""
 
-    def deliverTo(self, datatype:type, destination: Callable[[Any], None]):
+    def deliverTo(self, datatype: type, destination: Callable[[Any], None], key: int | None = None):
         """
         Tell the subscription where to deliver received data
         :param datatype: Which datatype we want to receive
         :param destination: Function to call with the data
+        :param key: Only deliver events with this key (see eventKey), i.e. a single stage identifier. None for all.
         :return: None
         """
         # Check that we serve this datatype
-        if not self.datatypes.__contains__(datatype):
+        if datatype not in self.datatypes:
             raise Exception(f"Data type {datatype} is not delivered here")
 
-        # Check if this key has been initialized, otherwise give it an empty list
-        if self.deliveries.get(datatype) is None:
-            self.deliveries[datatype] = []
+        destinations = self.deliveries.setdefault(datatype, {}).setdefault(key, [])
 
         # Check if already registered
-        if self.deliveries.get(datatype).__contains__(destination):
+        if destination in destinations:
             print(f"delivery of {datatype} to {destination} is already registered")
             return
 
-        # Register for deliveries
-        self.deliveries[datatype].append(destination)
+        # Register for deliveries, the announcer has to rebuild its dispatch table
+        destinations.append(destination)
+        self.announcer.invalidate()
 
-    def event(self, event: Any):
-        """Calls relevant functions on receiving event"""
+    def destinations(self, event: Any) -> list[Callable[[Any], None]]:
+        """Returns the functions this event is delivered to"""
+        keyed = self.deliveries.get(type(event))
+        if keyed is None:
+            return []
 
-        # Check if delivery array exists or is empty
-        if self.deliveries.get(type(event)) is None or len(self.deliveries.get(type(event))) == 0:
-            print(f"No function is currently receiving {type(event)}")
-            return
+        res = list(keyed.get(None, ()))
+        key = eventKey(event)
+        if key is not None:
+            res.extend(keyed.get(key, ()))
+        return res
 
-        # Deliver the package
-        for func in self.deliveries.get(type(event)):
+    def event(self, event: Any):
+        """Calls relevant functions on receiving event. The EventAnnouncer dispatches through its own table,
+        this is for delivering to a single subscription directly."""
+        for func in self.destinations(event):
             func(event)
 
+    def queued(self, maxsize: int = 256, policies: dict[type, DeliveryPolicy] = None,
+               default: DeliveryPolicy = DeliveryPolicy.drop) -> EventQueue:
+        """
+        Switch this subscription to asynchronous delivery. The announcer only puts events into a bounded queue,
+        which a worker task drains into the destinations. Destinations may then also be coroutine functions.
+        :param maxsize: How many events may wait in the queue
+        :param policies: DeliveryPolicy per data type, for when the queue is full
+        :param default: DeliveryPolicy for data types not in policies
+        :return: the EventQueue
+        """
+        if self.queue is None:
+            self.queue = EventQueue(self, maxsize, policies, default)
+            self.announcer.invalidate()
+        return self.queue
+
     def unsubscribe(self):
         self.announcer.unsubscribe(self)
+        if self.queue is not None:
+            self.queue.close()
+
+
+class EventQueue:
+    """
+    Bounded queue sitting between an EventAnnouncer and a Subscription. Producers never wait on the consumer, a
+    worker task delivers the queued events in order, awaiting coroutine destinations. The queue and worker live on
+    the event loop events are put in, and move over to a new one if that changes.
+    """
+
+    def __init__(self, sub: Subscription, maxsize: int = 256, policies: dict[type, DeliveryPolicy] = None,
+                 default: DeliveryPolicy = DeliveryPolicy.drop):
+        self.subscription = sub
+        """Subscription we deliver to"""
+        self.policies: dict[type, DeliveryPolicy] = {} if policies is None else policies
+        """DeliveryPolicy per data type"""
+        self.default = default
+        """DeliveryPolicy for data types not in policies"""
+        self.maxsize = maxsize
+        self.queue: asyncio.Queue[list] | None = None
+        """Queued [event, conflation slot] pairs. The event is swapped out in place when conflated. Made with the
+        first event, see _ready"""
+        self.loop: asyncio.AbstractEventLoop | None = None
+        """Event loop the queue and worker belong to"""
+        self._slots: dict[tuple[type, int | None], list] = {}
+        """Queued entries of conflating data types, by (type, key)"""
+        self.worker: asyncio.Task | None = None
+        """Task draining the queue, started with the first event inside a running event loop"""
+        self.dropped: int = 0
+        """Amount of events dropped because the queue was full"""
+
+    def put(self, event: Any):
+        """Queue an event without waiting, applying the DeliveryPolicy if the queue is full"""
+        entry = self._entry(event)
+        if entry is None:
+            # conflated into an event that is already queued
+            return
+
+        queue = self._ready()
+        if queue.full():
+            self._drop_oldest()
+        queue.put_nowait(entry)
+        if entry[1] is not None:
+            self._slots[entry[1]] = entry
+
+    async def put_wait(self, event: Any):
+        """Queue an event, waiting for room if its DeliveryPolicy is block"""
+        if self.policies.get(type(event), self.default) is not DeliveryPolicy.block:
+            self.put(event)
+            return
+
+        entry = self._entry(event)
+        await self._ready().put(entry)
+
+    def _entry(self, event: Any) -> list | None:
+        """Makes a queue entry for the event, or conflates it into a queued one and returns None"""
+        slot = None
+        if self.policies.get(type(event), self.default) is DeliveryPolicy.conflate:
+            slot = (type(event), eventKey(event))
+            queued = self._slots.get(slot)
+            if queued is not None:
+                queued[0] = event
+                return None
+        return [event, slot]
+
+    def _drop_oldest(self):
+        event, slot = self.queue.get_nowait()
+        if slot is not None:
+            self._slots.pop(slot, None)
+        self.dropped += 1
+
+    def _ready(self) -> asyncio.Queue[list]:
+        """The queue, belonging to the running event loop if there is one, with a worker draining it"""
+        if self.queue is None:
+            self.queue = asyncio.Queue(self.maxsize)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop running, the worker is started by the next event put in one.
+            return self.queue
+
+        if self.loop is not loop:
+            if self.loop is not None:
+                # The loop we ran on was replaced, a queue and worker of its own can't be used from this one.
+                # Carry over what's queued.
+                queued = []
+                while not self.queue.empty():
+                    queued.append(self.queue.get_nowait())
+                self.queue = asyncio.Queue(self.maxsize)
+                for entry in queued:
+                    self.queue.put_nowait(entry)
+                self.close()
+            self.loop = loop
+        if self.worker is None or self.worker.done():
+            self.worker = loop.create_task(self._drain(self.queue))
+        return self.queue
+
+    async def _drain(self, queue: asyncio.Queue[list]):
+        while True:
+            entry = await queue.get()
+            if entry[1] is not None:
+                self._slots.pop(entry[1], None)
+            event = entry[0]
+
+            for func in self.subscription.destinations(event):
+                try:
+                    res = func(event)
+                    if inspect.isawaitable(res):
+                        await res
+                except Exception as e:
+                    # Don't let one bad delivery kill the worker
+                    print(f"Failed delivering {type(event)} from {self.subscription.announcer.host} to {func}: {e}")
+
+    def close(self):
+        """Stops the worker, queued events stay until the next event starts another one"""
+        if self.worker is not None:
+            try:
+                self.worker.cancel()
+            except RuntimeError:
+                # its event loop is closed, it will never run again anyway
+                pass
+            self.worker = None
+
+class Conflator:
+    """
+    Event pipeline stage that passes on at most one event per type and key per window, i.e. one StageStatus per
+    stage per window. The first event after a quiet window is passed on right away, the ones following it within the
+    window are held and only the newest is passed on when it closes. Events identical to the last one passed on are
+    dropped. Use it as a destination, it delivers to another destination (usually an EventAnnouncer's event
+    function).
+    """
+
+    def __init__(self, destination: Callable[[Any], None], window: float = 0.05, datatypes: list[type] = None):
+        """
+        :param destination: where to deliver the conflated events
+        :param window: seconds to hold events for. If zero, or there is no event loop, only duplicates are dropped.
+        :param datatypes: data types to conflate, others are passed on immediately. Defaults to StageStatus, StageInfo
+        """
+        self.destination = destination
+        self.window = window
+        self.datatypes: list[type] = [StageStatus, StageInfo] if datatypes is None else datatypes
+        self._pending: dict[tuple[type, int | None], Any] = {}
+        """Newest event per (type, key) waiting for the window to close"""
+        self._last: dict[tuple[type, int | None], Any] = {}
+        """Copy of the last event passed on per (type, key), for dropping duplicates"""
+        self._opened: dict[tuple[type, int | None], float] = {}
+        """Loop time the window of each (type, key) last opened, i.e. something was passed on"""
+        self._flush_handle: asyncio.TimerHandle | None = None
+
+    def __call__(self, event: Any):
+        if type(event) not in self.datatypes:
+            if isinstance(event, StageRemoved):
+                # the stage is gone, don't send anything stale after the removal
+                self.forget(event.identifier)
+            self.destination(event)
+            return
+
+        slot = (type(event), eventKey(event))
+        if slot not in self._pending and self._last.get(slot) == event:
+            # nothing changed
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if self.window <= 0 or loop is None:
+            # nothing to wait for, or no event loop to wait in
+            self._pending[slot] = event
+            self.flush()
+            return
+
+        now = loop.time()
+        if slot not in self._pending and now - self._opened.get(slot, -math.inf) >= self.window:
+            # quiet for a window, so it goes out right away and whatever follows waits for the window to close
+            self._opened[slot] = now
+            self._pass(slot, event)
+            return
+        self._pending[slot] = event
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.window, self.flush)
+
+    def flush(self):
+        """Pass on everything pending right now"""
+        self._flush_handle = None
+        pending = self._pending
+        self._pending = {}
+        try:
+            now = asyncio.get_running_loop().time()
+        except RuntimeError:
+            now = None
+        for slot, event in pending.items():
+            if self._last.get(slot) == event:
+                continue
+            if now is not None:
+                self._opened[slot] = now
+            self._pass(slot, event)
+
+    def _pass(self, slot: tuple[type, int | None], event: Any):
+        # copy, since some producers mutate and re-send the same object
+        self._last[slot] = copy.copy(event)
+        self.destination(event)
+
+    def forget(self, key: int):
+        """Drop pending and remembered events with the given key"""
+        for slots in (self._pending, self._last, self._opened):
+            for slot in [slot for slot in slots.keys() if slot[1] == key]:
+                del slots[slot]
+
 
 class EventAnnouncer:
     def __init__(self, host: type|str,  *availableDataTypes: type):
@@ -262,29 +555,132 @@ class EventAnnouncer:
         """Information about the object hosting this EventAnnouncer, can be a type or a string. Useful for debugging"""
         self.subs: list[Subscription] = []
         self.availableDataTypes: list[type] = list(availableDataTypes)
+        self._dispatch: dict[type, dict[int | None, list[Callable[[Any], None]]]] | None = None
+        """Dispatch table of data type -> key -> destinations, rebuilt lazily after subscriptions change"""
+        self._feeders: weakref.WeakSet[EventAnnouncer] = weakref.WeakSet()
+        """EventAnnouncers whose compiled routes go through this one, and must be rebuilt when ours change"""
 
     def subscribe(self, *datatypes: type) -> Subscription:
         """Subscribe to events, pass in the data type you want to get"""
 
         # Check that we have the requested data types
         for datatype in datatypes:
-            if not self.availableDataTypes.__contains__(datatype):
+            if datatype not in self.availableDataTypes:
                 raise Exception(f"Data type {datatype} is not served here")
 
         # All good, add the subscription
         sub = Subscription(self, list(datatypes))
         self.subs.append(sub)
+        self.invalidate()
         return sub
 
+    def invalidate(self):
+        """Marks the dispatch table as stale, along with every route compiled through it"""
+        if self._dispatch is None:
+            # Already stale, so is everything feeding into us
+            return
+        self._dispatch = None
+        for feeder in list(self._feeders):
+            feeder.invalidate()
+
+    def compile(self, visiting: set[EventAnnouncer] = None) -> dict[type, dict[int | None, list[Callable[[Any], None]]]]:
+        """
+        Builds the dispatch table from the current subscriptions. Deliveries into another EventAnnouncer (i.e. set
+        up by patch_through_from) are replaced by that announcer's own destinations, so an event reaches the final
+        subscribers directly instead of re-running dispatch at every hop.
+        :param visiting: announcers currently being compiled further up the chain, used to break cycles
+        """
+        if visiting is None:
+            visiting = set()
+        visiting.add(self)
+
+        dispatch: dict[type, dict[int | None, list[Callable[[Any], None]]]] = {}
+        for sub in self.subs:
+            if sub.queue is not None:
+                # The queue worker sorts out the destinations, we only need to route each event into it once
+                for datatype, keyed in sub.deliveries.items():
+                    for key in ([None] if None in keyed else keyed.keys()):
+                        dispatch.setdefault(datatype, {}).setdefault(key, []).append(sub.queue.put)
+                continue
+
+            for datatype, keyed in sub.deliveries.items():
+                for key, destinations in keyed.items():
+                    for destination in destinations:
+                        self._route(dispatch, datatype, key, destination, visiting)
+
+        visiting.discard(self)
+        self._dispatch = dispatch
+        return dispatch
+
+    def _route(self, dispatch: dict, datatype: type, key: int | None, destination: Callable[[Any], None],
+               visiting: set[EventAnnouncer]):
+        """Adds a destination to the dispatch table, flattening it if it only forwards into another announcer"""
+        target = forwardingTarget(destination)
+        if target is None or target in visiting:
+            # Regular destination, or a forwarding loop we cannot flatten
+            dispatch.setdefault(datatype, {}).setdefault(key, []).append(destination)
+            return
+
+        # Rebuild our routes whenever the target's subscriptions change
+        target._feeders.add(self)
+        downstream = target._dispatch
+        if downstream is None:
+            downstream = target.compile(visiting)
+
+        for downstream_key, downstream_destinations in downstream.get(datatype, {}).items():
+            if key is None:
+                # We forward everything, so the downstream key filters apply unchanged
+                dispatch.setdefault(datatype, {}).setdefault(downstream_key, []).extend(downstream_destinations)
+            elif downstream_key is None or downstream_key == key:
+                # We only forward a single key, which the downstream destination accepts
+                dispatch.setdefault(datatype, {}).setdefault(key, []).extend(downstream_destinations)
+
     def event(self, event: Any):
         """Receive an event, send it to relevant subscribers"""
         #print(f"event at {self.host}", event) useful for debug
-        for sub in self.subs:
-            if sub.datatypes.__contains__(type(event)):
-                sub.event(event)
+        dispatch = self._dispatch
+        if dispatch is None:
+            dispatch = self.compile()
+
+        keyed = dispatch.get(type(event))
+        if keyed is None:
+            # Nobody is listening
+            return
+
+        for func in keyed.get(None, ()):
+            func(event)
+        # Only look up the key if someone asked for a specific one
+        if len(keyed) > 1 or None not in keyed:
+            key = eventKey(event)
+            if key is not None:
+                for func in keyed.get(key, ()):
+                    func(event)
+
+    async def publish(self, event: Any):
+        """Like event, but waits for room in queued subscriptions whose DeliveryPolicy for this event is block"""
+        dispatch = self._dispatch
+        if dispatch is None:
+            dispatch = self.compile()
+
+        keyed = dispatch.get(type(event))
+        if keyed is None:
+            return
+
+        destinations = list(keyed.get(None, ()))
+        key = eventKey(event)
+        if key is not None:
+            destinations.extend(keyed.get(key, ()))
+
+        for func in destinations:
+            queue = getattr(func, "__self__", None)
+            if isinstance(queue, EventQueue):
+                await queue.put_wait(event)
+            else:
+                func(event)
 
     def unsubscribe(self, sub: Subscription):
         self.subs.remove(sub)
+        self.invalidate()
 
     def patch_through_from(self, datatypes: list[type], target: EventAnnouncer):
         """
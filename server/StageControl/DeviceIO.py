@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Hashable
+
+
+class DeviceWorker:
+    """
+    A single thread owning the blocking calls to one physical device. Calls are queued and run one after the other,
+    so the device only ever sees one exchange at a time, while the event loop, and other devices with their own
+    worker, carry on in the meantime.
+    """
+
+    def __init__(self, name: str):
+        """
+        :param name: name of the device, shows up in the thread name
+        """
+        self.name = name
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"device-{name}")
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        """
+        Queue a blocking call on the device's thread and wait for its result, exceptions are raised here
+        :param func: the blocking function, i.e. a GCS command
+        :return: whatever it returns
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor,
+                                                                functools.partial(func, *args, **kwargs))
+
+    def shutdown(self, last: Callable | None = None):
+        """
+        Stop the thread once the calls already queued are done, without waiting for them
+        :param last: call to run after those, i.e. closing the connection
+        """
+        if last is not None:
+            self.executor.submit(last)
+        self.executor.shutdown(wait=False)
+
+
+class DevicePool:
+    """
+    A bounded pool of threads shared by many devices, for libraries which are happy to be called from any thread but
+    not about the same device from two at once. Calls to one device wait for each other on its lock, calls to
+    different devices run side by side, as many at a time as there are threads.
+    """
+
+    def __init__(self, name: str, workers: int = 8):
+        """
+        :param name: name of the devices, shows up in the thread names
+        :param workers: most calls running at the same time
+        """
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"devices-{name}")
+        self.locks: dict[Hashable, asyncio.Lock] = {}
+
+    def lock(self, device: Hashable) -> asyncio.Lock:
+        """Lock held while a call to the device runs"""
+        if device not in self.locks:
+            self.locks[device] = asyncio.Lock()
+        return self.locks[device]
+
+    async def run(self, device: Hashable, func: Callable, *args, **kwargs) -> Any:
+        """
+        Run a blocking call to the device on the pool once nothing else is talking to it, and wait for its result
+        :param device: key of the device, i.e. its serial number
+        :param func: the blocking function
+        :return: whatever it returns
+        """
+        async with self.lock(device):
+            future = asyncio.ensure_future(self.call(func, *args, **kwargs))
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # the thread can't be cancelled, keep the device to ourselves until it's done with it
+                await asyncio.wait({future})
+                raise
+
+    async def call(self, func: Callable, *args, **kwargs) -> Any:
+        """Run a blocking call which isn't about any one device on the pool, i.e. enumerating devices"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor,
+                                                                functools.partial(func, *args, **kwargs))
+
+    def forget(self, device: Hashable):
+        """Drop the lock of a device which is gone"""
+        self.locks.pop(device, None)
+
+    def shutdown(self):
+        """Stop the threads once the calls already queued are done, without waiting for them"""
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,367 @@
+from __future__ import annotations
+
+import asyncio
+import math
+
+from server.StageControl.DataTypes import ControllerInterface, MotionParameters, EventAnnouncer, Notice
+from server.StageControl.Registry import StageRegistry
+
+
+class MoveEstimator:
+    """
+    Predicts how long a move takes from a trapezoidal velocity profile, accelerate, cruise, decelerate, and learns a
+    correction per stage from how long its moves actually took. The correction takes care of settling time, servo
+    lag and whatever else the profile doesn't know about.
+    """
+
+    def __init__(self, smoothing: float = 0.3, limits: tuple[float, float] = (0.5, 3)):
+        """
+        :param smoothing: weight of a new observation in the correction, exponential moving average
+        :param limits: bounds of the correction, so one odd move can't throw the predictions off completely
+        """
+        self.smoothing = smoothing
+        self.limits = limits
+        self.corrections: dict[int, float] = {}
+        """Identifier -> observed / profile duration"""
+
+    @staticmethod
+    def profileDuration(distance: float, parameters: MotionParameters) -> float:
+        """
+        Duration of a move over the distance with a trapezoidal velocity profile, or a triangular one if the stage
+        never gets up to speed
+        :param distance: how far the stage goes
+        :param parameters: velocity and acceleration of the stage
+        :return: seconds
+        """
+        distance = abs(distance)
+        v = parameters.velocity
+        a = parameters.acceleration
+        d = parameters.deceleration or a
+        # distance covered getting up to speed and back down again
+        ramps = v * v / (2 * a) + v * v / (2 * d)
+        if distance >= ramps:
+            return v / a + v / d + (distance - ramps) / v
+        peak = math.sqrt(2 * distance * a * d / (a + d))
+        return peak / a + peak / d
+
+    def predict(self, identifier: int, distance: float, parameters: MotionParameters) -> tuple[float, float]:
+        """
+        :return: the profile duration, and the prediction corrected by what we learned about the stage
+        """
+        profile = self.profileDuration(distance, parameters)
+        return profile, profile * self.corrections.get(identifier, 1)
+
+    def learn(self, identifier: int, profile: float, observed: float, upperBound: bool = False):
+        """
+        Update the stage's correction with how long a move took
+        :param identifier: identifier of the stage
+        :param profile: profile duration of the move
+        :param observed: how long it took until we saw it on target
+        :param upperBound: if the stage was already on target the first time we looked, it might have been there a
+        while, so the observation only tells us it can't take longer
+        """
+        if profile <= 0:
+            return
+        current = self.corrections.get(identifier, 1)
+        ratio = min(max(observed / profile, self.limits[0]), self.limits[1])
+        if upperBound and ratio >= current:
+            return
+        self.corrections[identifier] = current + self.smoothing * (ratio - current)
+
+
+class ExpectedMove:
+    """A move we know roughly how long it should take"""
+
+    def __init__(self, started: float, profile: float, due: float):
+        self.started = started
+        """Loop time the move started"""
+        self.profile = profile
+        """Profile duration, before any correction"""
+        self.due = due
+        """Loop time we expect the stage on target"""
+        self.polled = False
+        """Whether we've seen the stage still moving"""
+
+
+class MotionSupervisor:
+    """
+    Watches moving stages until they are on target, so their status updates reach everyone listening. A single
+    long-lived task polls each controller interface once per tick for all of its due stages, however many moves
+    asked for them to be watched. Anyone who needs to know when a stage arrives can wait for it with untilOnTarget,
+    which is resolved by the same polling.
+
+    Stages we know the move of (see expect) aren't polled at a fixed interval, but once in a while until shortly
+    before they're predicted to arrive, then densely until they do. A stage still not there a while after it should
+    have been is polled less and less often again, back to the regular interval.
+    """
+
+    def __init__(self, interfaces: list[ControllerInterface], interval: float = 0.2, dense: float = 0.05,
+                 lead: float = 0.1, progress: float | None = 1, grace: float = 0.5,
+                 registry: StageRegistry | None = None, EA: EventAnnouncer | None = None):
+        """
+        :param interfaces: controller interfaces of the stages to watch, the list may grow later on
+        :param interval: seconds between polls of stages without a predicted arrival
+        :param dense: seconds between polls of stages around their predicted arrival
+        :param lead: seconds before the predicted arrival to start polling densely
+        :param progress: seconds between polls of a stage on a long move, so the position shown still moves along,
+        None to not poll at all until it's about to arrive
+        :param grace: seconds past the predicted arrival to keep polling densely, after that the time between polls
+        grows with how late the stage is, up to interval
+        :param registry: where to look up the interface of a stage, the interfaces are asked for their stages only
+        about the ones it doesn't know
+        :param EA: where to announce the stages we gave up on watching
+        """
+        self.interfaces = interfaces
+        self.registry = registry
+        self.EA = EA
+        self.interval = interval
+        self.dense = dense
+        self.lead = lead
+        self.progress = progress
+        self.grace = grace
+        self.estimator = MoveEstimator()
+        self.watched: set[int] = set()
+        """Identifiers of stages we poll until they are on target"""
+        self.nextPoll: dict[int, float] = {}
+        """Identifier -> loop time the stage is due to be polled"""
+        self.expected: dict[int, ExpectedMove] = {}
+        """Identifier -> the move it's on, for stages we have a prediction for"""
+        self.arrivals: dict[int, asyncio.Future[bool]] = {}
+        """
+        Identifier -> future resolved once we stop watching the stage, True if it got on target. Only exists for
+        stages someone is waiting on.
+        """
+        self.task: asyncio.Task | None = None
+        self._wake: asyncio.Event | None = None
+
+    def watch(self, identifiers: list[int]):
+        """
+        Poll the given stages until they are on target. Watching a stage which is already watched does nothing.
+        Starts the supervisor if it isn't running yet.
+        :param identifiers: identifiers of the stages
+        """
+        self.start()
+        now = asyncio.get_running_loop().time()
+        for identifier in identifiers:
+            if identifier not in self.watched:
+                self.watched.add(identifier)
+                self.nextPoll[identifier] = now + self.interval
+        if len(self.watched) > 0:
+            self._wake.set()
+
+    def expect(self, identifier: int, distance: float, parameters: MotionParameters):
+        """
+        Watch a stage which just started a move, polling it around the time it should arrive rather than all the way
+        :param identifier: identifier of the stage
+        :param distance: how far it is going
+        :param parameters: velocity and acceleration of the stage
+        """
+        self.start()
+        now = asyncio.get_running_loop().time()
+        profile, predicted = self.estimator.predict(identifier, distance, parameters)
+        self.expected[identifier] = ExpectedMove(now, profile, now + predicted)
+        self.watched.add(identifier)
+        self.nextPoll[identifier] = self.schedule(identifier, now)
+        self._wake.set()
+
+    def schedule(self, identifier: int, now: float) -> float:
+        """Loop time to poll the stage next"""
+        move = self.expected.get(identifier)
+        if move is None:
+            return now + self.interval
+        if now >= move.due - self.lead:
+            # past the grace, wait about as long as it's been late, which doubles the time between polls every poll
+            late = now - move.due - self.grace
+            return now + min(max(self.dense, late), max(self.dense, self.interval))
+        if self.progress is None:
+            return move.due - self.lead
+        return min(move.due - self.lead, now + self.progress)
+
+    def unwatch(self, identifiers: list[int]):
+        """
+        Stop watching the given stages, i.e. when they were stopped and will never reach their target. Anyone waiting
+        on them is told they didn't get there.
+        :param identifiers: identifiers of the stages
+        """
+        self.forget(identifiers, ontarget=False)
+
+    async def untilOnTarget(self, identifiers: list[int], timeout: float | None = None) -> dict[int, bool]:
+        """
+        Waits for the stages to be on target, watching them if they aren't watched already. Doesn't poll anything
+        itself, the supervisor's regular polling resolves the wait.
+        :param identifiers: identifiers of the stages
+        :param timeout: seconds to wait at most, None to wait as long as it takes
+        :return: identifier -> True if it got on target, False if it was unwatched first, i.e. because it was stopped
+        :raises asyncio.TimeoutError: if they didn't all finish in time
+        :raises Exception: if a stage disappeared, or its interface failed to tell us its status
+        """
+        futures = {identifier: self.arrival(identifier) for identifier in identifiers}
+        self.watch(identifiers)
+        # shielded, so a waiter timing out doesn't cancel the future for everyone else waiting on the stage
+        results = await asyncio.wait_for(asyncio.gather(*[asyncio.shield(f) for f in futures.values()]), timeout)
+        return dict(zip(futures.keys(), results))
+
+    def arrival(self, identifier: int) -> asyncio.Future[bool]:
+        """Future resolved when we stop watching the stage, shared by everyone waiting on it"""
+        future = self.arrivals.get(identifier)
+        if future is None or future.done():
+            future = asyncio.get_running_loop().create_future()
+            # everyone waiting on it might have timed out and left, the error is theirs to miss then
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+            self.arrivals[identifier] = future
+        return future
+
+    def forget(self, identifiers, ontarget: bool = True, error: Exception | None = None):
+        """
+        Stop watching the stages and resolve their futures
+        :param identifiers: identifiers of the stages
+        :param ontarget: whether they got on target
+        :param error: why we can't tell, instead
+        """
+        for identifier in list(identifiers):
+            self.watched.discard(identifier)
+            self.nextPoll.pop(identifier, None)
+            self.expected.pop(identifier, None)
+            future = self.arrivals.pop(identifier, None)
+            if future is None or future.done():
+                continue
+            if error is None:
+                future.set_result(ontarget)
+            else:
+                future.set_exception(error)
+
+    def start(self):
+        """Start the supervisor task on the running event loop, if it isn't running already"""
+        if self.task is not None and not self.task.done():
+            return
+        self._wake = asyncio.Event()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        """Cancel the supervisor task and forget about all watched stages, cancelling anyone waiting on them"""
+        self.watched.clear()
+        self.nextPoll.clear()
+        self.expected.clear()
+        for future in self.arrivals.values():
+            future.cancel()
+        self.arrivals.clear()
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    async def run(self):
+        """Supervisor task, sleeps until the next stage is due, or while nothing is watched"""
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wake.clear()
+            if len(self.watched) == 0:
+                await self._wake.wait()
+                continue
+            delay = min(self.nextPoll.get(identifier, 0) for identifier in self.watched) - loop.time()
+            if delay > 0:
+                try:
+                    # a new watch might be due sooner
+                    await asyncio.wait_for(self._wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self.tick()
+            except Exception as e:
+                # don't leave anyone waiting on a supervisor that's gone, nor take it down for the next watch.
+                # Waiters get the error without its traceback, which holds this task's frame, and clearing that
+                # (i.e. traceback.clear_frames) would close it.
+                self.giveUp(list(self.watched), e.with_traceback(None))
+
+    def locate(self, identifiers) -> tuple[dict[ControllerInterface, list[int]], dict[int, Exception]]:
+        """
+        Sorts the stages by the interface they belong to
+        :return: interface -> identifiers, and identifier -> why not for the stages we can't place
+        """
+        located: dict[ControllerInterface, list[int]] = {}
+        errors: dict[int, Exception] = {}
+        stages: list[tuple[ControllerInterface, set[int]]] | None = None
+        for identifier in identifiers:
+            try:
+                route = None if self.registry is None else self.registry.lookup(identifier)
+            except Exception as e:
+                errors[identifier] = e
+                continue
+            if route is not None and route.interface in self.interfaces:
+                located.setdefault(route.interface, []).append(identifier)
+                continue
+
+            # not announced (yet), ask around, once per tick at most
+            if stages is None:
+                stages = [(intf, set(intf.stages)) for intf in self.interfaces]
+            intf = next((intf for intf, known in stages if identifier in known), None)
+            if intf is None:
+                errors[identifier] = Exception(f"Stage {identifier} doesn't exist")
+            else:
+                located.setdefault(intf, []).append(identifier)
+        return located, errors
+
+    async def tick(self):
+        """
+        Poll every interface once for all of its due stages, then forget the ones on target or gone and schedule
+        the next poll of the rest
+        """
+        now = asyncio.get_running_loop().time()
+        # poll stages which are due any moment now along with the ones due, rather than on their own right after
+        due = now + min(self.interval, self.dense) / 2
+        located, errors = self.locate(self.watched)
+        # stages which aren't anywhere anymore, or in more than one place
+        for identifier, error in errors.items():
+            self.forget([identifier], error=error)
+
+        polled: list[tuple[ControllerInterface, list[int]]] = []
+        for intf, identifiers in located.items():
+            identifiers = [identifier for identifier in identifiers if self.nextPoll.get(identifier, 0) <= due]
+            if len(identifiers) > 0:
+                polled.append((intf, identifiers))
+
+        moves = {identifier: self.expected.get(identifier) for _, identifiers in polled for identifier in identifiers}
+        results = await asyncio.gather(*[intf.updateStageStatus(identifiers) for intf, identifiers in polled],
+                                       return_exceptions=True)
+        for (intf, identifiers), result in zip(polled, results):
+            if isinstance(result, Exception):
+                self.giveUp(identifiers, result)
+                continue
+            try:
+                status = intf.stageStatus
+            except Exception as e:
+                self.giveUp(identifiers, e)
+                continue
+            now = asyncio.get_running_loop().time()
+            # a stage which started a new move while we were polling isn't done, whatever the poll said
+            arrived = [identifier for identifier in identifiers if identifier in status and status[identifier].ontarget
+                       and self.expected.get(identifier) is moves[identifier]]
+            for identifier in arrived:
+                move = self.expected.get(identifier)
+                if move is not None:
+                    self.estimator.learn(identifier, move.profile, now - move.started, upperBound=not move.polled)
+            self.forget(arrived)
+            for identifier in identifiers:
+                if identifier in self.watched:
+                    if identifier in self.expected:
+                        self.expected[identifier].polled = True
+                    self.nextPoll[identifier] = self.schedule(identifier, now)
+            missing = [identifier for identifier in identifiers if identifier not in status]
+            if len(missing) > 0:
+                self.forget(missing, error=Exception(f"No status for stages {missing}"))
+
+    def giveUp(self, identifiers: list[int], error: Exception):
+        """Stop watching the stages because we can't tell their status, and say so"""
+        if len(identifiers) == 0:
+            return
+        message = f"Giving up on watching {sorted(identifiers)}: {error}"
+        print(message)
+        if self.EA is not None:
+            for identifier in identifiers:
+                self.EA.event(Notice(identifier=identifier, message=message))
+        self.forget(identifiers, error=error)
@@ -1,11 +1,13 @@
 import asyncio
-from typing import Coroutine, Awaitable, Any
+from typing import Coroutine, Awaitable, Any, Callable
 
-from pipython import GCSDevice
+from pipython import GCSDevice, GCSError
 
-from server.Settings import SettingsVault
-from server.StageControl.DataTypes import Notice, StageKind, ConfigurationUpdate
-from server.StageControl.PI.DataTypes import PIController, PIConfiguration, PIConnectionType, PIStageInfo, PIStage
+from server.StageControl.DeviceIO import DeviceWorker
+from server.StageControl.DataTypes import Notice, ConfigurationUpdate, MotionParameters, StageRemoved, \
+    StageStatus
+from server.StageControl.PI.DataTypes import PIController, PIConfiguration, PIConnectionType, PIStageInfo, PIStage, \
+    PIStageRecord, PIStageData
 
 
 class ControllerNotReadyException(Exception):
@@ -28,6 +30,53 @@ def sn_in_device_list(SN: int, enumerate_usb: list[str]):
     return exists
 
 
+def connectionLost(error: Exception) -> bool:
+    """
+    Whether the error means we can't talk to the controller anymore, rather than the controller refusing a command.
+    GCS interface errors are -1 to -999, anything else came from the controller itself, so it's still there.
+    """
+    if isinstance(error, GCSError):
+        return -1000 < error.val < 0
+    return isinstance(error, OSError)
+
+
+class StaticParameters:
+    """
+    Answers of GCS queries which only change when the controller is reconfigured (qCST, qTMN, qTMX, qRON, qVST), kept
+    per axis so they're asked for once rather than on every refresh. Only touched from the controller's thread.
+    """
+
+    def __init__(self):
+        self.values: dict[str, dict[str, Any]] = {}
+        """query name -> axis -> answer"""
+        self.lists: dict[str, list] = {}
+        """query name -> answer, for queries that aren't about axes"""
+
+    def get(self, name: str, query: Callable[[list[str]], dict[str, Any]], axes: list[str]) -> dict[str, Any]:
+        """
+        Answers for the given axes, asking the controller only about the ones we don't know yet
+        @param name: name of the query, i.e. "CST"
+        @param query: the GCS query, i.e. device.qCST
+        @param axes: axes we want to know about
+        """
+        known = self.values.setdefault(name, {})
+        missing = [axis for axis in axes if axis not in known]
+        if len(missing) > 0:
+            known.update(query(missing))
+        return {axis: known[axis] for axis in axes if axis in known}
+
+    def once(self, name: str, query: Callable[[], list]) -> list:
+        """Answer of a query that isn't about axes, asking the controller only the first time"""
+        if name not in self.lists:
+            self.lists[name] = query()
+        return self.lists[name]
+
+    def invalidate(self):
+        """Forget everything, the controller has been reconfigured or reconnected"""
+        self.values.clear()
+        self.lists.clear()
+
+
 class C884(PIController):
     """
     Class used to interact with a single PI C-884 controller.
@@ -41,21 +90,36 @@ class C884(PIController):
     3 Check if axes are referenced with qFRF()
     4 Reference axis with FRF(), this thing will move so be careful
     5 Set soft limits??? working on that. You an also check if the type of axis has to be FRF'd by asking qRON()
+    Referencing is started here, but followed until done by the ReferencingOrchestrator.
     """
-    # TODO Set a timeout for referencing, or be able to detect some kind of errors when referencing
 
-    def __init__(self):
+    def __init__(self, device=None):
         """
-        Initialize the controller and update/reference what's requested in the config. Throws an exception if it fails.
+        Initialize the controller and update what's requested in the config. Throws an exception if it fails.
 
         A device which is not powered or improperly connected will raise an error!
+        :param device: GCS device to talk to, i.e. a GCSEmulator, a new pipython GCSDevice if None
         """
 
         # Start up GCS device
-        self.device: GCSDevice.gcsdevice = GCSDevice("C-884").gcsdevice
+        self.device: GCSDevice.gcsdevice = GCSDevice("C-884").gcsdevice if device is None else device
         """GCSDevice instance, DO NOT ACESS/MODIFY OUTSIDE OF THE C884 CLASS"""
+        self.io = DeviceWorker("C-884")
+        """Thread all GCS calls run on, so a slow exchange doesn't hold up the event loop or other controllers"""
+        self.static = StaticParameters()
+        """Stage names, travel ranges and such, only asked for again after a CST, WPA or reconnect"""
+        self.announced: set[int] = set()
+        """Identifiers of the stages we last sent a StageInfo for"""
+        self.records: dict[str, PIStageRecord] = {}
+        """Live state of the configured stages by channel, what status ticks write to"""
+        self.connected: bool = False
+        """Whether we can talk to the controller, as of the last connect, close, command or liveness check"""
+        self._view: PIConfiguration | None = None
+        """What config hands out, made when first asked for after a change"""
         self.being_referenced = []
         """List of axes we are currently referencing, because PI doesn't know :)"""
+        self.motion: dict[str, MotionParameters] = {}
+        """Velocity and acceleration per channel, asked for once per configuration"""
         super().__init__()
 
     async def updateFromConfig(self, config: PIConfiguration):
@@ -66,6 +130,9 @@ class C884(PIController):
         :return:
         """
 
+        # stages might change, ask for their motion parameters again
+        self.motion.clear()
+
         # if we are a fresh object without a config, lets make one
         if self.config is None:
             self._config = PIConfiguration(
@@ -102,10 +169,7 @@ class C884(PIController):
         print("setting CLO")
         await self.setServoCLO(config.stages)
 
-
-        print("Referencing")
-        await self.reference(config.stages)
-
+        # Referencing is started by whoever asked for the configuration, see ReferencingOrchestrator
         # Do a full status refresh
         await self.refreshFullStatus()
 
@@ -129,7 +193,7 @@ class C884(PIController):
         """
         self.checkReady()
 
-        cst = self.device.qCST()
+        cst = await self.run(self.device.qCST)
         return cst
 
     async def loadStagesToC884(self, stages: dict[str, PIStage]):
@@ -146,16 +210,71 @@ class C884(PIController):
         # Replace NOSTAGE with stage name
         for stage in stages.values():
             req[stage.channel] = stage.device
-        try:
+
+        def write():
+            self.static.invalidate()
             self.device.CST(req)
             # Save to non-volatile memory so we have it again on next startup
             self.device.WPA()
-            # if we're here then we successfully updated stages
+
+        try:
+            await self.run(write)
+            # if we're here then we successfully updated stages, what we knew about the old ones is gone
             self._config.stages = stages
+            self.records = {}
+            self._view = None
         except Exception as e:
             print(e)
             raise e
 
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        """
+        Run a blocking call on the device's thread, noting if it failed because the controller is gone
+        @param func: the blocking function, i.e. a GCS command
+        @return: whatever it returns
+        """
+        try:
+            return await self.io.run(func, *args, **kwargs)
+        except Exception as e:
+            if connectionLost(e):
+                self.setConnected(False)
+            raise e
+
+    def setConnected(self, connected: bool):
+        """Note whether the controller is there, and let everyone know if that changed"""
+        if connected == self.connected:
+            return
+        self.connected = connected
+        self._view = None
+        if self._config is None:
+            return
+        print(f"C-884 {self._config.SN} {'connected' if connected else 'lost connection'}")
+        self.EA.event(ConfigurationUpdate(SN=self._config.SN, message="Connected" if connected else "Connection lost",
+                                          error=not connected))
+        # the stages' connected and ready flags changed with it
+        for status in self.stageStatuses.values():
+            self.EA.event(status)
+
+    async def checkLiveness(self) -> bool:
+        """
+        Ask the controller who it is, to find out whether it's still there. Waits behind whatever the controller is
+        busy with, rather than cutting in.
+        @return: whether it answered
+        """
+        if self._config is None:
+            return False
+
+        def probe() -> bool:
+            return self.device.IsConnected() and len(self.device.qIDN()) > 0
+
+        try:
+            alive = await self.io.run(probe)
+        except Exception as e:
+            print(f"C-884 {self._config.SN} liveness check failed: {e}")
+            alive = False
+        self.setConnected(alive)
+        return alive
+
     @property
     async def error(self) -> str | None:
         """
@@ -163,7 +282,7 @@ class C884(PIController):
         :return: the error read from the controller
         """
         if self.ready:
-            return str(self.device.GetError())
+            return str(await self.run(self.device.GetError))
         else:
             return "Controller not ready."
 
@@ -173,11 +292,13 @@ class C884(PIController):
 
     @property
     def isconnected(self) -> bool:
-        return self.device.IsConnected()
+        """Whether we're connected, as far as we know, without asking the device"""
+        return self.connected
 
     @property
     def ready(self) -> bool:
-        return self.isavailable  # for now just isavailable
+        # for now just connected, which is all isavailable of the device tells us too
+        return self.connected
 
     def checkReady(self, message: str = ""):
         """ Raises ControllerNotReady exception if controller is not ready"""
@@ -191,7 +312,7 @@ class C884(PIController):
         :return:
         """
         self.checkReady()
-        return self.dict2list(self.device.qRON(self.device.axes))
+        return self.dict2list(await self.run(lambda: self.static.get("RON", self.device.qRON, self.device.axes)))
 
     @property
     async def isReferenced(self) -> dict[str, bool]:
@@ -200,7 +321,7 @@ class C884(PIController):
         :return:
         """
         self.checkReady()
-        return self.device.qFRF(self.device.axes)
+        return await self.run(lambda: self.device.qFRF(self.device.axes))
 
     @property
     async def servoCLO(self) -> list[bool | None]:
@@ -209,7 +330,7 @@ class C884(PIController):
         :return:
         """
         self.checkReady()
-        return self.device.qSVO(self.device.axes)
+        return await self.run(lambda: self.device.qSVO(self.device.axes))
 
     async def setServoCLO(self, stages: dict[str, PIStage] = None):
         """
@@ -218,7 +339,7 @@ class C884(PIController):
         :return:
         """
         if stages is None:
-            self.device.SVO(self.device.axes, [True] * len(self.device.axes))
+            await self.run(lambda: self.device.SVO(self.device.axes, [True] * len(self.device.axes)))
         else:
             # if there are non-None values for a stage which is a NOSTAGE, set it to none,
             # or else GCS will throw an error
@@ -229,45 +350,63 @@ class C884(PIController):
 
             # Only do a request if our request is not empty, else an exception will be thrown
             if len(req.values()) != 0:
-                self.device.SVO(req)
+                await self.run(self.device.SVO, req)
 
-    async def reference(self, stages: dict[str, PIStage]):
+    async def startReferencing(self, stages: dict[str, PIStage]) -> list[int]:
         """
-        Reference the given axes. If none, reference all axes. We cannot "dereference" axes,
-        so no worries about accidentally doing that.
-        :param stages: PIStage objects we pull data from.
-        :return:
+        Start referencing the given axes, if they want to be referenced and aren't yet. We cannot "dereference" axes,
+        so no worries about accidentally doing that. Doesn't wait for the axes to finish.
+        @param stages: PIStage objects we pull data from.
+        @return: channels which started referencing
         """
-        # clear the list of stages we are currently referencing
+        self.checkReady()
         self.being_referenced = []
+        wanted = [stage for stage in stages.values() if stage.referenced]
+        if len(wanted) == 0:
+            return []
 
-        # check if we are ready, if we are requesting anything to be referenced in the first place
+        # Check against the current referenced axes, we do not want to reference already references stages.
+        refd = await self.run(self.device.qFRF, [str(stage.channel) for stage in wanted])
+        req = [stage.channel for stage in wanted if not refd.get(str(stage.channel))]
+
+        if len(req) != 0:
+            # Ask the controller to reference. Make sure the request is not empty.
+            await self.run(self.device.FRF, req)
+            self.being_referenced = req
+        return req
+
+    async def referencedState(self, channels: list[int]) -> dict[int, bool]:
+        """
+        Ask only the given axes whether they are referenced
+        @param channels: Integers of channels
+        """
         self.checkReady()
-        if stages is None:
-            return
+        refd = await self.run(self.device.qFRF, [str(channel) for channel in channels])
+        res = {channel: bool(refd.get(str(channel))) for channel in channels}
+        self.being_referenced = [channel for channel in self.being_referenced if not res.get(channel, False)]
+        return res
 
+    async def haltReferencing(self, channels: list[int] | None = None):
+        """
+        Stop referencing, all axes with STP, or just the given ones with HLT
+        @param channels: Integers of channels, None for all of them
+        """
+        self.checkReady("Cannot stop referencing.")
+        # both leave error 10 (stopped by command) behind, which is expected so don't raise it
+        if channels is None:
+            await self.run(self.device.STP, noraise=True)
+            self.being_referenced = []
         else:
-            req = []
-            # Check against the current referenced axes, we do not want to reference already references stages.
-            refd = await self.isReferenced
-            # Go through each stage configuration.
-            for stage in stages.values():
-                if stage.referenced and refd.__contains__(str(stage.channel)) and refd[str(stage.channel)]:
-                    # Already referenced, no need to re-reference
-                    continue
-                elif stage.referenced:
-                    # We would like to request this stage to be referenced
-                    req.append(stage.channel)
-                    # add to the list of stages we are referencing
-                    self.being_referenced.append(stage.channel)
-
-            if len(req) != 0:
-                # Ask the controller to reference. Make sure the request is not empty.
-                self.device.FRF(req)
-                await self.refreshFullStatus()  # do this because sometimes it shows as not ref'd.
-
-    async def refreshFullStatus(self):
+            await self.run(self.device.HLT, channels, noraise=True)
+            self.being_referenced = [channel for channel in self.being_referenced if channel not in channels]
+
+    async def refreshFullStatus(self, invalidate_cache: bool = False):
+        """
+        @param invalidate_cache: ask for stage names and travel ranges again too, rather than using what we know
+        """
         print("refresh full status")
+        if invalidate_cache:
+            await self.run(self.static.invalidate)
 
         status = PIConfiguration(
             SN=self.config.SN,
@@ -286,74 +425,124 @@ class C884(PIController):
 
 
         # If the controller is ready, then we query for the rest of the status information
+        records: dict[str, PIStageRecord] = {}
         if status.ready:
 
-            # We now try to read information to disk, namely whether
-            # the stage is linear or rotational
-            SV = SettingsVault()
-            await SV.load_all()
+            # What the settings say about the stages, namely whether they are linear or rotational. Read once, and
+            # kept up to date by the vault, so nothing is read from disk here
+            await self.SV.ensureLoaded()
+            catalog = self.SV.catalog("PIStages", PIStageData)
 
-            # Check if ref'd, clo'd and the device name
-            refd, clod, dev = await asyncio.gather(self.isReferenced, self.servoCLO, self.loadStagesFromC884())
-            for ax in self.device.axes:
+            # Everything about the configured axes, in one go
+            readout = await self.run(self.readStatus, None, True)
+            for ax, values in readout.items():
 
                 # get device data saved on disk
-                fetched = self.fetchPIStageData(dev[ax], SV.readonly["PIStages"])
+                fetched = self.fetchPIStageData(values["device"], catalog)
 
-                # Generate the PIStage object from what we learned
+                # Keep what we learned, checked once here rather than on every status tick
                 try:
-                    status.stages[ax] = PIStage(
-                        channel=ax,
-                        referenced=refd[ax],
-                        clo=clod[ax],
-                        device=dev[ax],
-                        kind=StageKind(fetched["type"])
+                    records[ax] = PIStageRecord(
+                        channel=int(ax),
+                        identifier=status.SN * 10 + int(ax),
+                        referenced=bool(values["referenced"]),
+                        clo=bool(values["clo"]),
+                        device=str(values["device"]),
+                        kind=fetched.type,
+                        minimum=float(values["minimum"]),
+                        maximum=float(values["maximum"]),
+                        position=float(values["position"]),
+                        on_target=bool(values["on_target"]),
                     )
                 except Exception as e:
                     raise Exception(f"Error reading stages from settings/readonly/PIStages.json: {e}")
-
+            status.stages = {ax: record.toPIStage() for ax, record in records.items()}
 
         self._config = status
-
-        # update parameters which directly save to the self.config
-        await asyncio.gather(self.refreshPosOnTarget(), self.update_ranges())
-
-        # Send an info update, status is handled in pos on target
-        for info in self.stageInfos.values():
-            self.EA.event(info)
+        self.records = records
+        self._view = None
+
+        # Send the updates
+        for stat in self.stageStatuses.values():
+            self.EA.event(stat)
+        infos = self.stageInfos
+        for info in infos.values():
+            self.EA.event(info.toStageInfo())
+        # stages no longer configured or referenced
+        for identifier in self.announced - set(infos.keys()):
+            self.EA.event(StageRemoved(identifier=identifier))
+        self.announced = set(infos.keys())
+
+    def readStatus(self, axes: list[str] | None = None, full: bool = False) -> dict[str, dict[str, Any]]:
+        """
+        Status pipeline, runs as a single job on the device's thread. Asks only about the given axes, position and
+        on target always and everything else only for a full refresh, and sorts the answers per axis in one pass.
+        Stage names and travel ranges come from the static parameters, so they cost nothing once known.
+        @param axes: axes to ask about, all configured axes if None
+        @param full: whether to ask about more than position and on target
+        @return: axis -> field (position, on_target, referenced, clo, device, minimum, maximum) -> value
+        """
+        axes = list(self.device.axes) if axes is None else axes
+        if len(axes) == 0:
+            return {}
+        queries = {"position": self.device.qPOS, "on_target": self.device.qONT}
+        if full:
+            queries.update(referenced=self.device.qFRF, clo=self.device.qSVO)
+        answers = {field: query(axes) for field, query in queries.items()}
+        if full:
+            answers.update(device=self.static.get("CST", self.device.qCST, axes),
+                           minimum=self.static.get("TMN", self.device.qTMN, axes),
+                           maximum=self.static.get("TMX", self.device.qTMX, axes))
+        return {axis: {field: answer[axis] for field, answer in answers.items() if axis in answer} for axis in axes}
 
     @property
     def config(self) -> PIConfiguration:
+        """
+        Configuration and state of the controller as we know it, without asking the controller. Made once after each
+        change and shared until the next, so don't modify it.
+        """
 
         # if we are none, return none
         if self._config is None:
             return None
 
-        # Update the status with data that doesn't need to be async'd
-        self._config.ready = self.ready
-        self._config.connected = self.isconnected
+        if self._view is None:
+            # Only made from what we keep here, nothing to validate since it all comes from us
+            update = {"connected": self.connected, "ready": self.ready}
+            if self.records:
+                update["stages"] = {channel: record.toPIStage() for channel, record in self.records.items()}
+            self._view = self._config.model_copy(update=update)
+        return self._view
+
+    @property
+    def stageRecords(self) -> dict[str, PIStageRecord]:
+        return self.records
 
-        # return the status, but as a copy, we don't want anyone to access this.
-        return self._config.__copy__()
+    @property
+    def stageInfos(self) -> dict[int, PIStageInfo]:
+        SN = self._config.SN
+        return {record.identifier: record.toStageInfo(SN) for record in self.records.values() if record.usable}
+
+    @property
+    def stageStatuses(self) -> dict[int, StageStatus]:
+        # straight from the records, without making a configuration first
+        return {record.identifier: record.toStageStatus(self.connected, self.ready)
+                for record in self.records.values() if record.usable}
 
     async def refreshPosOnTarget(self):
-        await asyncio.gather(self.update_onTarget(), self.update_position())
+        self.checkReady("Cannot get position.")
+        # just the axes we know are configured
+        readout = await self.run(self.readStatus, list(self.records.keys()))
+        for channel, values in readout.items():
+            record = self.records[channel]
+            record.position = float(values["position"])
+            record.on_target = bool(values["on_target"])
+        self._view = None
 
         # Send a status update
         for status in self.stageStatuses.values():
             self.EA.event(status)
 
-    async def update_position(self):
-        """
-        Gets position of stages from controller
-        :return:
-        """
-        self.checkReady("Cannot get position.")
-        # ensure float type
-        for channel, pos in self.device.qPOS().items():
-            if self.config.stages.__contains__(channel):
-                self._config.stages[channel].position = float(pos)
-
     async def moveTo(self, channel: str, target: float):
         """
         Moves channel(s) to target(s)
@@ -362,31 +551,72 @@ class C884(PIController):
         """
         self.checkReady("Cannot move axis.")
 
-        self.device.MOV(channel, target)
+        await self.run(self.device.MOV, channel, target)
+
+    async def moveToMany(self, targets: dict[int, float]):
+        """
+        Moves several channels with a single MOV, so they start together. The controller refuses the whole command
+        if any of it is wrong.
+        @param targets: Integer of channel -> float of target position
+        """
+        self.checkReady("Cannot move axes.")
+
+        await self.run(self.device.MOV, dict(targets))
 
     async def moveBy(self, channel, step):
         self.checkReady("Cannot move axis.")
 
         # MVR is for relative, but it is relative to the last commanded
         # target position, not current position.
-        position = self.dict2list(self.device.qPOS())
-        self.device.MOV(channel, position[channel - 1] + step)
+        def relative():
+            position = self.dict2list(self.device.qPOS())
+            self.device.MOV(channel, position[channel - 1] + step)
 
-    async def update_onTarget(self):
+        await self.run(relative)
+
+    async def stop(self, channel):
         """
-        Returns boolean of whether the axis/axes are on target.
-        @return: Boolean or array of booleans of whether the axes are on target.
+        Stops the channel, decelerating smoothly
+        @param channel: Integer of channel to stop
         """
-        self.checkReady()
-        for key, ont in self.device.qONT().items():
-            if self.config.stages.__contains__(key):
-                self._config.stages[key].on_target = ont
+        self.checkReady("Cannot stop axis.")
+
+        # HLT leaves error 10 (stopped by command) behind, which is expected so don't raise it
+        await self.run(self.device.HLT, channel, noraise=True)
+
+    async def motionParameters(self, channel) -> MotionParameters:
+        """
+        Velocity and acceleration of the channel, from qVEL and qACC. Remembered until the next configuration change.
+        @param channel: Integer of channel
+        """
+        axis = str(channel)
+        if axis not in self.motion:
+            self.checkReady("Cannot get velocity.")
+            velocity, acceleration = await self.run(lambda: (self.device.qVEL(axis), self.device.qACC(axis)))
+            self.motion[axis] = MotionParameters(velocity=float(velocity[axis]), acceleration=float(acceleration[axis]))
+        return self.motion[axis]
 
     async def openConnection(self, config: PIConfiguration) -> bool:
         """
         Opens connection to controller device if not already connected
         :return: true if successful or already connected, false otherwise
         """
+        try:
+            connected = await self.run(self.connect, config)
+        except Exception as e:
+            self.setConnected(False)
+            raise e
+        # the channel amount and comport might have changed
+        self._view = None
+        self.setConnected(connected)
+        return connected
+
+    def connect(self, config: PIConfiguration) -> bool:
+        """
+        Blocking part of openConnection, runs on the device's thread
+        """
+        # whatever we knew might not be about this controller anymore
+        self.static.invalidate()
         if not self.device.connected:
             # try to connect
             try:
@@ -431,65 +661,19 @@ class C884(PIController):
         Closes connection to the controller device
         """
         self.device.CloseConnection()
-
-    async def update_ranges(self):
-        """
-        Updates the [min,max] for each channel
-        """
-        self.checkReady()
-        minrange = self.device.qTMN()
-        maxrange = self.device.qTMX()
-
-        # Go through each stage in the config and update the minmax
-        for stage in self._config.stages.values():
-                stage.min_max = ([minrange[str(stage.channel)], maxrange[str(stage.channel)]])
+        # on the device's thread, so nothing to announce from here
+        self.connected = False
+        self._view = None
 
     async def getSupportedStages(self) -> list[str]:
         if not self.isconnected:
             raise Exception("Not connected!")
 
-        return self.device.qVST()
-
-    async def is_configuration_configured(self):
-
-        # The only PI configuration we need to query periodically for is if everything is referenced
-        refstate = self.device.qFRF()
-        print("refstate, being_referenced", refstate, self.being_referenced)
-        message = "Referencing"
-
-        for reffing in self.being_referenced:
-            if refstate.__contains__(str(reffing)):
-                # we have it (we should!)
-                if refstate.get(str(reffing)):
-                    # add to the message and remove from list of axes being referenced
-                    message += f", Channel {reffing} referenced "
-                    self.being_referenced.remove(reffing)
-            else:
-                # something has gone wrong! tell the user and remove from list
-                self.EA.event(ConfigurationUpdate(SN=self.config.SN,message=f"could not find channel {reffing}", error=True))
-                self.being_referenced.remove(reffing)
-
-
-        # Construct the configuration update
-        if len(self.being_referenced)==0:
-            message = "Ready"
-
-        await self.refreshFullStatus()
-
-        update = ConfigurationUpdate(
-            SN=self.config.SN,
-            message = message,
-            configuration = self.config.toPIAPI(),
-            finished = len(self.being_referenced)==0,
-        )
-        self.EA.event(update)
-
-
-        # Check if controller is ready, if True we don't need to run this function again
-        return self.config.SN, len(self.being_referenced)==0
+        return await self.run(self.static.once, "VST", self.device.qVST)
 
     def shutdown_and_cleanup(self):
-        self.__exit__()
+        # close after whatever is still queued for the device
+        self.io.shutdown(self.closeConnection)
 
     # adding a bunch of exit handlers to triple make sure it disconnects gracefully
     # and doesn't keep hogging the com port (for rs232 mainly, and no i'm not gonna
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+from dataclasses import dataclass
 from enum import Enum
 from typing import Any, Coroutine, Awaitable
 
@@ -9,7 +10,7 @@ from pydantic_core.core_schema import FieldValidationInfo
 
 from server.Settings import SettingsVault
 from server.StageControl.DataTypes import StageStatus, StageInfo, EventAnnouncer, StageKind, \
-    StageRemoved, ConfigurationUpdate, Configuration, Notice
+    StageRemoved, ConfigurationUpdate, Configuration, Notice, MotionParameters
 
 
 class C884Settings(BaseModel):
@@ -27,6 +28,11 @@ class PIControllerModel(str, Enum):
     mock = "mock"
 
 
+class PIStageData(BaseModel):
+    """What we know about a PI stage model, from settings/readonly/PIStages.json"""
+    type: StageKind = Field(description="Whether the stage is linear or rotational")
+
+
 class PIStage(BaseModel):
     channel: int = Field(description="Which channel this stage is connected to", examples=[1, 2, 3])
     device: str = Field(description="Name of the stage, i.e. L-611.90AD",
@@ -67,6 +73,56 @@ class PIStageInfo(StageInfo):
             raise ValueError(f"SN {value} doesnt match identifier")
         return value
 
+    def toStageInfo(self) -> StageInfo:
+        """Just the StageInfo part, for announcing it, since events only reach subscribers of their exact type"""
+        return StageInfo.model_construct(**{field: getattr(self, field) for field in StageInfo.model_fields})
+
+
+@dataclass(slots=True)
+class PIStageRecord:
+    """
+    Live state of a configured stage, as the driver keeps it between status ticks. Plain attributes, so writing a new
+    position costs nothing, converted to the API models only when they're handed out.
+    """
+    channel: int
+    identifier: int
+    """controller SN * 10 + channel"""
+    device: str
+    kind: StageKind = StageKind.linear
+    minimum: float = 0
+    maximum: float = 500
+    referenced: bool = False
+    clo: bool = False
+    position: float = 0
+    on_target: bool = False
+
+    @classmethod
+    def fromPIStage(cls, SN: int, stage: PIStage) -> PIStageRecord:
+        return cls(channel=int(stage.channel), identifier=SN * 10 + int(stage.channel), device=stage.device,
+                   kind=stage.kind, minimum=stage.min_max[0], maximum=stage.min_max[1], referenced=stage.referenced,
+                   clo=stage.clo, position=stage.position, on_target=stage.on_target)
+
+    @property
+    def usable(self) -> bool:
+        """Whether the stage can be handed out, i.e. referenced and not a NOSTAGE"""
+        return self.referenced and self.device != "NOSTAGE"
+
+    # The values were checked when the record was made, so the models are built without validating them again
+
+    def toPIStage(self) -> PIStage:
+        return PIStage.model_construct(channel=self.channel, device=self.device, clo=self.clo,
+                                       referenced=self.referenced, min_max=[self.minimum, self.maximum],
+                                       on_target=self.on_target, position=self.position, kind=self.kind)
+
+    def toStageInfo(self, SN: int) -> PIStageInfo:
+        return PIStageInfo.model_construct(controllerSN=SN, channel=self.channel, model=self.device,
+                                           identifier=self.identifier, kind=self.kind, minimum=self.minimum,
+                                           maximum=self.maximum)
+
+    def toStageStatus(self, connected: bool, ready: bool) -> StageStatus:
+        return StageStatus.model_construct(identifier=self.identifier, connected=connected, ready=ready and connected,
+                                           position=self.position, ontarget=self.on_target)
+
 
 class PIConfiguration(Configuration):
     """
@@ -129,7 +185,7 @@ class PIController:
     def __init__(self):
         self.EA = EventAnnouncer(PIController, StageStatus, StageInfo, StageRemoved, Notice, ConfigurationUpdate)
         self._config = None
-        self.SV = SettingsVault()
+        self.SV = SettingsVault.shared()
 
     async def updateFromConfig(self, status: PIConfiguration):
         raise NotImplementedError
@@ -137,9 +193,10 @@ class PIController:
     def shutdown_and_cleanup(self):
         raise NotImplementedError
 
-    async def refreshFullStatus(self):
+    async def refreshFullStatus(self, invalidate_cache: bool = False):
         """
         Refresh the entire status of the controller.
+        :param invalidate_cache: also ask again for what only changes on reconfiguration, i.e. stage names
         """
         raise NotImplementedError
 
@@ -155,6 +212,29 @@ class PIController:
     async def moveBy(self, channel, step):
         raise NotImplementedError
 
+    async def moveToMany(self, targets: dict[int, float]):
+        """
+        Move several channels at once, one after the other unless the controller can do better
+        :param targets: channel -> position
+        """
+        for channel, position in targets.items():
+            await self.moveTo(channel, position)
+
+    async def stop(self, channel):
+        raise NotImplementedError
+
+    async def motionParameters(self, channel) -> MotionParameters | None:
+        """Velocity and acceleration of the channel, None if we don't know them"""
+        return None
+
+    async def checkLiveness(self) -> bool:
+        """
+        Find out whether the controller is still there, and update the connection state if it isn't. Controllers which
+        can't lose their connection just say how they are.
+        :return: whether it is
+        """
+        return self.config is not None and self.config.connected
+
     @property
     def config(self) -> PIConfiguration:
         """
@@ -163,60 +243,61 @@ class PIController:
         raise NotImplementedError
 
     @property
-    def stageInfos(self) -> dict[int, PIStageInfo]:
+    def stageRecords(self) -> dict[str, PIStageRecord]:
+        """
+        Live state of the configured stages, channel -> record. Made from the configuration, controllers which keep
+        their own records hand those out instead.
+        """
+        config = self.config
+        if config is None:
+            return {}
+        return {channel: PIStageRecord.fromPIStage(config.SN, stage) for channel, stage in config.stages.items()}
 
-        res = {}
-        for stage in self.config.stages.values():
-            # Check if ready to use, i.e. referenced and no a NOSTAGE.
-            if (stage == "NOSTAGE") or (not stage.referenced):
-                continue
-
-            resstage = PIStageInfo(
-                controllerSN=self.config.SN,
-                channel=stage.channel,
-                model=stage.device,
-                identifier=self.config.SN * 10 + (int(stage.channel)),  # controller SN plus channel
-                kind=StageKind.linear,  # TODO UNHARDCODE
-                minimum=stage.min_max[0],
-                maximum=stage.min_max[1]
-            )
-            # if we are here, the stage exists
-            res[resstage.identifier] = resstage
-
-        return res
+    @property
+    def stageInfos(self) -> dict[int, PIStageInfo]:
+        SN = self.config.SN
+        # only stages ready to use, i.e. referenced and not a NOSTAGE
+        return {record.identifier: record.toStageInfo(SN) for record in self.stageRecords.values() if record.usable}
 
     @property
     def stageStatuses(self) -> dict[int, StageStatus]:
-        res = {}
-        for stage in self.config.stages.values():
-            # Check if valid stage
-            if (stage == "NOSTAGE") or (not stage.referenced):
-                continue
-
-            stat = (StageStatus(
-                identifier=self.config.SN * 10 + (int(stage.channel)),
-                connected=self.config.connected,
-                ready=self.config.ready,
-                position=stage.position,
-                ontarget=stage.on_target
-            ))
-            res[stat.identifier] = stat
-        return res
+        config = self.config
+        return {record.identifier: record.toStageStatus(config.connected, config.ready)
+                for record in self.stageRecords.values() if record.usable}
 
     @staticmethod
-    def fetchPIStageData(name: str, settings: object):
+    def fetchPIStageData(name: str, settings: dict[str, PIStageData]) -> PIStageData:
         """
         Look into the readonly settings if we have a stage of this name
         :param name: name of the stage, i.e. L406.20DD10
-        :param settings: the settings dict loaded from disk
-        :return: dict from the settings, {type: linear/rotational}
+        :param settings: the PIStages catalog of the settings
+        :return: what the settings say about the stage
         """
         if settings.__contains__(name):
             return settings[name]
         else:
             raise Exception(f"Stage {name} not found in settings")
 
-    async def is_configuration_configured(self) -> tuple[int, bool]:
+    async def startReferencing(self, stages: dict[str, PIStage]) -> list[int]:
+        """
+        Start referencing the stages which want to be referenced and aren't yet, without waiting for them
+        :param stages: the stages as configured
+        :return: channels which started referencing
+        """
+        raise NotImplementedError
+
+    async def referencedState(self, channels: list[int]) -> dict[int, bool]:
+        """
+        Ask the controller which of the channels are referenced by now, asking about those channels only
+        :return: channel -> referenced
+        """
+        raise NotImplementedError
+
+    async def haltReferencing(self, channels: list[int] | None = None):
+        """
+        Stop referencing
+        :param channels: channels to halt, None to stop all of them
+        """
         raise NotImplementedError
 
 
@@ -0,0 +1,358 @@
+from __future__ import annotations
+
+import math
+import time
+from collections import OrderedDict
+from typing import Any, Callable
+
+from pipython import GCSError
+from pipython.pidevice import gcserror
+
+
+class EmulatedStage:
+    """Parameters of a stage the emulator knows by name"""
+
+    def __init__(self, minimum: float = 0, maximum: float = 200, velocity: float = 10, acceleration: float = 100,
+                 referencing: float = 2):
+        """
+        :param minimum: lower end of the travel range, also where referencing leaves the stage
+        :param maximum: upper end of the travel range
+        :param velocity: cruising speed of moves, per second
+        :param acceleration: acceleration and deceleration of moves, per second squared
+        :param referencing: seconds a FRF takes
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.velocity = velocity
+        self.acceleration = acceleration
+        self.referencing = referencing
+
+
+def travelled(distance: float, velocity: float, acceleration: float, elapsed: float) -> tuple[float, float]:
+    """
+    Where a trapezoidal move is after some time, or a triangular one if it never gets up to speed
+    :param distance: length of the move, positive
+    :return: distance covered, and the total duration of the move
+    """
+    ramp = velocity / acceleration
+    ramp_distance = velocity * velocity / (2 * acceleration)
+    if distance < 2 * ramp_distance:
+        velocity = math.sqrt(distance * acceleration)
+        ramp = velocity / acceleration
+        ramp_distance = distance / 2
+    duration = 2 * ramp + (distance - 2 * ramp_distance) / velocity if velocity > 0 else 0
+
+    if elapsed >= duration:
+        return distance, duration
+    if elapsed <= 0:
+        return 0, duration
+    if elapsed < ramp:
+        return acceleration * elapsed * elapsed / 2, duration
+    if elapsed < duration - ramp:
+        return ramp_distance + velocity * (elapsed - ramp), duration
+    remaining = duration - elapsed
+    return distance - acceleration * remaining * remaining / 2, duration
+
+
+class EmulatedAxis:
+    """State of one channel of the emulated controller"""
+
+    def __init__(self, clock: Callable[[], float]):
+        self.clock = clock
+        self.stage = "NOSTAGE"
+        self.parameters = EmulatedStage()
+        self.servo = False
+        self.referenced = False
+        self.referencedAt: float | None = None
+        """Clock time a FRF in progress finishes"""
+        self.origin = 0.0
+        self.target = 0.0
+        self.started = 0.0
+
+    def settle(self):
+        """Finish a FRF which is done by now"""
+        if self.referencedAt is not None and self.clock() >= self.referencedAt:
+            self.referencedAt = None
+            self.referenced = True
+            self.origin = self.target = self.parameters.minimum
+            self.started = self.clock()
+
+    def progress(self) -> tuple[float, bool]:
+        """Position right now, and whether the move is done"""
+        self.settle()
+        distance = abs(self.target - self.origin)
+        covered, duration = travelled(distance, self.parameters.velocity, self.parameters.acceleration,
+                                      self.clock() - self.started)
+        position = self.origin + math.copysign(covered, self.target - self.origin)
+        return position, covered >= distance and self.referencedAt is None
+
+    def halt(self):
+        """Stop right where it is, and abort referencing"""
+        self.origin = self.target = self.progress()[0]
+        self.started = self.clock()
+        self.referencedAt = None
+
+
+class GCSEmulator:
+    """
+    In-process stand-in for pipython's GCSDevice, implementing the part of it C884 uses, so the real driver can be
+    tested and benchmarked without a controller. Commands take as long as their exchange would over the serial line
+    at the connected baud rate, moves follow a trapezoidal velocity profile, FRF takes a while, and errors are raised
+    as GCSError with the codes the controller uses, unless noraise is given.
+
+    Usage: C884(device=GCSEmulator(SN=118071328))
+    """
+
+    def __init__(self, SN: int = 118071328, channels: int = 4, stages: dict[str, EmulatedStage] | None = None,
+                 turnaround: float = 0.001, errcheck: bool = True, clock: Callable[[], float] = time.monotonic):
+        """
+        :param SN: serial number the controller reports
+        :param channels: number of channels
+        :param stages: stages the controller knows by name (qVST), a few of the usual ones if None
+        :param turnaround: seconds the controller takes to answer, on top of the transfer
+        :param errcheck: whether every command is followed by an ERR? exchange, as pipython does by default
+        :param clock: time source for motion, seconds
+        """
+        self.SN = SN
+        self.stages = stages if stages is not None else {
+            name: EmulatedStage() for name in ["L-406.20DD10", "L-406.40DD10", "M-417.2PD", "M-414.2DG"]}
+        self.turnaround = turnaround
+        self.errcheck = errcheck
+        self.clock = clock
+        self.channels = OrderedDict((str(channel), EmulatedAxis(clock)) for channel in range(1, channels + 1))
+        self.baudrate: int | None = None
+        """Baud rate of the RS232 connection, None over USB"""
+        self.connected = False
+        self.error = 0
+        self.saved: dict[str, str] = {}
+        """Stages saved with WPA, loaded on connect"""
+        self.exchanges = 0
+        """Number of exchanges with the controller so far"""
+        self.traffic = 0
+        """Bytes sent and received so far"""
+        self.sent: list[str] = []
+        """Commands sent so far, in order"""
+
+    # connection
+
+    @property
+    def isavailable(self) -> bool:
+        return self.connected
+
+    def IsConnected(self) -> bool:
+        return self.connected
+
+    def EnumerateUSB(self, mask: str = "") -> list[str]:
+        return [f"PI C-884 Controller SN {self.SN}"]
+
+    def ConnectUSB(self, serialnum):
+        if int(serialnum) != self.SN:
+            raise GCSError(gcserror.CONNECTION_FAILED__6)
+        self.open(None)
+
+    def ConnectRS232(self, comport, baudrate):
+        self.open(int(baudrate))
+
+    def open(self, baudrate: int | None):
+        self.baudrate = baudrate
+        self.connected = True
+        self.error = 0
+        for axis, name in self.saved.items():
+            self.channels[axis].stage = name
+            self.channels[axis].parameters = self.stages.get(name, EmulatedStage())
+
+    def CloseConnection(self):
+        self.connected = False
+
+    def close(self):
+        self.CloseConnection()
+
+    # plumbing
+
+    def exchange(self, command: str, reply: str = ""):
+        """Take as long as sending the command and reading the reply would"""
+        if not self.connected:
+            raise GCSError(gcserror.CONNECTION_FAILED__6)
+        size = len(command) + 1 + len(reply)
+        delay = self.turnaround + (size * 10 / self.baudrate if self.baudrate else 0)
+        self.exchanges += 1
+        self.traffic += size
+        self.sent.append(command)
+        if self.errcheck and command != "ERR?":
+            delay += self.turnaround + (7 * 10 / self.baudrate if self.baudrate else 0)
+            self.exchanges += 1
+            self.traffic += 7
+        if delay > 0:
+            time.sleep(delay)
+
+    def fail(self, code: int, noraise: bool = False):
+        self.error = code
+        if not noraise:
+            raise GCSError(code)
+
+    def resolve(self, axes) -> list[str]:
+        """Axes asked about as a list of strings, all configured axes if None"""
+        if axes is None:
+            return self.axes
+        if isinstance(axes, (str, int)):
+            axes = [axes]
+        return [str(axis) for axis in axes]
+
+    @staticmethod
+    def pairs(axes, values) -> dict[str, Any]:
+        """Arguments of a set command, either a dict or axes and values"""
+        if isinstance(axes, dict):
+            return {str(axis): value for axis, value in axes.items()}
+        if isinstance(axes, (str, int)):
+            return {str(axes): values}
+        values = values if isinstance(values, (list, tuple)) else [values] * len(axes)
+        return {str(axis): value for axis, value in zip(axes, values)}
+
+    def query(self, command: str, axes, value: Callable[[EmulatedAxis], Any]) -> OrderedDict:
+        axes = self.resolve(axes)
+        invalid = [axis for axis in axes if axis not in self.channels]
+        if len(invalid) > 0:
+            self.exchange(f"{command} {' '.join(axes)}")
+            self.fail(gcserror.E15_PI_CNTR_INVALID_AXIS_IDENTIFIER)
+        res = OrderedDict((axis, value(self.channels[axis])) for axis in axes)
+        self.exchange(f"{command} {' '.join(axes)}", "".join(f"{axis}={answer}\n" for axis, answer in res.items()))
+        return res
+
+    def command(self, command: str, arguments: dict[str, Any], noraise: bool = False) -> bool:
+        """Exchange a set command, False if it's about axes that don't exist"""
+        self.exchange(f"{command} {' '.join(f'{axis} {value}' for axis, value in arguments.items())}")
+        if any(axis not in self.channels for axis in arguments):
+            self.fail(gcserror.E15_PI_CNTR_INVALID_AXIS_IDENTIFIER, noraise)
+            return False
+        return True
+
+    # axes
+
+    @property
+    def allaxes(self) -> list[str]:
+        return list(self.channels.keys())
+
+    @property
+    def axes(self) -> list[str]:
+        return [axis for axis, channel in self.channels.items() if channel.stage != "NOSTAGE"]
+
+    def qIDN(self) -> str:
+        idn = f"(c)2015 Physik Instrumente (PI) GmbH & Co. KG, C-884.4DC, {self.SN}, 1.1.0.0"
+        self.exchange("*IDN?", idn)
+        return idn
+
+    def qERR(self) -> int:
+        self.exchange("ERR?", f"{self.error}\n")
+        error, self.error = self.error, 0
+        return error
+
+    def GetError(self) -> int:
+        return self.qERR()
+
+    def qVST(self) -> list[str]:
+        self.exchange("VST?", "".join(f"{name}\n" for name in self.stages))
+        return list(self.stages.keys())
+
+    def qCST(self, axes=None) -> OrderedDict:
+        return self.query("CST?", self.allaxes if axes is None else axes, lambda channel: channel.stage)
+
+    def CST(self, axes, values=None):
+        arguments = self.pairs(axes, values)
+        if not self.command("CST", arguments):
+            return
+        unknown = [name for name in arguments.values() if name != "NOSTAGE" and name not in self.stages]
+        if len(unknown) > 0:
+            self.fail(gcserror.E1_PI_CNTR_PARAM_SYNTAX)
+        for axis, name in arguments.items():
+            channel = self.channels[axis]
+            channel.stage = name
+            channel.parameters = self.stages.get(name, EmulatedStage())
+            channel.servo = channel.referenced = False
+            channel.referencedAt = None
+
+    def WPA(self, password: str = "100"):
+        self.exchange(f"WPA {password}")
+        self.saved = {axis: channel.stage for axis, channel in self.channels.items()}
+
+    def qSVO(self, axes=None) -> OrderedDict:
+        return self.query("SVO?", axes, lambda channel: channel.servo)
+
+    def SVO(self, axes, values=None):
+        arguments = self.pairs(axes, values)
+        if not self.command("SVO", arguments):
+            return
+        for axis, value in arguments.items():
+            if self.channels[axis].stage == "NOSTAGE":
+                self.fail(gcserror.E15_PI_CNTR_INVALID_AXIS_IDENTIFIER)
+            self.channels[axis].servo = bool(value)
+
+    def qRON(self, axes=None) -> OrderedDict:
+        return self.query("RON?", axes, lambda channel: True)
+
+    def qFRF(self, axes=None) -> OrderedDict:
+        def referenced(channel: EmulatedAxis) -> bool:
+            channel.settle()
+            return channel.referenced
+        return self.query("FRF?", axes, referenced)
+
+    def FRF(self, axes=None):
+        axes = self.resolve(axes)
+        if not self.command("FRF", {axis: "" for axis in axes}):
+            return
+        if any(not self.channels[axis].servo for axis in axes):
+            self.fail(gcserror.E5_PI_CNTR_MOVE_WITHOUT_REF_OR_NO_SERVO)
+        for axis in axes:
+            channel = self.channels[axis]
+            channel.halt()
+            channel.referenced = False
+            channel.referencedAt = self.clock() + channel.parameters.referencing
+
+    def qTMN(self, axes=None) -> OrderedDict:
+        return self.query("TMN?", axes, lambda channel: channel.parameters.minimum)
+
+    def qTMX(self, axes=None) -> OrderedDict:
+        return self.query("TMX?", axes, lambda channel: channel.parameters.maximum)
+
+    def qVEL(self, axes=None) -> OrderedDict:
+        return self.query("VEL?", axes, lambda channel: channel.parameters.velocity)
+
+    def qACC(self, axes=None) -> OrderedDict:
+        return self.query("ACC?", axes, lambda channel: channel.parameters.acceleration)
+
+    def qPOS(self, axes=None) -> OrderedDict:
+        return self.query("POS?", axes, lambda channel: channel.progress()[0])
+
+    def qONT(self, axes=None) -> OrderedDict:
+        return self.query("ONT?", axes, lambda channel: channel.progress()[1])
+
+    def MOV(self, axes, values=None):
+        arguments = self.pairs(axes, values)
+        if not self.command("MOV", arguments):
+            return
+        # the controller refuses the whole command if any of it is wrong
+        for axis, target in arguments.items():
+            channel = self.channels[axis]
+            channel.settle()
+            if not (channel.servo and channel.referenced):
+                self.fail(gcserror.E5_PI_CNTR_MOVE_WITHOUT_REF_OR_NO_SERVO)
+            if not channel.parameters.minimum <= float(target) <= channel.parameters.maximum:
+                self.fail(gcserror.E7_PI_CNTR_POS_OUT_OF_LIMITS)
+        for axis, target in arguments.items():
+            channel = self.channels[axis]
+            channel.origin = channel.progress()[0]
+            channel.target = float(target)
+            channel.started = self.clock()
+
+    def HLT(self, axes=None, noraise: bool = False):
+        axes = self.resolve(axes)
+        if not self.command("HLT", {axis: "" for axis in axes}, noraise):
+            return
+        for axis in axes:
+            self.channels[axis].halt()
+        self.fail(gcserror.E10_PI_CNTR_STOP, noraise)
+
+    def STP(self, noraise: bool = False):
+        self.exchange("STP")
+        for channel in self.channels.values():
+            channel.halt()
+        self.fail(gcserror.E10_PI_CNTR_STOP, noraise)
@@ -5,11 +5,12 @@ from pydantic import BaseModel
 
 from server.Settings import SettingsVault
 from server.StageControl.DataTypes import ControllerInterface, StageStatus, StageInfo, \
-    updateResponse, StageRemoved, EventAnnouncer, Notice, getComPorts, ConfigurationUpdate
+    updateResponse, StageRemoved, EventAnnouncer, Notice, getComPorts, ConfigurationUpdate, MotionParameters
 from server.StageControl.PI.C884 import C884
 from server.StageControl.PI.DataTypes import PIConfiguration, PIController, PIStageInfo, PIControllerModel, \
-    PIConnectionType, PIStage, PIAPIConfig
+    PIConnectionType, PIStage, PIAPIConfig, PIStageData
 from server.StageControl.PI.Mock import MockPIController
+from server.StageControl.PI.Referencing import ReferencingOrchestrator
 
 
 class PISettings:
@@ -18,6 +19,9 @@ class PISettings:
         self._controllerStatuses = []
         # type hint, this is where we store controller statuses
         self.controllers: dict[int, PIController] = {}
+        self.referencing = ReferencingOrchestrator(self.EventAnnouncer)
+        self.liveness: asyncio.Task | None = None
+        """Task checking on the controllers every so often, see startLiveness"""
 
     def subscribeTo(self, cntr: PIController):
         self.EventAnnouncer.patch_through_from(self.EventAnnouncer.availableDataTypes, cntr.EA)
@@ -31,32 +35,32 @@ class PISettings:
 
     async def configurationChangeRequest(self, request: list[PIConfiguration]) -> list[updateResponse]:
         """
-        Tries to turn the desired state into reality.
+        Tries to turn the desired state into reality. The controllers are configured concurrently, and referencing is
+        started on each as soon as it's configured, without waiting for it to finish.
         :param request: A valid PIController status.
         :return:
         """
-        res = []
-        for req in request:
-            try:
-                # If we don't have a controller with the SN we need to create a blank new one
-                if not self.controllers.keys().__contains__(req.SN):
-                    await self.newController(req)
-                else:
-                    # Update the relevant controller
-
-                    await self.updateController(req)
-                res.append(updateResponse(
-                    identifier=req.SN,
-                    success=True,
-                ))
-            except Exception as e:
-                res.append(updateResponse(
-                    identifier=req.SN,
-                    success=False,
-                    error=str(e),
-                ))
-
-        return res
+        return list(await asyncio.gather(*[self.configureController(req) for req in request]))
+
+    async def configureController(self, req: PIConfiguration) -> updateResponse:
+        try:
+            # If we don't have a controller with the SN we need to create a blank new one
+            if not self.controllers.keys().__contains__(req.SN):
+                await self.newController(req)
+            else:
+                # Update the relevant controller
+                await self.updateController(req)
+            await self.referencing.start(self.controllers[req.SN], req.stages)
+            return updateResponse(
+                identifier=req.SN,
+                success=True,
+            )
+        except Exception as e:
+            return updateResponse(
+                identifier=req.SN,
+                success=False,
+                error=str(e),
+            )
 
     async def removeConfiguration(self, SN: int):
         """
@@ -64,8 +68,12 @@ class PISettings:
         :param SN: Serial number of the controller.
         :return:
         """
+        await self.referencing.cancel(SN)
+        removed = list(self.controllers[SN].stageInfos.keys())
         self.controllers[SN].shutdown_and_cleanup()
         self.controllers.pop(SN)
+        for identifier in removed:
+            self.EventAnnouncer.event(StageRemoved(identifier=identifier))
 
     async def newController(self, config: PIConfiguration):
         if config.model == PIControllerModel.C884:
@@ -111,10 +119,45 @@ class PISettings:
     def configurationFormat(self):
         return PIConfiguration
 
+    async def checkLiveness(self) -> dict[int, bool]:
+        """
+        Check on all controllers at the same time
+        :return: SN -> whether the controller is there
+        """
+        SNs = list(self.controllers.keys())
+        results = await asyncio.gather(*[self.controllers[SN].checkLiveness() for SN in SNs], return_exceptions=True)
+        return {SN: result is True for SN, result in zip(SNs, results)}
+
+    def startLiveness(self, interval: float = 5):
+        """
+        Check on the controllers every interval seconds, on its own rather than as part of any status refresh
+        :param interval: seconds between checks
+        """
+        if self.liveness is not None and not self.liveness.done():
+            return
+
+        async def run():
+            while True:
+                await asyncio.sleep(interval)
+                await self.checkLiveness()
+
+        self.liveness = asyncio.get_running_loop().create_task(run())
+
+    async def stopLiveness(self):
+        if self.liveness is None:
+            return
+        self.liveness.cancel()
+        try:
+            await self.liveness
+        except asyncio.CancelledError:
+            pass
+        self.liveness = None
+
     async def fullRefreshAllSettings(self):
         awaiters = []
         for cntr in self.controllers.values():
-            awaiters.append(cntr.refreshFullStatus())
+            # explicitly asked for, so don't trust anything we remember
+            awaiters.append(cntr.refreshFullStatus(invalidate_cache=True))
 
         await asyncio.gather(*awaiters)
 
@@ -182,8 +225,9 @@ class PIControllerInterface(ControllerInterface):
         # turn the PIStage device field into a dropdown
         # Update from settings
 
-        await self.SV.reload_all()
-        schema["$defs"]["PIStage"]["properties"]["device"]["enum"] = list(self.SV.readonly["PIStages"].keys())
+        await self.SV.load_all()
+        catalog = self.SV.catalog("PIStages", PIStageData)
+        schema["$defs"]["PIStage"]["properties"]["device"]["enum"] = list(catalog.keys())
 
         # turn the comport field into a dropdown
         # grab free comports
@@ -213,7 +257,7 @@ class PIControllerInterface(ControllerInterface):
         self._settings: PISettings = PISettings()
         """The PISettings is handling basically everything for us"""
         self.EventAnnouncer.patch_through_from(self.EventAnnouncer.availableDataTypes, self.settings.EventAnnouncer)
-        self.SV = SettingsVault()
+        self.SV = SettingsVault.shared()
 
     @property
     def settings(self) -> PISettings:
@@ -231,6 +275,32 @@ class PIControllerInterface(ControllerInterface):
         sn, channel = deconstruct_SN_Channel(identifier)
         await self.settings.controllers[sn].moveTo(channel, position)
 
+    async def moveToMany(self, targets: dict[int, float]) -> dict[int, Exception | None]:
+        """One move command per controller, all controllers at the same time"""
+        grouped: dict[int, dict[int, float]] = {}
+        res: dict[int, Exception | None] = {}
+        for identifier, position in targets.items():
+            sn, channel = deconstruct_SN_Channel(identifier)
+            if sn not in self.settings.controllers:
+                res[identifier] = Exception(f"Stage {identifier} doesn't exist")
+                continue
+            grouped.setdefault(sn, {})[channel] = position
+
+        results = await asyncio.gather(*[self.settings.controllers[sn].moveToMany(channels)
+                                         for sn, channels in grouped.items()], return_exceptions=True)
+        for (sn, channels), result in zip(grouped.items(), results):
+            for channel in channels:
+                res[sn * 10 + channel] = result if isinstance(result, Exception) else None
+        return res
+
+    async def stop(self, identifier: int):
+        sn, channel = deconstruct_SN_Channel(identifier)
+        await self.settings.controllers[sn].stop(channel)
+
+    async def motionParameters(self, identifier: int) -> MotionParameters | None:
+        sn, channel = deconstruct_SN_Channel(identifier)
+        return await self.settings.controllers[sn].motionParameters(channel)
+
     @property
     def stageInfo(self) -> dict[int, StageInfo]:
         res = {}
@@ -303,22 +373,17 @@ class PIControllerInterface(ControllerInterface):
 
     async def is_configuration_configured(self, identifiers: list[int]) -> list[int]:
         """
-        Checks if we have a controller with the given SN, and returns is_configuration_configured.
-        :param identifiers:
-        :return:
+        Returns the controllers among the given SNs which are still referencing. The ReferencingOrchestrator keeps track
+        of that and sends the progress, so nothing is asked of the controllers here.
+        :param identifiers: SNs of controllers
+        :return: SNs of controllers not done yet
         """
+        return [SN for SN in identifiers if self.settings.referencing.busy(SN)]
 
-        # Ask each controller
-        awaiters: list[Awaitable[tuple[int, bool]]] = []
-        for identifier, controller in self.settings.controllers.items():
-            if identifier in identifiers:
-                # Check if it's the correct identifier, if so append to awaiters
-                awaiters.append(controller.is_configuration_configured())
-
-        awaited: list[tuple[int, bool]] = await asyncio.gather(*awaiters)
-        res = []
-        # Go through each awaiter and construct a response array
-        for SN, finished in awaited:
-            if not finished:
-                res.append(SN)
-        return res
+    async def cancelReferencing(self, SN: int | None = None) -> list[int]:
+        """
+        Stops referencing, the stages stop where they are
+        :param SN: SN of the controller, None for all of them
+        :return: SNs of the controllers stopped
+        """
+        return await self.settings.referencing.cancel(SN)
@@ -22,13 +22,14 @@ class MockPIController(PIController):
         time.sleep(0.1)
         self._config.connected = True
 
-    async def reference(self, stages: dict[str, PIStage]):
+    async def startReferencing(self, stages: dict[str, PIStage]) -> list[int]:
         time.sleep(0.1)
         for stage in stages.values():
             if self.config.stages.__contains__(str(stage.channel)):
                 if stage.referenced:
                     # set the referencing time to 3 seconds
                     self.time_when_referenced[stage.channel] = time.time() + 3
+        return list(self.time_when_referenced.keys())
 
     async def load_stages(self, stages: dict[str, PIStage]):
         time.sleep(0.1)
@@ -79,9 +80,6 @@ class MockPIController(PIController):
         self.EA.event(Notice(message="loading stage names"))
         await self.enable_clo(config.stages)
 
-        self.EA.event(Notice(message="loading stage names"))
-        await self.reference(config.stages)
-
         # TODO find a way to simulate this more closely
         self._config.ready = True
 
@@ -99,10 +97,10 @@ class MockPIController(PIController):
     def shutdown_and_cleanup(self):
         pass
 
-    async def refreshFullStatus(self):
+    async def refreshFullStatus(self, invalidate_cache: bool = False):
         # Send an info update, status is handled in pos on target
         for info in self.stageInfos.values():
-            self.EA.event(info)
+            self.EA.event(info.toStageInfo())
 
         # also refresh pos on target since this is a full refresh
         await self.refreshPosOnTarget()
@@ -126,38 +124,16 @@ class MockPIController(PIController):
     def config(self) -> PIConfiguration:
         return self._config
 
-    async def is_configuration_configured(self):
-        # The only PI configuration we need to query periodically for is if everything is referenced
-
-        refstate = {}
-        # go through each time when referenced for each channel
-        for key, reftime in self.time_when_referenced.items():
-                refstate[key] = (time.time() > reftime)
-
-        message = "Referencing"
-
-        for key, ref in refstate.items():
-            if ref:
-                # add to the message and "reference"
-                message += f", Channel {key} referenced "
+    async def referencedState(self, channels: list[int]) -> dict[int, bool]:
+        res = {}
+        for channel in channels:
+            res[channel] = time.time() > self.time_when_referenced.get(channel, 0)
+            if res[channel] and channel in self.time_when_referenced:
                 # "reference"
-                self._config.stages[str(key)].referenced = True
-
-        # convoluted string manipulation
-        if message != "Referencing":
-            message = message[12:]
-
-        finished = not list(refstate.values()).__contains__(False)  # if any channel is not referenced yet, don't reference
-
-        # Construct the configuration update
-        update = ConfigurationUpdate(
-            SN=self.config.SN,
-            message=message,
-            configuration=self.config.toPIAPI(), # REMEMBER TO USE API FORMAT
-            finished=finished
-        )
-
-        self.EA.event(update)
+                self._config.stages[str(channel)].referenced = True
+                self.time_when_referenced.pop(channel)
+        return res
 
-        # Check if controller is ready, if True we don't need to run this function again
-        return self.config.SN, finished
+    async def haltReferencing(self, channels: list[int] | None = None):
+        for channel in list(self.time_when_referenced.keys()) if channels is None else channels:
+            self.time_when_referenced.pop(channel, None)
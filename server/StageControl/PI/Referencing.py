@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+import asyncio
+
+from server.StageControl.DataTypes import EventAnnouncer, ConfigurationUpdate
+from server.StageControl.PI.DataTypes import PIController, PIStage
+
+
+class ReferencingOrchestrator:
+    """
+    Takes PI stages through referencing. Referencing is started on each controller as soon as it is configured, so
+    several controllers reference at the same time, then only the referenced state (qFRF) of the axes still
+    referencing is polled until they finish or their deadline passes. Progress goes out as ConfigurationUpdates, and
+    the full status of a controller is only refreshed once, when all of its axes are done.
+    """
+
+    def __init__(self, EA: EventAnnouncer, interval: float = 0.2, timeout: float = 120):
+        """
+        :param EA: where the ConfigurationUpdates go
+        :param interval: seconds between polls
+        :param timeout: seconds an axis may take to reference before it is stopped
+        """
+        self.EA = EA
+        self.interval = interval
+        self.timeout = timeout
+        self.controllers: dict[int, PIController] = {}
+        """SN -> controllers with axes referencing"""
+        self.inflight: dict[int, dict[int, float]] = {}
+        """SN -> channel -> loop time by which it must be referenced"""
+        self.failed: dict[int, list[int]] = {}
+        """SN -> channels which did not finish referencing, reported once the controller is done"""
+        self.task: asyncio.Task | None = None
+
+    def busy(self, SN: int) -> bool:
+        """Whether the controller still has axes referencing"""
+        return SN in self.inflight
+
+    async def start(self, controller: PIController, stages: dict[str, PIStage], timeout: float | None = None) \
+            -> list[int]:
+        """
+        Start referencing the stages that want to be referenced and aren't yet, and keep an eye on them
+        :param controller: controller of the stages
+        :param stages: the stages as configured
+        :param timeout: seconds the axes may take, the orchestrator's timeout if None
+        :return: channels which started referencing. If none did, and the controller isn't referencing anything else,
+        the finished ConfigurationUpdate is sent before returning
+        """
+        SN = controller.config.SN
+        channels = await controller.startReferencing(stages)
+        if len(channels) == 0:
+            if not self.busy(SN):
+                # nothing to wait for, the configuration is done right away
+                self.controllers[SN] = controller
+                await self.finish(SN)
+            return []
+
+        deadline = asyncio.get_running_loop().time() + (self.timeout if timeout is None else timeout)
+        self.controllers[SN] = controller
+        self.inflight.setdefault(SN, {}).update({channel: deadline for channel in channels})
+        self.EA.event(ConfigurationUpdate(SN=SN, message=f"Referencing channels {sorted(self.inflight[SN])}"))
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        return channels
+
+    async def cancel(self, SN: int | None = None) -> list[int]:
+        """
+        Stop referencing, the axes stop where they are (STP)
+        :param SN: controller to stop, None for all of them
+        :return: SNs of the controllers stopped
+        """
+        SNs = list(self.inflight.keys()) if SN is None else [SN] if SN in self.inflight else []
+        for sn in SNs:
+            inflight = self.inflight.get(sn)
+            if inflight is None:
+                # finished while we were stopping another one
+                continue
+            channels = list(inflight.keys())
+            try:
+                await self.controllers[sn].haltReferencing()
+            except Exception as e:
+                print(f"Could not stop referencing of controller {sn}: {e}")
+            if self.inflight.get(sn) is not inflight:
+                # a check finished it while we were stopping it
+                continue
+            self.failed.setdefault(sn, []).extend(channels)
+            await self.finish(sn, f"Referencing of channels {channels} cancelled")
+        return SNs
+
+    async def run(self):
+        """Poll the controllers until nothing is referencing anymore"""
+        while len(self.inflight) > 0:
+            await asyncio.sleep(self.interval)
+            await asyncio.gather(*[self.check(SN) for SN in list(self.inflight.keys())])
+
+    async def check(self, SN: int):
+        """Ask the controller about the axes it's referencing, and deal with the finished and the late ones"""
+        channels = self.inflight.get(SN)
+        if channels is None:
+            # cancelled in the meantime
+            return
+        controller = self.controllers[SN]
+        try:
+            state = await controller.referencedState(list(channels.keys()))
+        except Exception as e:
+            if self.inflight.get(SN) is not channels:
+                return
+            self.failed.setdefault(SN, []).extend(channels.keys())
+            await self.finish(SN, f"Could not check referencing: {e}")
+            return
+        if self.inflight.get(SN) is not channels:
+            # cancelled while we were asking, that took care of everything
+            return
+
+        now = asyncio.get_running_loop().time()
+        done = [channel for channel in channels if state.get(channel)]
+        late = [channel for channel, deadline in channels.items() if not state.get(channel) and now > deadline]
+        for channel in done + late:
+            channels.pop(channel)
+
+        if len(late) > 0:
+            # failed before stopping them, so a cancel meanwhile reports them too
+            self.failed.setdefault(SN, []).extend(late)
+            try:
+                await controller.haltReferencing(late)
+            except Exception as e:
+                print(f"Could not stop referencing of controller {SN} channels {late}: {e}")
+            if self.inflight.get(SN) is not channels:
+                return
+            self.EA.event(ConfigurationUpdate(SN=SN, message=f"Channels {late} took too long referencing, stopped",
+                                              error=True))
+        if len(done) > 0:
+            self.EA.event(ConfigurationUpdate(SN=SN, message=f"Channels {done} referenced"))
+
+        if len(channels) == 0:
+            await self.finish(SN)
+
+    async def finish(self, SN: int, message: str | None = None):
+        """The controller is done referencing, refresh it once and say so. Only the first call does anything."""
+        self.inflight.pop(SN, None)
+        controller = self.controllers.pop(SN, None)
+        if controller is None:
+            return
+        failed = self.failed.pop(SN, [])
+        try:
+            await controller.refreshFullStatus()
+        except Exception as e:
+            message = f"{message or 'Referencing finished'}, but the status refresh failed: {e}"
+            failed = failed or [None]
+
+        if message is None:
+            message = "Ready" if len(failed) == 0 else f"Ready, channels {failed} not referenced"
+        self.EA.event(ConfigurationUpdate(SN=SN, message=message, configuration=controller.config.toPIAPI(),
+                                          finished=True, error=len(failed) > 0))
@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+from server.StageControl.DataTypes import ControllerInterface, EventAnnouncer, StageInfo, StageRemoved, Notice, \
+    Subscription
+
+
+class StageRoute:
+    """Where a stage lives"""
+
+    def __init__(self, interface: ControllerInterface):
+        self.interface = interface
+        """Controller interface the stage belongs to"""
+
+
+class StageRegistry:
+    """
+    Identifier -> where the stage lives, kept up to date from the StageInfo and StageRemoved events of the controller
+    interfaces, so finding a stage doesn't mean asking every interface for all of its stages. Keeps track of which
+    interfaces claim each identifier, so two interfaces handing out the same identifier (i.e. a virtual stage with
+    the SN of a PI controller channel) is noticed instead of moving whichever stage happens to be found first.
+    """
+
+    def __init__(self, EA: EventAnnouncer | None = None):
+        """
+        :param EA: where to announce identifier collisions
+        """
+        self.EA = EA
+        self.claims: dict[int, dict[ControllerInterface, StageRoute]] = {}
+        """identifier -> interface -> route, more than one interface means a collision"""
+        self.subscriptions: list[Subscription] = []
+
+    def watch(self, interface: ControllerInterface):
+        """Keep track of the stages of the interface, starting with the ones it has right now"""
+        sub = interface.EventAnnouncer.subscribe(StageInfo, StageRemoved)
+        sub.deliverTo(StageInfo, lambda info: self.add(interface, info))
+        sub.deliverTo(StageRemoved, lambda removed: self.remove(interface, removed.identifier))
+        self.subscriptions.append(sub)
+        try:
+            for info in interface.stageInfo.values():
+                self.add(interface, info)
+        except NotImplementedError:
+            pass
+
+    def add(self, interface: ControllerInterface, info: StageInfo):
+        claims = self.claims.setdefault(info.identifier, {})
+        collides = len(claims) > 0 and interface not in claims
+        claims[interface] = StageRoute(interface)
+        if collides:
+            message = f"Stage identifier {info.identifier} is used by {self.names(info.identifier)}, " \
+                      f"none of them can be moved until one is removed"
+            print(message)
+            if self.EA is not None:
+                self.EA.event(Notice(identifier=info.identifier, message=message))
+
+    def remove(self, interface: ControllerInterface, identifier: int):
+        claims = self.claims.get(identifier)
+        if claims is None:
+            return
+        claims.pop(interface, None)
+        if len(claims) == 0:
+            del self.claims[identifier]
+
+    def names(self, identifier: int) -> str:
+        return " and ".join(interface.name for interface in self.claims.get(identifier, {}))
+
+    def lookup(self, identifier: int) -> StageRoute | None:
+        """
+        Where the stage lives, None if no interface has told us about it
+        :raises Exception: if more than one interface uses the identifier
+        """
+        claims = self.claims.get(identifier)
+        if not claims:
+            return None
+        if len(claims) > 1:
+            raise Exception(f"Stage identifier {identifier} is used by {self.names(identifier)}")
+        return next(iter(claims.values()))
+
+    def close(self):
+        for sub in self.subscriptions:
+            sub.unsubscribe()
+        self.subscriptions = []
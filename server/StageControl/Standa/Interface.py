@@ -5,8 +5,9 @@ from typing import Awaitable
 import libximc.highlevel as ximc
 
 from server.Settings import SettingsVault
+from server.StageControl.DeviceIO import DevicePool
 from server.StageControl.DataTypes import ControllerInterface, StageStatus, StageInfo, \
-    updateResponse, Notice
+    updateResponse, Notice, MotionParameters, StageRemoved
 from server.StageControl.Standa.DataTypes import StandaStage, StandaConfiguration
 
 
@@ -17,16 +18,31 @@ class StandaInterface(ControllerInterface):
         self.ximcs: dict[int, ximc.Axis] = {}
         self._configs: dict[int, StandaConfiguration] = {}
         self.StandaSettings: dict[str, StandaStage] = {}
+        self.motion: dict[int, MotionParameters] = {}
+        """Calibrated speed and acceleration per device, read once per configuration"""
+        self.io = DevicePool("Standa")
+        """Threads libximc calls run on, one at a time per device, so homing doesn't hold up the loop"""
 
     @property
     def stages(self) -> list[int]:
         return list(self.stageInfo.keys())
 
     async def moveTo(self, identifier: int, position: float):
-        self.ximcs[identifier].command_move_calb(position)
+        await self.io.run(identifier, self.ximcs[identifier].command_move_calb, position)
 
     async def moveBy(self, identifier: int, step: float):
-        self.ximcs[identifier].command_movr_calb(step)
+        await self.io.run(identifier, self.ximcs[identifier].command_movr_calb, step)
+
+    async def stop(self, identifier: int):
+        # soft stop, decelerates instead of stopping dead
+        await self.io.run(identifier, self.ximcs[identifier].command_sstp)
+
+    async def motionParameters(self, identifier: int) -> MotionParameters | None:
+        if identifier not in self.motion:
+            settings = await self.io.run(identifier, self.ximcs[identifier].get_move_settings_calb)
+            self.motion[identifier] = MotionParameters(velocity=settings.Speed, acceleration=settings.Accel,
+                                                       deceleration=settings.Decel)
+        return self.motion[identifier]
 
     async def updateStageInfo(self, identifiers: list[int] = None):
         if identifiers is None:
@@ -52,18 +68,10 @@ class StandaInterface(ControllerInterface):
         return list(self._configs.values())
 
     async def loadStandaSettings(self):
-        SV = SettingsVault()
+        SV = SettingsVault.shared()
+        # only parsed again if the file changed
         await SV.load_all()
-        stageconfigs = {}
-        for key, item in dict(SV.readonly["StandaStages"]).items():
-            stageconfigs[key] = StandaStage(
-                Name=key,
-                Calibration=item["Calibration"],
-                MinMax=item["MinMax"],
-                Kind=item["Kind"]
-            )
-
-        self.StandaSettings = stageconfigs
+        self.StandaSettings = SV.catalog("StandaStages", StandaStage, key="Name")
 
     async def handleConfig(self, request: StandaConfiguration) -> updateResponse:
         """
@@ -73,9 +81,11 @@ class StandaInterface(ControllerInterface):
         """
         device = self.ximcs[request.SN]
         config = self._configs[request.SN]
-        status = None
-        try:
-            config.connected = False
+        # calibration might change, read the motion parameters again
+        self.motion.pop(request.SN, None)
+        calibration = self.StandaSettings[request.model].Calibration
+
+        def connect():
             # we have no way to check if we are currently connected (yippee)
             # so we try to get status, if we can't, then we are probably not connected.
             # incredible implementation by the team at ximc
@@ -86,10 +96,16 @@ class StandaInterface(ControllerInterface):
                 device.open_device()
 
             status = device.get_status()
+            # set calibration
+            device.set_calb(calibration, device.get_engine_settings().MicrostepMode)
+            return status
+
+        status = None
+        try:
+            config.connected = False
+            status = await self.io.run(request.SN, connect)
             # if we make it here we are connected
             config.connected = True
-            # set calibration
-            device.set_calb(self.StandaSettings[request.model].Calibration, device.get_engine_settings().MicrostepMode)
         except Exception as e:
             config.connected = False
             return updateResponse(
@@ -110,14 +126,36 @@ class StandaInterface(ControllerInterface):
             ))
             await asyncio.sleep(0.1)  # give some time for the request to send
             try:
-                device.command_homezero()
-                config.homed = True
+                config.homed = await self.home(request.SN)
             except:
                 # TODO error handling
                 config.homed = False
 
         return updateResponse(success=True, identifier=request.SN)
 
+    async def home(self, SN: int, interval: float = 0.1) -> bool:
+        """
+        Home the device and make that the zero position, like command_homezero. The device is only held for each
+        command and status check rather than the whole move, so it can still be stopped and polled while homing.
+        :param SN: serial number of the device
+        :param interval: seconds between status checks
+        :return: True if homed, False if the homing was stopped before it got there
+        """
+        device = self.ximcs[SN]
+        await self.io.run(SN, device.command_home)
+        while True:
+            await asyncio.sleep(interval)
+            status = await self.io.run(SN, device.get_status)
+            if not str(status.MvCmdSts).__contains__("MVCMD_RUNNING"):
+                break
+
+        # the last command is still the home one if nothing stopped it, and it didn't end in an error
+        moved = str(status.MvCmdSts)
+        if not moved.__contains__("MVCMD_HOME") or moved.__contains__("MVCMD_ERROR"):
+            return False
+        await self.io.run(SN, device.command_zero)
+        return True
+
     def addNewDevice(self, SN: int, model: str, devices: list[dict]):
         """Adds a new XIMC device along with an empty config to self.ximcs and self._configs"""
         for dev in devices:
@@ -140,7 +178,7 @@ class StandaInterface(ControllerInterface):
             await self.loadStandaSettings()
 
         # quickly probe for all connected ximc devices
-        devices = ximc.enumerate_devices(ximc.EnumerateFlags.ENUMERATE_PROBE)
+        devices = await self.io.call(ximc.enumerate_devices, ximc.EnumerateFlags.ENUMERATE_PROBE)
         awaiters: list[Awaitable[updateResponse]] = []
         # handle config change requests
         res: list[updateResponse] = []
@@ -156,13 +194,21 @@ class StandaInterface(ControllerInterface):
 
         # let's now do a full refresh before returning results
         await self.fullRefreshAllSettings()
+        # announce the configured stages, the refresh only does so if something changed
+        for response in res:
+            if response.success:
+                self.EventAnnouncer.event(self.stageInfo[response.identifier])
+                self.EventAnnouncer.event(self.stageStatus[response.identifier])
         return res
 
     async def removeConfiguration(self, SN: int):
         if self.ximcs.keys().__contains__(SN):
-            self.ximcs[SN].close_device()
+            await self.io.run(SN, self.ximcs[SN].close_device)
             del self.ximcs[SN]
             del self._configs[SN]
+            self.motion.pop(SN, None)
+            self.io.forget(SN)
+            self.EventAnnouncer.event(StageRemoved(identifier=SN))
             return True
         else:
             return False
@@ -216,7 +262,7 @@ class StandaInterface(ControllerInterface):
         })
 
         # TODO Include devices already connected to the interface, as they don't show up as available
-        for dev in ximc.enumerate_devices(ximc.EnumerateFlags.ENUMERATE_PROBE):
+        for dev in await self.io.call(ximc.enumerate_devices, ximc.EnumerateFlags.ENUMERATE_PROBE):
             sns.append({
                 "const": dev['device_serial'],
                 "title": dev['ControllerName']})
@@ -233,18 +279,18 @@ class StandaInterface(ControllerInterface):
         initialstageinfo = self.stageInfo[SN]
         initialstagestatus = self.stageStatus[SN]
 
-        status = None
+        device = self.ximcs[SN]
         newconfig = self._configs[SN]
         try:
-            status = self.ximcs[SN].get_status()
+            status, position = await self.io.run(SN, lambda: (device.get_status(), device.get_position_calb()))
             newconfig.connected = True
             if status.Flags.__contains__(ximc.StateFlags.STATE_IS_HOMED):
                 newconfig.homed = True
             else:
                 newconfig.homed = False
 
-            newconfig.ontarget = not str(self.ximcs[SN].get_status().MvCmdSts).__contains__("MVCMD_RUNNING")
-            newconfig.position = self.ximcs[SN].get_position_calb().Position
+            newconfig.ontarget = not str(status.MvCmdSts).__contains__("MVCMD_RUNNING")
+            newconfig.position = position.Position
 
         except:
             newconfig.connected = False
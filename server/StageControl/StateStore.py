@@ -0,0 +1,182 @@
+from __future__ import annotations
+
+import asyncio
+import uuid
+from typing import Any, Callable
+
+from pydantic import BaseModel, ConfigDict, Field
+
+from server.StageControl.DataTypes import ControllerInterface, EventAnnouncer, StageInfo, StageStatus, \
+    StageRemoved, Subscription
+
+
+class StageState(BaseModel):
+    """Everything we know about a stage at one version of the store. Never changed once made, a change makes a new
+    one."""
+    model_config = ConfigDict(frozen=True)
+
+    identifier: int = Field(description="Unique identifier for the stage")
+    version: int = Field(description="Version of the store this state was last changed in")
+    info: StageInfo | None = Field(default=None, description="Latest StageInfo, None if not announced yet")
+    status: StageStatus | None = Field(default=None, description="Latest StageStatus, None if not announced yet")
+
+
+class StageChanges(BaseModel):
+    """What changed in the store after a given version"""
+    epoch: str = Field(description="Which run of the server the version belongs to, send it back along with it")
+    version: int = Field(description="Version of the store these changes bring you up to")
+    stages: list[StageState] = Field(default=[], description="Stages which were added or changed")
+    removed: list[int] = Field(default=[], description="Identifiers of the stages which were removed")
+    complete: bool = Field(default=False, description="If true, stages holds every stage there is, and anything "
+                                                      "not in it should be dropped. Happens when asking from version "
+                                                      "0, or with the epoch of another run of the server")
+
+
+class StageStateStore:
+    """
+    Latest StageInfo and StageStatus of every stage, kept up to date from the events of the controller interfaces.
+    Reading from it never talks to a controller. Every change bumps a global version, so readers can ask for just
+    what changed since the version they saw last, or wait until something does.
+    """
+
+    def __init__(self, tombstones: int = 1000):
+        """
+        :param tombstones: how many removals to remember, callers from before the oldest one get everything instead
+        """
+        self.tombstones = tombstones
+        self.epoch: str = uuid.uuid4().hex
+        """Tells this run of the server apart from the others, versions only mean something along with it"""
+        self.version: int = 0
+        """Bumped by every change"""
+        self.stages: dict[int, StageState] = {}
+        """identifier -> current state. Replaced, never changed in place, hold on to it as long as you like"""
+        self.removed: dict[int, int] = {}
+        """identifier -> version in which the stage was removed, oldest first"""
+        self.forgotten: int = 0
+        """Version of the newest removal no longer in removed, callers from before it can't be told about it"""
+        self.subscriptions: list[Subscription] = []
+        self._views: dict[Callable, Any] = {}
+        """build function -> what it built from the current version, see view()"""
+        self._changed: asyncio.Event | None = None
+        """Set, then replaced, on the next change, for whoever is waiting on one"""
+
+    def watch(self, EA: EventAnnouncer):
+        """Keep up to date from the StageInfo, StageStatus and StageRemoved events of the announcer"""
+        sub = EA.subscribe(StageInfo, StageStatus, StageRemoved)
+        sub.deliverTo(StageInfo, self.updateInfo)
+        sub.deliverTo(StageStatus, self.updateStatus)
+        sub.deliverTo(StageRemoved, lambda removed: self.remove(removed.identifier))
+        self.subscriptions.append(sub)
+
+    def seed(self, interface: ControllerInterface):
+        """Take in the stages the interface has right now, for interfaces added after they announced them"""
+        for attribute, update in (("stageInfo", self.updateInfo), ("stageStatus", self.updateStatus)):
+            try:
+                for event in getattr(interface, attribute).values():
+                    update(event)
+            except NotImplementedError:
+                pass
+
+    def updateInfo(self, info: StageInfo):
+        current = self.stages.get(info.identifier)
+        if current is not None and current.info == info:
+            return
+        # a copy, the interfaces are free to keep changing the objects they emitted
+        self.store(info.identifier, info.model_copy(), None if current is None else current.status)
+
+    def updateStatus(self, status: StageStatus):
+        current = self.stages.get(status.identifier)
+        if current is not None and current.status == status:
+            return
+        self.store(status.identifier, None if current is None else current.info, status.model_copy())
+
+    def store(self, identifier: int, info: StageInfo | None, status: StageStatus | None):
+        self.bump()
+        # the values come from us, no need to validate them again
+        self.stages[identifier] = StageState.model_construct(identifier=identifier, version=self.version, info=info,
+                                                             status=status)
+        self.removed.pop(identifier, None)
+
+    def remove(self, identifier: int):
+        if identifier not in self.stages:
+            return
+        self.bump()
+        del self.stages[identifier]
+        self.removed[identifier] = self.version
+        if len(self.removed) > self.tombstones:
+            oldest = next(iter(self.removed))
+            self.forgotten = self.removed.pop(oldest)
+
+    def bump(self):
+        self.version += 1
+        self._views = {}
+        if self._changed is not None:
+            self._changed.set()
+            self._changed = None
+
+    def info(self, identifier: int) -> StageInfo | None:
+        state = self.stages.get(identifier)
+        return None if state is None else state.info
+
+    def status(self, identifier: int) -> StageStatus | None:
+        state = self.stages.get(identifier)
+        return None if state is None else state.status
+
+    def view(self, build: Callable[[dict[int, StageState]], Any]) -> Any:
+        """
+        What build makes of the current stages, made once per version and shared by every reader until the next
+        change, so don't modify it
+        :param build: function of identifier -> StageState, pass the same function every time
+        """
+        if build not in self._views:
+            self._views[build] = build(self.stages)
+        return self._views[build]
+
+    def current(self, since: int, epoch: str | None) -> bool:
+        """Whether the caller's version is one of ours, so we can tell what changed after it"""
+        return self.forgotten <= since <= self.version and since > 0 and epoch == self.epoch
+
+    def changes(self, since: int = 0, epoch: str | None = None) -> StageChanges:
+        """
+        What changed after the given version
+        :param since: the version the caller is at, 0 for everything
+        :param epoch: the epoch that version came with, everything is sent if it isn't ours
+        """
+        if not self.current(since, epoch):
+            # the caller knows nothing, or its version is from another run
+            return StageChanges(epoch=self.epoch, version=self.version, stages=list(self.stages.values()),
+                                complete=True)
+        return StageChanges(epoch=self.epoch, version=self.version,
+                            stages=[state for state in self.stages.values() if state.version > since],
+                            removed=[identifier for identifier, version in self.removed.items() if version > since])
+
+    async def wait(self, since: int, epoch: str | None, timeout: float | None = None) -> StageChanges:
+        """
+        Like changes, but if nothing changed after the given version yet, waits until something does
+        :param since: the version the caller is at
+        :param epoch: the epoch that version came with
+        :param timeout: seconds to wait at most, then the (empty) changes are returned anyway
+        """
+        if since == self.version and self.current(since, epoch):
+            if self._changed is None:
+                self._changed = asyncio.Event()
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.changes(since, epoch)
+
+    def close(self):
+        for sub in self.subscriptions:
+            sub.unsubscribe()
+        self.subscriptions = []
+
+
+def infoView(stages: dict[int, StageState]) -> dict[int, StageInfo]:
+    """identifier -> StageInfo, for StageStateStore.view"""
+    return {identifier: state.info for identifier, state in stages.items() if state.info is not None}
+
+
+def statusView(stages: dict[int, StageState]) -> dict[int, StageStatus]:
+    """identifier -> StageStatus, for StageStateStore.view"""
+    return {identifier: state.status for identifier, state in stages.items() if state.status is not None}
@@ -47,6 +47,7 @@ class VirtualSettings:
                     ))
                     # success, send an event update
                     self.EventAnnouncer.event(self.virtualstages[request.SN].stageInfo.toStageInfo())
+                    self.EventAnnouncer.event(self.virtualstages[request.SN].stageStatus)
             except Exception as e:
                 res.append(updateResponse(
                     identifier = request.SN,
@@ -107,8 +108,9 @@ class VirtualControllerInterface(ControllerInterface):
         super().__init__()
         self._settings:VirtualSettings = VirtualSettings()
         # forward events
-        sub = self.settings.EventAnnouncer.subscribe(StageInfo, StageRemoved)
+        sub = self.settings.EventAnnouncer.subscribe(StageInfo, StageStatus, StageRemoved)
         sub.deliverTo(StageInfo, self.EventAnnouncer.event)
+        sub.deliverTo(StageStatus, self.EventAnnouncer.event)
         sub.deliverTo(StageRemoved, self.EventAnnouncer.event)
 
     @property
@@ -134,12 +136,15 @@ class VirtualControllerInterface(ControllerInterface):
         self.settings.virtualstages[serial_number].stageStatus.ontarget = True
         self.EventAnnouncer.event(self.stageStatus[serial_number])
 
+    async def stop(self, identifier: int):
+        """Virtual stages arrive instantly, so there is nothing to stop"""
+        pass
+
     async def updateStageInfo(self, identifiers: list[int] = None):
         """Update stage info objects"""
         # loop through I cant be bothered
         for v in self.settings.virtualstages.values():
-            print("updatestageinfo sending rn")
-            self.EventAnnouncer.event(v.stageInfo)
+            self.EventAnnouncer.event(v.stageInfo.toStageInfo())
         return
 
     @property
@@ -1,9 +1,13 @@
+from contextlib import asynccontextmanager
+
 import uvicorn
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.openapi.utils import get_openapi
 from starlette.staticfiles import StaticFiles
 
 from .API import StageControlAPI, WebSocketAPI, GeometryAPI, KinematicsAPI, ConfigurationAPI
+from .Interface import toplevelinterface, PIinterface
+from .Settings import SettingsVault
 
 tags_metadata = [
     {
@@ -23,7 +27,21 @@ tags_metadata = [
         "description": "Calculate geometry, angles, offsets, etc..",
     }
 ]
-app = FastAPI(openapi_tags = tags_metadata)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Watch moving stages from a single task for as long as we're up
+    toplevelinterface.supervisor.start()
+    # and check the PI controllers are still there, apart from polling them
+    PIinterface.settings.startLiveness()
+    # keep the settings up to date in the background, so reading them never has to look at the disk
+    SettingsVault.shared().watch()
+    yield
+    await SettingsVault.shared().unwatch()
+    await PIinterface.settings.stopLiveness()
+    await toplevelinterface.supervisor.stop()
+    WebSocketAPI.websocketapi.shutdown()
+
+app = FastAPI(openapi_tags = tags_metadata, lifespan=lifespan)
 
 # settings routers
 app.include_router(ConfigurationAPI.router)
@@ -48,6 +66,27 @@ def custom_openapi():
     openapi_schema["paths"]["/ws/"] = {
         "get": {
             "summary": "WebSocket connection, obviously use ws://",
+            "parameters": [{
+                "name": "encoding",
+                "in": "query",
+                "required": False,
+                "description": "json (default), or binary to receive StageStatus events as packed 26 byte frames",
+                "schema": {"type": "string", "enum": [e.value for e in WebSocketAPI.Encoding]},
+            }, {
+                "name": "since",
+                "in": "query",
+                "required": False,
+                "description": "seq of the last event received before reconnecting, to get only the missed events "
+                               "instead of a snapshot",
+                "schema": {"type": "integer"},
+            }, {
+                "name": "epoch",
+                "in": "query",
+                "required": False,
+                "description": "epoch of the last snapshot received, needed along with since. A snapshot is sent "
+                               "instead if it isn't the server's, i.e. after a restart",
+                "schema": {"type": "string"},
+            }],
             "responses": {200: {"description": "WebSocket"}},
             # Find a way to add the websocket schema here
         }
@@ -57,8 +96,17 @@ def custom_openapi():
 
 @app.websocket("/ws/")
 async def websocket_endpoint(websocket: WebSocket):
+    # The client chooses the encoding when connecting, json unless told otherwise, and may resume where it left off
+    try:
+        encoding = WebSocketAPI.Encoding(websocket.query_params.get("encoding", "json"))
+        since = websocket.query_params.get("since")
+        since = None if since is None else int(since)
+        epoch = websocket.query_params.get("epoch")
+    except ValueError:
+        await websocket.close(code=1008, reason="unknown encoding or invalid since")
+        return
     # Add to WS manager
-    await wsmanager.connect(websocket)
+    await wsmanager.connect(websocket, encoding, since, epoch)
     # Wait for new data
     while True:
         try:
@@ -71,11 +119,10 @@ async def websocket_endpoint(websocket: WebSocket):
             print("Disconnected")
             break
         except Exception as e:
-            res = {
-                "response": "error",
-                "error": str(e)
-            }
-            await websocket.send_json(res)
+            # answered in order with everything else queued for the client, unless it was dropped meanwhile
+            if not wsmanager.reject(websocket, e):
+                print("Dropped")
+                break
 
 app.openapi = custom_openapi
 
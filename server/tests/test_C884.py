@@ -0,0 +1,217 @@
+import asyncio
+import os
+from pathlib import Path
+from unittest import TestCase, IsolatedAsyncioTestCase
+
+from pipython import GCSError
+
+from server.StageControl.DataTypes import StageStatus, ConfigurationUpdate
+from server.StageControl.PI.C884 import StaticParameters, C884
+from server.StageControl.PI.DataTypes import PIConfiguration, PIControllerModel, PIConnectionType, PIStage
+from server.StageControl.PI.Emulator import GCSEmulator, EmulatedStage, travelled
+
+
+class TestStaticParameters(TestCase):
+
+    def setUp(self):
+        self.static = StaticParameters()
+        self.asked: list[list[str]] = []
+
+    def qCST(self, axes: list[str]) -> dict[str, str]:
+        self.asked.append(axes)
+        return {axis: f"stage {axis}" for axis in axes}
+
+    def test_only_asks_about_unknown_axes(self):
+        self.assertEqual({"1": "stage 1", "2": "stage 2"}, self.static.get("CST", self.qCST, ["1", "2"]))
+        self.assertEqual({"2": "stage 2", "3": "stage 3"}, self.static.get("CST", self.qCST, ["2", "3"]))
+        self.assertEqual({"1": "stage 1"}, self.static.get("CST", self.qCST, ["1"]))
+        self.assertEqual([["1", "2"], ["3"]], self.asked)
+
+    def test_invalidate(self):
+        self.static.get("CST", self.qCST, ["1"])
+        self.assertEqual(["a"], self.static.once("VST", lambda: ["a"]))
+        self.assertEqual(["a"], self.static.once("VST", lambda: ["b"]))
+
+        self.static.invalidate()
+        self.static.get("CST", self.qCST, ["1"])
+        self.assertEqual([["1"], ["1"]], self.asked)
+        self.assertEqual(["b"], self.static.once("VST", lambda: ["b"]))
+
+
+class TestEmulatorMotion(TestCase):
+
+    def test_trapezoid(self):
+        # 1 s up to speed over 5, cruise 90 in 9 s, 1 s back down over 5
+        self.assertEqual((100, 11), travelled(100, 10, 10, 20))
+        self.assertEqual((5, 11), travelled(100, 10, 10, 1))
+        self.assertEqual((55, 11), travelled(100, 10, 10, 6))
+        self.assertEqual((0, 11), travelled(100, 10, 10, 0))
+
+    def test_triangle(self):
+        # never gets up to speed, 1 s up and 1 s down
+        covered, duration = travelled(10, 100, 10, 1)
+        self.assertAlmostEqual(2, duration)
+        self.assertAlmostEqual(5, covered)
+
+
+class TestC884Emulated(IsolatedAsyncioTestCase):
+    """The real driver against the emulator"""
+
+    SN = 118071328
+
+    async def asyncSetUp(self):
+        # stage data is read from the settings in the server directory
+        self.cwd = os.getcwd()
+        os.chdir(Path(__file__).parents[1])
+        self.emulator = GCSEmulator(SN=self.SN, turnaround=0, errcheck=False, stages={
+            "L-406.20DD10": EmulatedStage(velocity=100, acceleration=1000, referencing=0.1)})
+        self.c884 = C884(device=self.emulator)
+        self.stages = {"1": PIStage(channel=1, device="L-406.20DD10", clo=True, referenced=True),
+                       "2": PIStage(channel=2, device="L-406.20DD10", clo=True, referenced=True)}
+        await self.c884.updateFromConfig(PIConfiguration(
+            SN=self.SN,
+            model=PIControllerModel.C884,
+            connection_type=PIConnectionType.usb,
+            stages=self.stages
+        ))
+
+    async def asyncTearDown(self):
+        self.c884.shutdown_and_cleanup()
+        os.chdir(self.cwd)
+
+    async def reference(self):
+        self.assertEqual([1, 2], await self.c884.startReferencing(self.stages))
+        self.assertEqual({1: False, 2: False}, await self.c884.referencedState([1, 2]))
+        await asyncio.sleep(0.15)
+        self.assertEqual({1: True, 2: True}, await self.c884.referencedState([1, 2]))
+
+    async def test_configured(self):
+        config = self.c884.config
+        self.assertTrue(config.connected)
+        self.assertEqual(4, config.channel_amount)
+        self.assertEqual(["1", "2"], list(config.stages.keys()))
+        self.assertTrue(config.stages["1"].clo)
+        self.assertFalse(config.stages["1"].referenced)
+        self.assertEqual([0, 200], config.stages["1"].min_max)
+        # not referenced, so not usable yet
+        self.assertEqual({}, self.c884.stageInfos)
+
+    async def test_move_needs_reference(self):
+        with self.assertRaises(GCSError) as error:
+            await self.c884.moveTo(1, 10)
+        self.assertEqual(5, error.exception.val)
+
+    async def test_move(self):
+        await self.reference()
+        await self.c884.refreshFullStatus()
+        self.assertIn(self.SN * 10 + 1, self.c884.stageInfos)
+
+        await self.c884.moveTo(1, 20)
+        await self.c884.refreshPosOnTarget()
+        self.assertFalse(self.c884.config.stages["1"].on_target)
+        await asyncio.sleep(0.35)
+        await self.c884.refreshPosOnTarget()
+        self.assertTrue(self.c884.config.stages["1"].on_target)
+        self.assertAlmostEqual(20, self.c884.config.stages["1"].position)
+        # the status handed out matches the live record
+        status = self.c884.stageStatuses[self.SN * 10 + 1]
+        self.assertAlmostEqual(20, status.position)
+        self.assertTrue(status.ontarget and status.connected and status.ready)
+        self.assertEqual(1, self.c884.stageInfos[self.SN * 10 + 1].channel)
+
+        with self.assertRaises(GCSError) as error:
+            await self.c884.moveTo(1, 500)
+        self.assertEqual(7, error.exception.val)
+
+    async def test_halt_referencing(self):
+        await self.c884.startReferencing(self.stages)
+        await self.c884.haltReferencing()
+        self.assertEqual("10", await self.c884.error)
+        await asyncio.sleep(0.15)
+        self.assertEqual({1: False, 2: False}, await self.c884.referencedState([1, 2]))
+
+    async def test_move_many(self):
+        await self.reference()
+        self.emulator.exchanges = 0
+        await self.c884.moveToMany({1: 10, 2: 20})
+        # a single MOV for both
+        self.assertEqual(1, self.emulator.exchanges)
+        await asyncio.sleep(0.35)
+        await self.c884.refreshPosOnTarget()
+        self.assertEqual([10, 20], [stage.position for stage in self.c884.config.stages.values()])
+
+        # refused as a whole
+        with self.assertRaises(GCSError):
+            await self.c884.moveToMany({1: 30, 2: 500})
+        await self.c884.refreshPosOnTarget()
+        self.assertEqual([10, 20], [stage.position for stage in self.c884.config.stages.values()])
+
+    async def test_poll_traffic(self):
+        self.emulator.exchanges = 0
+        await self.c884.refreshPosOnTarget()
+        # POS? and ONT?
+        self.assertEqual(2, self.emulator.exchanges)
+
+        self.emulator.exchanges = 0
+        await self.c884.refreshFullStatus()
+        # FRF? and SVO? on top, stage names and ranges are known
+        self.assertEqual(4, self.emulator.exchanges)
+
+        self.emulator.exchanges = 0
+        await self.c884.refreshFullStatus(invalidate_cache=True)
+        self.assertEqual(7, self.emulator.exchanges)
+
+    async def test_status_of_configured_axes_only(self):
+        # channels 3 and 4 of the controller have no stage configured
+        await self.reference()
+        await self.c884.refreshFullStatus()
+        self.emulator.exchanges = 0
+        self.emulator.sent = []
+        await self.c884.refreshPosOnTarget()
+        self.assertEqual(2, self.emulator.exchanges)
+        self.assertEqual(["POS? 1 2", "ONT? 1 2"], self.emulator.sent)
+
+        # asked for a single axis, the others aren't queried either
+        self.emulator.sent = []
+        readout = await self.c884.run(self.c884.readStatus, ["2"], True)
+        self.assertEqual(["2"], list(readout.keys()))
+        self.assertEqual(["position", "on_target", "referenced", "clo", "device", "minimum", "maximum"],
+                         list(readout["2"].keys()))
+        self.assertEqual(["POS? 2", "ONT? 2", "FRF? 2", "SVO? 2"], self.emulator.sent)
+
+        # and nothing at all for no axes
+        self.emulator.exchanges = 0
+        self.assertEqual({}, await self.c884.run(self.c884.readStatus, []))
+        self.assertEqual(0, self.emulator.exchanges)
+
+    async def test_config_is_shared_until_a_change(self):
+        config = self.c884.config
+        self.assertIs(config, self.c884.config)
+        await self.c884.refreshPosOnTarget()
+        self.assertIsNot(config, self.c884.config)
+
+    async def test_lost_connection(self):
+        await self.reference()
+        await self.c884.refreshFullStatus()
+        updates = []
+        sub = self.c884.EA.subscribe(StageStatus, ConfigurationUpdate)
+        sub.deliverTo(StageStatus, updates.append)
+        sub.deliverTo(ConfigurationUpdate, updates.append)
+
+        self.assertTrue(await self.c884.checkLiveness())
+        self.assertEqual([], updates)
+
+        # unplugged, noticed by the next command
+        self.emulator.CloseConnection()
+        with self.assertRaises(GCSError):
+            await self.c884.refreshPosOnTarget()
+        self.assertFalse(self.c884.config.connected)
+        self.assertFalse(self.c884.config.ready)
+        self.assertTrue(updates[0].error)
+        self.assertEqual([False, False], [status.connected for status in updates[1:]])
+
+        # and back, noticed by the liveness check
+        self.emulator.open(None)
+        self.assertTrue(await self.c884.checkLiveness())
+        self.assertTrue(self.c884.config.connected)
+        sub.unsubscribe()
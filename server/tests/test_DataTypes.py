@@ -1,7 +1,9 @@
-from unittest import TestCase
+import asyncio
+from unittest import TestCase, IsolatedAsyncioTestCase
 from unittest.mock import MagicMock
 
-from server.StageControl.DataTypes import EventAnnouncer
+from server.StageControl.DataTypes import EventAnnouncer, StageStatus, DeliveryPolicy, Notice, \
+    Conflator, StageRemoved
 
 
 class TestEventAnnouncer(TestCase):
@@ -50,5 +52,200 @@ class TestEventAnnouncer(TestCase):
         destination.assert_called_with(msg)
 
 
+    def test_keyed_delivery(self):
+        EA = EventAnnouncer("EA3", StageStatus)
+        everything = MagicMock()
+        onlyone = MagicMock()
+
+        sub = EA.subscribe(StageStatus)
+        sub.deliverTo(StageStatus, everything)
+        sub.deliverTo(StageStatus, onlyone, key=4250030443)
+
+        other = StageStatus(identifier=4250030441)
+        mine = StageStatus(identifier=4250030443)
+        EA.event(other)
+        EA.event(mine)
+
+        assert everything.call_count == 2
+        onlyone.assert_called_once_with(mine)
+
+    def test_subscribe_after_event(self):
+        # the dispatch table must pick up subscriptions made after it was built
+        EA = EventAnnouncer("EA4", int)
+        EA.event(1)
+        destination = MagicMock()
+        EA.subscribe(int).deliverTo(int, destination)
+        EA.event(2)
+        destination.assert_called_once_with(2)
+
+    def test_patch_through_is_flattened(self):
+        # producer -> middle -> last -> destination
+        producer = EventAnnouncer("producer", StageStatus)
+        middle = EventAnnouncer("middle", StageStatus)
+        last = EventAnnouncer("last", StageStatus)
+        middle.patch_through_from([StageStatus], producer)
+        last.patch_through_from([StageStatus], middle)
+
+        destination = MagicMock()
+        last.subscribe(StageStatus).deliverTo(StageStatus, destination)
+
+        status = StageStatus(identifier=11)
+        producer.event(status)
+        destination.assert_called_once_with(status)
+        # the producer calls the destination directly, skipping the forwarding hops
+        assert producer._dispatch[StageStatus][None] == [destination]
+
+        # subscribing further down the chain rebuilds the producer's routes
+        late = MagicMock()
+        last.subscribe(StageStatus).deliverTo(StageStatus, late, key=11)
+        producer.event(status)
+        late.assert_called_once_with(status)
+        assert destination.call_count == 2
+
+    def test_exact_type_only(self):
+        class SpecialStatus(StageStatus):
+            pass
+
+        producer = EventAnnouncer("producer", StageStatus)
+        last = EventAnnouncer("last", StageStatus)
+        last.patch_through_from([StageStatus], producer)
+        destination = MagicMock()
+        last.subscribe(StageStatus).deliverTo(StageStatus, destination)
+
+        # subscribers of StageStatus get StageStatus, not whatever a producer derived from it
+        producer.event(SpecialStatus(identifier=11))
+        destination.assert_not_called()
+        status = StageStatus(identifier=11)
+        producer.event(status)
+        destination.assert_called_once_with(status)
+
+
 class TestSubscription(TestCase):
     pass
+
+
+class TestEventQueue(IsolatedAsyncioTestCase):
+
+    async def test_conflate(self):
+        EA = EventAnnouncer("EA5", StageStatus)
+        received = []
+
+        async def slow(status: StageStatus):
+            received.append(status)
+
+        sub = EA.subscribe(StageStatus)
+        sub.deliverTo(StageStatus, slow)
+        sub.queued(maxsize=4, policies={StageStatus: DeliveryPolicy.conflate})
+
+        # a burst of updates for two stages, the producer does not wait on the consumer
+        for i in range(100):
+            EA.event(StageStatus(identifier=1, position=i))
+            EA.event(StageStatus(identifier=2, position=i))
+        await asyncio.sleep(0)
+
+        # only the latest status per stage is delivered
+        assert [(s.identifier, s.position) for s in received] == [(1, 99), (2, 99)]
+
+    async def test_drop_and_block(self):
+        EA = EventAnnouncer("EA6", Notice)
+        received = []
+        sub = EA.subscribe(Notice)
+        sub.deliverTo(Notice, received.append)
+        queue = sub.queued(maxsize=2, policies={Notice: DeliveryPolicy.block})
+
+        # plain events cannot block, the oldest one is dropped
+        for i in range(3):
+            EA.event(Notice(message=str(i)))
+        assert queue.dropped == 1
+
+        # publish waits for the worker to make room instead
+        for i in range(3, 6):
+            await EA.publish(Notice(message=str(i)))
+        await asyncio.sleep(0)
+        assert [n.message for n in received] == ["1", "2", "3", "4", "5"]
+        assert queue.dropped == 1
+        sub.unsubscribe()
+
+    async def test_publish_waits_for_room(self):
+        EA = EventAnnouncer("EA7", Notice)
+        received = []
+        release = asyncio.Event()
+
+        async def slow(notice: Notice):
+            await release.wait()
+            received.append(notice)
+
+        sub = EA.subscribe(Notice)
+        sub.deliverTo(Notice, slow)
+        queue = sub.queued(maxsize=1, policies={Notice: DeliveryPolicy.block})
+        EA.event(Notice(message="0"))
+        await asyncio.sleep(0)
+        # the worker is stuck delivering 0, 1 fills the queue
+        await EA.publish(Notice(message="1"))
+        publishing = asyncio.ensure_future(EA.publish(Notice(message="2")))
+        await asyncio.sleep(0.01)
+        assert not publishing.done()
+
+        release.set()
+        await asyncio.wait_for(publishing, 1)
+        await asyncio.sleep(0)
+        assert [n.message for n in received] == ["0", "1", "2"]
+        assert queue.dropped == 0
+        sub.unsubscribe()
+
+
+class TestEventQueueLoops(TestCase):
+
+    def test_moves_to_new_loop(self):
+        EA = EventAnnouncer("EA8", Notice)
+        received = []
+        sub = EA.subscribe(Notice)
+        sub.deliverTo(Notice, received.append)
+        queue = sub.queued()
+
+        async def announce(*messages: str):
+            for message in messages:
+                EA.event(Notice(message=message))
+                # the worker waits for the next one in between, on a queue of this loop
+                await asyncio.sleep(0.01)
+                assert not queue.worker.done()
+
+        # i.e. one test's event loop after another's
+        asyncio.run(announce("first"))
+        asyncio.run(announce("second", "third"))
+        assert [n.message for n in received] == ["first", "second", "third"]
+        sub.unsubscribe()
+
+
+class TestConflator(IsolatedAsyncioTestCase):
+
+    async def test_window(self):
+        received = []
+        conflator = Conflator(received.append, window=0.01)
+
+        for i in range(10):
+            conflator(StageStatus(identifier=1, position=i))
+            conflator(StageStatus(identifier=2, position=0))
+        # the first of each right away, without waiting for the window
+        assert [(s.identifier, s.position) for s in received] == [(1, 0), (2, 0)]
+
+        # then only the newest of the rest, once it closes
+        await asyncio.sleep(0.05)
+        assert [(s.identifier, s.position) for s in received[2:]] == [(1, 9)]
+
+        # exact duplicates are dropped, even when the producer mutates and re-sends the same object
+        status = received[2]
+        conflator(StageStatus(identifier=2, position=0))
+        status.position = 10
+        conflator(status)
+        await asyncio.sleep(0.05)
+        assert [(s.identifier, s.position) for s in received[3:]] == [(1, 10)]
+
+    def test_without_window(self):
+        received = []
+        conflator = Conflator(received.append, window=0)
+        conflator(StageStatus(identifier=1))
+        conflator(StageStatus(identifier=1))
+        conflator(StageRemoved(identifier=1))
+        conflator(StageStatus(identifier=1))
+        assert [type(e) for e in received] == [StageStatus, StageRemoved, StageStatus]
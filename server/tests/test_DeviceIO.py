@@ -0,0 +1,118 @@
+import asyncio
+import threading
+import time
+from unittest import IsolatedAsyncioTestCase
+
+from server.StageControl.DeviceIO import DeviceWorker, DevicePool
+
+
+class SlowDevice:
+    """Blocking device which complains if it is talked to from two threads at once"""
+
+    def __init__(self, delay: float = 0.05):
+        self.delay = delay
+        self.busy = threading.Lock()
+        self.calls: list[str] = []
+        self.threads: set[str] = set()
+
+    def query(self, name: str) -> str:
+        if not self.busy.acquire(blocking=False):
+            raise Exception("device talked to concurrently")
+        try:
+            self.threads.add(threading.current_thread().name)
+            time.sleep(self.delay)
+            self.calls.append(name)
+            return name
+        finally:
+            self.busy.release()
+
+    def broken(self):
+        raise Exception("serial port on fire")
+
+
+class TestDeviceWorker(IsolatedAsyncioTestCase):
+
+    async def test_calls_to_one_device_are_serialized(self):
+        device = SlowDevice()
+        worker = DeviceWorker("slow")
+        try:
+            results = await asyncio.gather(*[worker.run(device.query, f"q{i}") for i in range(4)])
+            self.assertEqual(["q0", "q1", "q2", "q3"], results)
+            self.assertEqual(results, device.calls)
+            self.assertEqual(1, len(device.threads))
+            self.assertTrue(next(iter(device.threads)).startswith("device-slow"))
+        finally:
+            worker.shutdown()
+
+    async def test_devices_run_in_parallel_without_blocking_the_loop(self):
+        devices = [SlowDevice(0.2) for _ in range(3)]
+        workers = [DeviceWorker(str(i)) for i in range(3)]
+        loop = asyncio.get_running_loop()
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticking = asyncio.create_task(ticker())
+        try:
+            start = loop.time()
+            await asyncio.gather(*[worker.run(device.query, "q") for worker, device in zip(workers, devices)])
+            self.assertLess(loop.time() - start, 0.5)
+            self.assertGreater(ticks, 3)
+        finally:
+            ticking.cancel()
+            for worker in workers:
+                worker.shutdown()
+
+    async def test_exceptions_reach_the_caller(self):
+        worker = DeviceWorker("broken")
+        try:
+            with self.assertRaises(Exception):
+                await worker.run(SlowDevice().broken)
+        finally:
+            worker.shutdown()
+
+    async def test_shutdown_runs_last_call_after_queued_ones(self):
+        device = SlowDevice()
+        worker = DeviceWorker("closing")
+        queued = asyncio.ensure_future(worker.run(device.query, "q"))
+        await asyncio.sleep(0)
+        closed = threading.Event()
+        worker.shutdown(lambda: (device.calls.append("close"), closed.set()))
+        await queued
+        await asyncio.get_running_loop().run_in_executor(None, closed.wait, 1)
+        self.assertEqual(["q", "close"], device.calls)
+
+
+class TestDevicePool(IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.pool = DevicePool("test", workers=4)
+
+    async def asyncTearDown(self):
+        self.pool.shutdown()
+
+    async def test_devices_run_side_by_side(self):
+        devices = {SN: SlowDevice(0.2) for SN in range(4)}
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await asyncio.gather(*[self.pool.run(SN, device.query, "q") for SN, device in devices.items()])
+        # about the slowest one, not the sum
+        self.assertLess(loop.time() - start, 0.6)
+
+    async def test_calls_to_one_device_wait_for_each_other(self):
+        device = SlowDevice()
+        results = await asyncio.gather(*[self.pool.run(1, device.query, f"q{i}") for i in range(4)])
+        self.assertEqual(["q0", "q1", "q2", "q3"], results)
+
+    async def test_cancelled_call_keeps_the_device_until_done(self):
+        device = SlowDevice(0.2)
+        first = asyncio.ensure_future(self.pool.run(1, device.query, "first"))
+        await asyncio.sleep(0.05)
+        first.cancel()
+        # would raise if it got to the device while the first call is still running
+        self.assertEqual("second", await self.pool.run(1, device.query, "second"))
+        self.assertEqual(["first", "second"], device.calls)
@@ -0,0 +1,237 @@
+import asyncio
+import gc
+from unittest import IsolatedAsyncioTestCase, TestCase
+
+from server.StageControl.DataTypes import ControllerInterface, StageStatus, StageInfo, MotionParameters, \
+    EventAnnouncer, Notice
+from server.StageControl.MotionSupervisor import MotionSupervisor, MoveEstimator
+from server.StageControl.Registry import StageRegistry
+
+
+class FakeInterface(ControllerInterface):
+    """Stages which reach their target after a number of polls"""
+
+    def __init__(self, polls_until_on_target: dict[int, int]):
+        super().__init__()
+        self.remaining = polls_until_on_target
+        self.polls: list[list[int]] = []
+        self.listed = 0
+
+    @property
+    def stages(self) -> list[int]:
+        self.listed += 1
+        return list(self.remaining.keys())
+
+    async def updateStageStatus(self, identifiers: list[int] = None):
+        self.polls.append(sorted(identifiers))
+        for identifier in identifiers:
+            self.remaining[identifier] -= 1
+
+    @property
+    def stageStatus(self) -> dict[int, StageStatus]:
+        return {identifier: StageStatus(identifier=identifier, ontarget=remaining <= 0)
+                for identifier, remaining in self.remaining.items()}
+
+
+class TimedInterface(FakeInterface):
+    """Stages which reach their target at a given loop time"""
+
+    def __init__(self, arrivals: dict[int, float]):
+        super().__init__({identifier: 1 for identifier in arrivals})
+        self.arrivals = arrivals
+        self.times: list[float] = []
+
+    async def updateStageStatus(self, identifiers: list[int] = None):
+        self.times.append(asyncio.get_running_loop().time())
+        await super().updateStageStatus(identifiers)
+
+    @property
+    def stageStatus(self) -> dict[int, StageStatus]:
+        now = asyncio.get_running_loop().time()
+        return {identifier: StageStatus(identifier=identifier, ontarget=now >= arrival)
+                for identifier, arrival in self.arrivals.items()}
+
+
+class BrokenInterface(FakeInterface):
+
+    async def updateStageStatus(self, identifiers: list[int] = None):
+        raise Exception("serial port on fire")
+
+
+class UnlistableInterface(FakeInterface):
+
+    @property
+    def stages(self) -> list[int]:
+        raise Exception("lost track of its stages")
+
+
+class StatuslessInterface(FakeInterface):
+
+    @property
+    def stageStatus(self) -> dict[int, StageStatus]:
+        raise Exception("status went missing")
+
+
+class TestMotionSupervisor(IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.a = FakeInterface({1: 1, 2: 3})
+        self.b = FakeInterface({3: 2})
+        self.supervisor = MotionSupervisor([self.a, self.b], interval=0.01)
+
+    async def asyncTearDown(self):
+        await self.supervisor.stop()
+
+    async def settle(self):
+        for _ in range(100):
+            if len(self.supervisor.watched) == 0:
+                return
+            await asyncio.sleep(0.01)
+
+    async def test_one_poll_per_interface_per_tick(self):
+        # watching repeatedly, i.e. ten quick jogs, doesn't add pollers
+        for _ in range(10):
+            self.supervisor.watch([1, 2, 3])
+        await self.settle()
+
+        assert self.supervisor.watched == set()
+        # stages drop out as they reach their target
+        assert self.a.polls == [[1, 2], [2], [2]]
+        assert self.b.polls == [[3], [3]]
+
+    async def test_forgets_unknown_and_failing(self):
+        broken = BrokenInterface({4: 1})
+        self.supervisor.interfaces.append(broken)
+        self.supervisor.watch([404, 4])
+        await self.settle()
+        assert self.supervisor.watched == set()
+
+    async def test_stop(self):
+        self.supervisor.watch([2])
+        task = self.supervisor.task
+        await self.supervisor.stop()
+        assert task.cancelled()
+        assert self.supervisor.watched == set()
+        # it can be started again
+        self.supervisor.watch([1])
+        await self.settle()
+        assert self.supervisor.watched == set()
+
+    async def test_until_on_target(self):
+        # several waiters on the same stage share the one poll per tick
+        first, second = await asyncio.gather(self.supervisor.untilOnTarget([1, 2]), self.supervisor.untilOnTarget([2]))
+        assert first == {1: True, 2: True} and second == {2: True}
+        assert self.a.polls == [[1, 2], [2], [2]]
+
+    async def test_until_on_target_timeout(self):
+        with self.assertRaises(asyncio.TimeoutError):
+            await self.supervisor.untilOnTarget([2], timeout=0.015)
+        # the stage is still watched, and others can still wait for it
+        assert await self.supervisor.untilOnTarget([2]) == {2: True}
+
+    async def test_until_on_target_stopped_or_gone(self):
+        waiting = asyncio.ensure_future(self.supervisor.untilOnTarget([2]))
+        await asyncio.sleep(0)
+        self.supervisor.unwatch([2])
+        assert await waiting == {2: False}
+
+        with self.assertRaises(Exception):
+            await self.supervisor.untilOnTarget([404])
+
+        waiting = asyncio.ensure_future(self.supervisor.untilOnTarget([3]))
+        await asyncio.sleep(0)
+        await self.supervisor.stop()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+
+    async def test_error_after_waiters_left(self):
+        errors = []
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context))
+        broken = BrokenInterface({4: 1})
+        self.supervisor.interfaces.append(broken)
+        with self.assertRaises(asyncio.TimeoutError):
+            await self.supervisor.untilOnTarget([4], timeout=0)
+        await self.settle()
+        gc.collect()
+        # nobody was left to be told it failed, which isn't worth complaining about
+        assert errors == []
+        assert 4 not in self.supervisor.arrivals
+
+    async def test_located_through_registry(self):
+        registry = StageRegistry()
+        registry.add(self.a, StageInfo(model="v", identifier=2))
+        supervisor = MotionSupervisor([self.a, self.b], interval=0.01, registry=registry)
+        assert await supervisor.untilOnTarget([2]) == {2: True}
+        # found without asking the interfaces for their stages
+        assert self.a.polls == [[2], [2], [2]]
+        assert self.a.listed == 0 and self.b.listed == 0
+        # only for the ones nobody announced
+        assert await supervisor.untilOnTarget([3]) == {3: True}
+        assert self.b.listed > 0
+        await supervisor.stop()
+
+    async def test_survives_failing_tick(self):
+        EA = EventAnnouncer("main", Notice)
+        notices: list[Notice] = []
+        EA.subscribe(Notice).deliverTo(Notice, notices.append)
+        for broken in (StatuslessInterface({5: 1}), UnlistableInterface({5: 1})):
+            supervisor = MotionSupervisor([broken], interval=0.01, EA=EA)
+            # told it failed, rather than waiting forever
+            with self.assertRaises(Exception):
+                await asyncio.wait_for(supervisor.untilOnTarget([5]), 1)
+            self.assertFalse(supervisor.task.done())
+            self.assertEqual(5, notices[-1].identifier)
+            await supervisor.stop()
+        self.assertEqual(2, len(notices))
+
+
+class TestMoveEstimator(TestCase):
+
+    def test_profile(self):
+        parameters = MotionParameters(velocity=10, acceleration=100)
+        # 0.1s up to speed over 0.5mm, 1s at speed, 0.1s back down
+        assert abs(MoveEstimator.profileDuration(11, parameters) - 1.2) < 1e-9
+        # never gets up to speed
+        assert abs(MoveEstimator.profileDuration(-0.25, parameters) - 0.1) < 1e-9
+
+    def test_learn(self):
+        estimator = MoveEstimator(smoothing=0.5)
+        estimator.learn(1, profile=1, observed=2)
+        assert estimator.corrections[1] == 1.5
+        # an upper bound only ever makes the prediction shorter
+        estimator.learn(1, profile=1, observed=3, upperBound=True)
+        assert estimator.corrections[1] == 1.5
+        estimator.learn(1, profile=1, observed=0.1, upperBound=True)
+        assert estimator.corrections[1] == 1
+        assert estimator.predict(1, 11, MotionParameters(velocity=10, acceleration=100)) == (1.2, 1.2)
+
+
+class TestExpectedMoves(IsolatedAsyncioTestCase):
+
+    async def test_polls_around_arrival(self):
+        loop = asyncio.get_running_loop()
+        # takes 30% longer than the profile says
+        stage = TimedInterface({1: loop.time() + 0.13})
+        supervisor = MotionSupervisor([stage], interval=0.01, dense=0.01, lead=0.02, progress=None)
+        supervisor.expect(1, 1, MotionParameters(velocity=10, acceleration=1000))
+        assert await supervisor.untilOnTarget([1], timeout=2) == {1: True}
+
+        # nothing until shortly before the predicted 0.1s, then densely until it's there
+        assert 1 < len(stage.polls) < 6
+        assert supervisor.estimator.corrections[1] > 1
+        await supervisor.stop()
+
+    async def test_backs_off_when_late(self):
+        loop = asyncio.get_running_loop()
+        # never gets there
+        stage = TimedInterface({1: loop.time() + 100})
+        supervisor = MotionSupervisor([stage], interval=0.1, dense=0.01, lead=0, progress=None, grace=0.05)
+        supervisor.expect(1, 1, MotionParameters(velocity=10, acceleration=1000))
+        with self.assertRaises(asyncio.TimeoutError):
+            await supervisor.untilOnTarget([1], timeout=0.8)
+
+        # densely for the grace past the predicted 0.1s, then less and less often, rather than densely forever
+        gaps = [later - earlier for earlier, later in zip(stage.times, stage.times[1:])]
+        assert len(stage.polls) < 25
+        assert gaps[-1] > 0.09
+        await supervisor.stop()
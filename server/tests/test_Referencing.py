@@ -0,0 +1,193 @@
+import asyncio
+from unittest import IsolatedAsyncioTestCase
+
+from server.StageControl.DataTypes import EventAnnouncer, ConfigurationUpdate
+from server.StageControl.PI.DataTypes import PIController, PIConfiguration, PIControllerModel, PIConnectionType, \
+    PIStage
+from server.StageControl.PI.Referencing import ReferencingOrchestrator
+
+
+class FakeController(PIController):
+    """Channels which are referenced after a number of qFRF polls, None never"""
+
+    def __init__(self, SN: int, polls_until_referenced: dict[int, int | None]):
+        super().__init__()
+        self._config = PIConfiguration(SN=SN, model=PIControllerModel.mock, connection_type=PIConnectionType.usb)
+        self.remaining = polls_until_referenced
+        self.queried: list[list[int]] = []
+        self.halted: list[list[int] | None] = []
+        self.refreshes = 0
+
+    @property
+    def config(self) -> PIConfiguration:
+        return self._config
+
+    async def startReferencing(self, stages: dict[str, PIStage]) -> list[int]:
+        return [stage.channel for stage in stages.values() if stage.referenced and stage.channel in self.remaining]
+
+    async def referencedState(self, channels: list[int]) -> dict[int, bool]:
+        self.queried.append(sorted(channels))
+        res = {}
+        for channel in channels:
+            if self.remaining[channel] is not None:
+                self.remaining[channel] -= 1
+            res[channel] = self.remaining[channel] is not None and self.remaining[channel] <= 0
+        return res
+
+    async def haltReferencing(self, channels: list[int] | None = None):
+        self.halted.append(channels)
+
+    async def refreshFullStatus(self):
+        self.refreshes += 1
+
+
+class SlowController(FakeController):
+    """Holds on to the qFRF and HLT answers until released"""
+
+    def __init__(self, SN: int, polls_until_referenced: dict[int, int | None]):
+        super().__init__(SN, polls_until_referenced)
+        self.asking = asyncio.Event()
+        self.halting = asyncio.Event()
+        self.release = asyncio.Event()
+        self.slowHalt = False
+
+    async def referencedState(self, channels: list[int]) -> dict[int, bool]:
+        self.asking.set()
+        await self.release.wait()
+        return await super().referencedState(channels)
+
+    async def haltReferencing(self, channels: list[int] | None = None):
+        if self.slowHalt:
+            self.halting.set()
+            await self.release.wait()
+        await super().haltReferencing(channels)
+
+
+def stages(*channels: int) -> dict[str, PIStage]:
+    return {str(channel): PIStage(channel=channel, device="L-406.20DD10", referenced=True) for channel in channels}
+
+
+class TestReferencingOrchestrator(IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.EA = EventAnnouncer("Referencing", ConfigurationUpdate)
+        self.updates: list[ConfigurationUpdate] = []
+        self.sub = self.EA.subscribe(ConfigurationUpdate)
+        self.sub.deliverTo(ConfigurationUpdate, self.updates.append)
+        self.orchestrator = ReferencingOrchestrator(self.EA, interval=0.01, timeout=5)
+
+    async def asyncTearDown(self):
+        await self.orchestrator.cancel()
+        self.sub.unsubscribe()
+
+    async def settle(self, condition, timeout: float = 5):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while not condition() and loop.time() < deadline:
+            await asyncio.sleep(0.01)
+
+    def finished(self, SN: int) -> list[ConfigurationUpdate]:
+        return [update for update in self.updates if update.SN == SN and update.finished]
+
+    async def test_controllers_reference_concurrently(self):
+        a = FakeController(111, {1: 2, 2: 4})
+        b = FakeController(222, {1: 3})
+        await self.orchestrator.start(a, stages(1, 2))
+        await self.orchestrator.start(b, stages(1))
+        self.assertTrue(self.orchestrator.busy(111))
+        self.assertTrue(self.orchestrator.busy(222))
+
+        await self.settle(lambda: not self.orchestrator.busy(111) and not self.orchestrator.busy(222))
+        # polled side by side, and only for the channels still referencing
+        self.assertEqual([[1, 2], [1, 2], [2], [2]], a.queried)
+        self.assertEqual([[1]] * 3, b.queried)
+        # the full status only once, when done
+        self.assertEqual(1, a.refreshes)
+        self.assertEqual(1, b.refreshes)
+        for SN in (111, 222):
+            final = self.finished(SN)
+            self.assertEqual(1, len(final))
+            self.assertFalse(final[0].error)
+            self.assertIsNotNone(final[0].configuration)
+
+    async def test_nothing_to_reference(self):
+        a = FakeController(111, {})
+        self.assertEqual([], await self.orchestrator.start(a, stages(1)))
+        self.assertFalse(self.orchestrator.busy(111))
+        self.assertIsNone(self.orchestrator.task)
+        # still told it's done, with the configuration
+        self.assertEqual(1, a.refreshes)
+        final = self.finished(111)
+        self.assertEqual(1, len(final))
+        self.assertFalse(final[0].error)
+        self.assertEqual(111, final[0].configuration.SN)
+
+    async def test_nothing_more_to_reference_while_referencing(self):
+        a = FakeController(111, {1: None, 2: None})
+        await self.orchestrator.start(a, stages(1))
+        self.assertEqual([], await self.orchestrator.start(a, {}))
+        # the first one isn't done yet
+        self.assertTrue(self.orchestrator.busy(111))
+        self.assertEqual([], self.finished(111))
+
+    async def test_late_channels_are_halted(self):
+        a = FakeController(111, {1: 1, 2: None})
+        await self.orchestrator.start(a, stages(1, 2), timeout=0.05)
+
+        await self.settle(lambda: not self.orchestrator.busy(111))
+        self.assertEqual([[2]], a.halted)
+        final = self.finished(111)
+        self.assertEqual(1, len(final))
+        self.assertTrue(final[0].error)
+        self.assertIn("[2]", final[0].message)
+
+    async def test_cancel(self):
+        a = FakeController(111, {1: None})
+        b = FakeController(222, {1: None})
+        await self.orchestrator.start(a, stages(1))
+        await self.orchestrator.start(b, stages(1))
+
+        self.assertEqual([111], await self.orchestrator.cancel(111))
+        self.assertEqual([None], a.halted)
+        self.assertEqual([], b.halted)
+        self.assertFalse(self.orchestrator.busy(111))
+        self.assertTrue(self.orchestrator.busy(222))
+        self.assertTrue(self.finished(111)[0].error)
+
+        # cancelling what isn't referencing does nothing
+        self.assertEqual([], await self.orchestrator.cancel(111))
+
+    async def test_cancel_during_check(self):
+        # referenced by the time the check that is under way gets its answer
+        a = SlowController(111, {1: 1})
+        b = FakeController(222, {1: None})
+        await self.orchestrator.start(a, stages(1))
+        await self.orchestrator.start(b, stages(1))
+        await asyncio.wait_for(a.asking.wait(), 1)
+
+        self.assertEqual([111], await self.orchestrator.cancel(111))
+        a.release.set()
+        await asyncio.sleep(0.05)
+        # the check that was under way doesn't finish it again, nor take down the polling of the others
+        self.assertEqual(1, len(self.finished(111)))
+        self.assertFalse(self.orchestrator.task.done())
+        self.assertTrue(self.orchestrator.busy(222))
+        queried = len(b.queried)
+        await asyncio.sleep(0.05)
+        self.assertGreater(len(b.queried), queried)
+
+    async def test_finished_during_cancel(self):
+        a = SlowController(111, {1: 1})
+        a.slowHalt = True
+        await self.orchestrator.start(a, stages(1))
+        await asyncio.wait_for(a.asking.wait(), 1)
+
+        cancelling = asyncio.ensure_future(self.orchestrator.cancel(111))
+        await asyncio.wait_for(a.halting.wait(), 1)
+        # referenced before the halt got through
+        a.release.set()
+        self.assertEqual([111], await asyncio.wait_for(cancelling, 1))
+        final = self.finished(111)
+        self.assertEqual(1, len(final))
+        self.assertFalse(final[0].error)
+        self.assertNotIn(111, self.orchestrator.failed)
@@ -0,0 +1,68 @@
+from unittest import TestCase
+
+from server.StageControl.DataTypes import ControllerInterface, StageInfo, StageRemoved, StageKind, Notice, \
+    EventAnnouncer
+from server.StageControl.PI.DataTypes import PIStageInfo
+from server.StageControl.Registry import StageRegistry
+
+
+class NamedInterface(ControllerInterface):
+
+    def __init__(self, name: str):
+        super().__init__()
+        self._name = name
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def stageInfo(self) -> dict[int, StageInfo]:
+        return {}
+
+
+def info(identifier: int) -> StageInfo:
+    return StageInfo(model="v", identifier=identifier, kind=StageKind.linear, minimum=0, maximum=1)
+
+
+class TestStageRegistry(TestCase):
+
+    def setUp(self):
+        self.EA = EventAnnouncer("main", Notice)
+        self.notices: list[Notice] = []
+        self.EA.subscribe(Notice).deliverTo(Notice, self.notices.append)
+        self.registry = StageRegistry(self.EA)
+        self.pi = NamedInterface("PI")
+        self.virtual = NamedInterface("Virtual")
+        self.registry.watch(self.pi)
+        self.registry.watch(self.virtual)
+
+    def tearDown(self):
+        self.registry.close()
+
+    def test_routes_from_events(self):
+        self.assertIsNone(self.registry.lookup(1234))
+        # as PI announces its stages
+        self.pi.EventAnnouncer.event(PIStageInfo(model="L-406.20DD10", identifier=1234, kind=StageKind.linear,
+                                                 minimum=0, maximum=200, controllerSN=123, channel=4).toStageInfo())
+        self.assertIs(self.pi, self.registry.lookup(1234).interface)
+
+        self.pi.EventAnnouncer.event(StageRemoved(identifier=1234))
+        self.assertIsNone(self.registry.lookup(1234))
+
+    def test_collision(self):
+        self.pi.EventAnnouncer.event(info(7))
+        self.virtual.EventAnnouncer.event(info(7))
+        with self.assertRaises(Exception) as error:
+            self.registry.lookup(7)
+        self.assertIn("PI and Virtual", str(error.exception))
+        self.assertEqual([7], [notice.identifier for notice in self.notices])
+
+        # an interface announcing its own stage again isn't a collision
+        self.pi.EventAnnouncer.event(info(8))
+        self.pi.EventAnnouncer.event(info(8))
+        self.assertEqual(1, len(self.notices))
+
+        # resolved once one of them goes
+        self.virtual.EventAnnouncer.event(StageRemoved(identifier=7))
+        self.assertIs(self.pi, self.registry.lookup(7).interface)
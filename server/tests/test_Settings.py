@@ -1,6 +1,12 @@
+import asyncio
+import json
+import tempfile
 from pathlib import Path
 from unittest import TestCase, IsolatedAsyncioTestCase
 import os
+
+from pydantic import BaseModel
+
 from server.Settings import SettingsVault
 
 
@@ -66,4 +72,78 @@ class TestSettingsVault(IsolatedAsyncioTestCase):
         if Path("settings").is_dir():
             for file in Path("settings").glob("*"):
                 file.unlink()
-        Path("settings").rmdir()
\ No newline at end of file
+        Path("settings").rmdir()
+
+class Entry(BaseModel):
+    Name: str
+    size: int
+
+
+class TestSettingsCache(IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmp.name)
+        self.dir.joinpath("readonly").mkdir()
+        self.catalog = self.dir.joinpath("readonly", "Entries.json")
+        self.write({"a": {"size": 1}})
+        self.SV = SettingsVault(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, data: dict, mtime: int | None = None):
+        self.catalog.write_text(json.dumps(data))
+        if mtime is not None:
+            os.utime(self.catalog, ns=(mtime, mtime))
+
+    async def test_parsed_once(self):
+        await self.SV.load_all()
+        first = self.SV.readonly["Entries"]
+        view = self.SV.catalog("Entries", Entry, key="Name")
+        self.assertEqual(Entry(Name="a", size=1), view["a"])
+
+        await self.SV.reload_all()
+        self.assertIs(first, self.SV.readonly["Entries"])
+        self.assertIs(view, self.SV.catalog("Entries", Entry, key="Name"))
+
+        # touched but the same
+        self.write({"a": {"size": 1}}, mtime=10 ** 9)
+        await self.SV.load_all()
+        self.assertIs(first, self.SV.readonly["Entries"])
+
+    async def test_changed_file_is_read_again(self):
+        await self.SV.load_all()
+        view = self.SV.catalog("Entries", Entry, key="Name")
+        self.write({"a": {"size": 1}, "b": {"size": 2}}, mtime=2 * 10 ** 9)
+        await self.SV.load_all()
+        self.assertEqual(["a", "b"], list(self.SV.catalog("Entries", Entry, key="Name").keys()))
+        self.assertEqual(["a"], list(view.keys()))
+
+    async def test_ensure_loaded_only_once(self):
+        await self.SV.ensureLoaded()
+        self.write({"b": {"size": 2}}, mtime=3 * 10 ** 9)
+        await self.SV.ensureLoaded()
+        self.assertIn("a", self.SV.readonly["Entries"])
+
+    async def test_watch(self):
+        self.SV.watch(interval=0.01)
+        try:
+            await asyncio.sleep(0.05)
+            self.write({"c": {"size": 3}}, mtime=4 * 10 ** 9)
+            await asyncio.sleep(0.2)
+            self.assertIn("c", self.SV.readonly["Entries"])
+        finally:
+            await self.SV.unwatch()
+
+    async def test_stores_are_copies(self):
+        self.dir.joinpath("saved.json").write_text(json.dumps({"one": 1, "two": 2}))
+        await self.SV.load_all()
+        # changed in place, then never saved, i.e. because the save failed
+        del self.SV.stores["saved"]["one"]
+        await self.SV.load_all()
+        self.assertEqual({"one": 1, "two": 2}, self.SV.stores["saved"])
+
+    def test_shared(self):
+        self.assertIs(SettingsVault.shared(self.tmp.name), SettingsVault.shared(str(self.dir.resolve())))
+        self.assertIsNot(SettingsVault.shared(self.tmp.name), self.SV)
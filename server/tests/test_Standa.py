@@ -0,0 +1,75 @@
+import asyncio
+import threading
+import time
+from unittest import IsolatedAsyncioTestCase
+
+from server.StageControl.Standa.Interface import StandaInterface
+
+
+class FakeStatus:
+
+    def __init__(self, MvCmdSts: str):
+        self.MvCmdSts = MvCmdSts
+
+
+class FakeAxis:
+    """Standa axis which homes for a while unless stopped, each command taking a little time like over USB"""
+
+    def __init__(self, homing: float = 1):
+        self.homing = homing
+        self.command = "MvcmdStatus.MVCMD_UKNWN"
+        self.until = 0.0
+        self.zeroed = False
+        self.busy = threading.Lock()
+
+    def exchange(self):
+        if not self.busy.acquire(blocking=False):
+            raise Exception("device talked to concurrently")
+        time.sleep(0.005)
+        self.busy.release()
+
+    def command_home(self):
+        self.exchange()
+        self.command = "MvcmdStatus.MVCMD_HOME"
+        self.until = time.monotonic() + self.homing
+
+    def command_sstp(self):
+        self.exchange()
+        self.command = "MvcmdStatus.MVCMD_SSTP"
+        self.until = time.monotonic() + 0.02
+
+    def command_zero(self):
+        self.exchange()
+        self.zeroed = True
+
+    def get_status(self) -> FakeStatus:
+        self.exchange()
+        running = "|MVCMD_RUNNING" if time.monotonic() < self.until else ""
+        return FakeStatus(self.command + running)
+
+
+class TestStandaHoming(IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.standa = StandaInterface()
+
+    async def asyncTearDown(self):
+        self.standa.io.shutdown()
+
+    async def test_homes_and_zeroes(self):
+        axis = FakeAxis(homing=0.05)
+        self.standa.ximcs[1] = axis
+        self.assertTrue(await self.standa.home(1, interval=0.01))
+        self.assertTrue(axis.zeroed)
+
+    async def test_stop_while_homing(self):
+        axis = FakeAxis(homing=5)
+        self.standa.ximcs[1] = axis
+        homing = asyncio.ensure_future(self.standa.home(1, interval=0.01))
+        await asyncio.sleep(0.05)
+
+        # doesn't wait for the homing to finish
+        await asyncio.wait_for(self.standa.stop(1), 0.5)
+        self.assertFalse(homing.done())
+        self.assertFalse(await asyncio.wait_for(homing, 0.5))
+        self.assertFalse(axis.zeroed)
@@ -0,0 +1,125 @@
+import asyncio
+from unittest import IsolatedAsyncioTestCase
+
+from server.StageControl.DataTypes import EventAnnouncer, StageInfo, StageStatus, StageRemoved, StageKind
+from server.StageControl.StateStore import StageStateStore, infoView, statusView
+from server.StageControl.Virtual import VirtualControllerInterface, VirtualStageInfo
+
+
+def info(identifier: int) -> StageInfo:
+    return StageInfo(model="v", identifier=identifier, kind=StageKind.linear, minimum=0, maximum=1)
+
+
+def status(identifier: int, position: float = 0) -> StageStatus:
+    return StageStatus(identifier=identifier, connected=True, ready=True, position=position, ontarget=True)
+
+
+class TestStageStateStore(IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.EA = EventAnnouncer("main", StageInfo, StageStatus, StageRemoved)
+        self.store = StageStateStore()
+        self.store.watch(self.EA)
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_versions_only_bump_on_change(self):
+        self.EA.event(info(1))
+        self.EA.event(status(1))
+        self.assertEqual(2, self.store.version)
+        self.EA.event(status(1))
+        self.assertEqual(2, self.store.version)
+        self.EA.event(status(1, 0.5))
+        self.assertEqual(3, self.store.version)
+        self.assertEqual(0.5, self.store.status(1).position)
+        self.assertEqual(3, self.store.stages[1].version)
+
+    def test_snapshots_are_copies(self):
+        emitted = status(1)
+        self.EA.event(emitted)
+        before = self.store.stages[1]
+        emitted.position = 0.7
+        self.assertEqual(0, before.status.position)
+        self.EA.event(emitted)
+        # replaced, the old snapshot is left as it was
+        self.assertEqual(0, before.status.position)
+        self.assertEqual(0.7, self.store.status(1).position)
+
+    def test_views_are_shared_until_a_change(self):
+        self.EA.event(info(1))
+        self.EA.event(status(1))
+        view = self.store.view(statusView)
+        self.assertIs(view, self.store.view(statusView))
+        self.assertEqual({1: info(1)}, self.store.view(infoView))
+        self.EA.event(status(1, 0.2))
+        self.assertIsNot(view, self.store.view(statusView))
+        self.assertEqual(0.2, self.store.view(statusView)[1].position)
+
+    def test_changes_since(self):
+        self.EA.event(info(1))
+        self.EA.event(info(2))
+        seen = self.store.version
+        self.EA.event(status(2))
+        self.EA.event(StageRemoved(identifier=1))
+
+        changes = self.store.changes(seen, self.store.epoch)
+        self.assertEqual(4, changes.version)
+        self.assertFalse(changes.complete)
+        self.assertEqual([2], [state.identifier for state in changes.stages])
+        self.assertEqual([1], changes.removed)
+
+        self.assertEqual([], self.store.changes(changes.version, changes.epoch).stages)
+        everything = self.store.changes(0)
+        self.assertTrue(everything.complete)
+        self.assertEqual([2], [state.identifier for state in everything.stages])
+        # from before a restart, with a version past ours
+        self.assertTrue(self.store.changes(100, self.store.epoch).complete)
+        # or with a version we have reached by now, the epoch gives it away
+        restarted = self.store.changes(seen, "another run")
+        self.assertTrue(restarted.complete)
+        self.assertEqual(self.store.epoch, restarted.epoch)
+        self.assertEqual([2], [state.identifier for state in restarted.stages])
+        # no epoch, no diff
+        self.assertTrue(self.store.changes(seen).complete)
+
+    async def test_wait_for_changes(self):
+        self.EA.event(status(1))
+        seen = self.store.version
+        waiting = asyncio.ensure_future(self.store.wait(seen, self.store.epoch, timeout=5))
+        await asyncio.sleep(0.01)
+        self.assertFalse(waiting.done())
+        self.EA.event(status(1, 0.3))
+        changes = await waiting
+        self.assertEqual(seen + 1, changes.version)
+        self.assertEqual(0.3, changes.stages[0].status.position)
+
+        # nothing happens, answered empty once the timeout runs out
+        changes = await self.store.wait(changes.version, changes.epoch, timeout=0.01)
+        self.assertEqual([], changes.stages)
+        # already behind, answered right away
+        self.assertEqual(1, len((await self.store.wait(seen, self.store.epoch, timeout=5)).stages))
+        # from another run, answered right away with everything
+        self.assertTrue((await self.store.wait(changes.version, "another run", timeout=5)).complete)
+
+    def test_forgets_old_removals(self):
+        store = StageStateStore(tombstones=2)
+        store.watch(self.EA)
+        for identifier in range(1, 5):
+            self.EA.event(info(identifier))
+        seen = store.version
+        for identifier in range(1, 5):
+            self.EA.event(StageRemoved(identifier=identifier))
+        self.assertEqual([3, 4], list(store.removed.keys()))
+        # the removals of 1 and 2 are forgotten, so only someone who saw them gets a diff
+        self.assertTrue(store.changes(seen, store.epoch).complete)
+        self.assertEqual([4], store.changes(store.version - 1, store.epoch).removed)
+        store.close()
+
+    async def test_configured_virtual_stage(self):
+        virtual = VirtualControllerInterface()
+        self.store.watch(virtual.EventAnnouncer)
+        await virtual.settings.configurationChangeRequest([VirtualStageInfo(SN=77, model="v", maximum=100)])
+        # configuring is enough to show up everywhere, without waiting for a status poll
+        self.assertIn(77, self.store.view(infoView))
+        self.assertIn(77, self.store.view(statusView))
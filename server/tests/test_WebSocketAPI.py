@@ -0,0 +1,249 @@
+import asyncio
+import json
+from unittest import IsolatedAsyncioTestCase
+
+from server.API.WebSocketAPI import WebSocketAPI, SlowClientPolicy, Encoding, STAGESTATUS_FRAME, STAGESTATUS_TYPE
+from server.Interface import Virtualinterface, PIinterface
+from server.StageControl.DataTypes import StageStatus, Notice
+from server.StageControl.Virtual import VirtualStageInfo
+
+
+class FakeWebSocket:
+    """Stands in for a starlette WebSocket, collecting what is sent"""
+
+    def __init__(self):
+        self.sent: list[str | bytes] = []
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, data: str):
+        self.sent.append(data)
+
+    async def send_bytes(self, data: bytes):
+        self.sent.append(data)
+
+    async def close(self):
+        pass
+
+    def events(self) -> list[dict]:
+        """Event frames, without the snapshot sent on connect"""
+        return [frame for frame in map(json.loads, self.text()) if frame.get("event", "Snapshot") != "Snapshot"]
+
+    def text(self) -> list[str]:
+        return [frame for frame in self.sent if isinstance(frame, str)]
+
+
+class StuckWebSocket(FakeWebSocket):
+    """A connection that never finishes sending"""
+
+    async def send_text(self, data: str):
+        await asyncio.Event().wait()
+
+
+async def settle(condition=lambda: False, timeout: float = 1):
+    """Let the queues and writer tasks run, until the condition holds or the timeout passes"""
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition() and asyncio.get_running_loop().time() < deadline:
+        await asyncio.sleep(0.01)
+
+
+class TestWebSocketAPI(IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.api = WebSocketAPI(conflation_window=0)
+        self.everything = FakeWebSocket()
+        self.dashboard = FakeWebSocket()
+        await self.api.connect(self.everything)
+        await self.api.connect(self.dashboard)
+
+    async def asyncTearDown(self):
+        self.api.shutdown()
+
+    async def test_frame(self):
+        Virtualinterface.EventAnnouncer.event(StageStatus(identifier=1, position=2.5))
+        await settle(lambda: len(self.everything.events()) > 0)
+
+        # data is a JSON object, not a string containing JSON
+        assert self.everything.events() == [{"seq": self.api.seq, "event": "StageStatus", "data": {
+            "identifier": 1, "connected": False, "ready": False, "position": 2.5, "ontarget": False}}]
+
+    async def test_binary_encoding(self):
+        binary = FakeWebSocket()
+        await self.api.connect(binary, Encoding.binary)
+
+        Virtualinterface.EventAnnouncer.event(StageStatus(identifier=4250030443, position=-2.5, connected=True,
+                                                          ontarget=True))
+        Virtualinterface.EventAnnouncer.event(Notice(identifier=1, message="hi"))
+        await settle(lambda: len(binary.sent) == 3)
+
+        # status packed, everything else stays JSON
+        assert len(binary.sent[1]) == 26
+        assert STAGESTATUS_FRAME.unpack(binary.sent[1]) == (STAGESTATUS_TYPE, self.api.seq - 1, 4250030443, -2.5,
+                                                            0b101)
+        assert json.loads(binary.sent[2])["event"] == "Notice"
+        # json clients are unaffected
+        assert [e["event"] for e in self.everything.events()] == ["StageStatus", "Notice"]
+
+    async def test_filtering(self):
+        await self.api.receive({"request": "subscribe", "events": ["StageStatus", "Notice"],
+                                "identifiers": [1, 2]}, self.dashboard)
+        await self.api.receive({"request": "unsubscribe", "identifiers": [2]}, self.dashboard)
+        await settle(lambda: len(self.dashboard.sent) == 3)
+        assert json.loads(self.dashboard.sent[-1])["data"]["identifiers"] == [1]
+
+        Virtualinterface.EventAnnouncer.event(StageStatus(identifier=1))
+        Virtualinterface.EventAnnouncer.event(StageStatus(identifier=2))
+        PIinterface.EventAnnouncer.event(StageStatus(identifier=4250030443))
+        # Notices without an identifier go to everyone subscribed to notices
+        PIinterface.EventAnnouncer.event(Notice(message="hello"))
+        await settle(lambda: len(self.everything.events()) == 4)
+
+        assert [(e["event"], e["data"].get("identifier")) for e in self.dashboard.events()] == \
+               [("StageStatus", 1), ("Notice", None)]
+        assert len(self.everything.events()) == 4
+
+        # filter by interface
+        await self.api.receive({"request": "subscribe", "interfaces": ["PI"], "identifiers": [4250030443]},
+                               self.dashboard)
+        await settle(lambda: len(self.dashboard.sent) == 6)
+        Virtualinterface.EventAnnouncer.event(StageStatus(identifier=1, position=1))
+        PIinterface.EventAnnouncer.event(StageStatus(identifier=4250030443, position=1))
+        await settle(lambda: len(self.everything.events()) == 6)
+        assert [e["data"]["identifier"] for e in self.dashboard.events()[2:]] == [4250030443]
+
+    async def test_malformed(self):
+        await self.api.receive({"request": "fly to the moon"}, self.everything)
+        await settle(lambda: len(self.everything.sent) == 2)
+        assert json.loads(self.everything.sent[-1])["errortype"] == "malformed_request"
+
+    async def test_unreadable_and_reaped(self):
+        # not even json, answered through the outbox after what was already queued
+        self.api.clients[self.everything].send('{"queued": true}')
+        assert self.api.reject(self.everything, ValueError("Expecting value"))
+        await settle(lambda: len(self.everything.sent) == 3)
+        assert json.loads(self.everything.sent[1]) == {"queued": True}
+        assert json.loads(self.everything.sent[2])["errormsg"] == "Expecting value"
+
+        # dropped for being too slow, nothing more is sent and the endpoint stops listening
+        self.api.reap(self.api.clients[self.dashboard])
+        await self.api.receive({"request": "ping", "id": 1}, self.dashboard)
+        assert not self.api.reject(self.dashboard, ValueError("Expecting value"))
+        await settle()
+        assert len(self.dashboard.text()) == 1
+
+    async def test_commands(self):
+        await Virtualinterface.settings.configurationChangeRequest([VirtualStageInfo(SN=7, model="v", maximum=100)])
+        try:
+            await self.api.receive({"request": "move", "id": "a", "identifier": 7, "position": 20}, self.dashboard)
+            await self.api.receive({"request": "step", "id": "b", "identifier": 7, "step": 5}, self.dashboard)
+            await self.api.receive({"request": "batch", "id": "c", "moves": {7: 1, 404: 2}}, self.dashboard)
+            await self.api.receive({"request": "stop", "id": "d", "identifier": 7}, self.dashboard)
+            await self.api.receive({"request": "move", "id": "w", "identifier": 7, "position": 30, "wait": True},
+                                   self.dashboard)
+            await self.api.receive({"request": "move", "id": "e", "identifier": 7}, self.dashboard)
+            responses = lambda: {r["id"]: r for r in map(json.loads, self.dashboard.text()) if "response" in r}
+            await settle(lambda: len(responses()) == 6)
+
+            res = responses()
+            assert res["a"]["response"] == "ack" and res["a"]["data"]["accepted"] == [7]
+            assert res["b"]["response"] == "ack"
+            # one of the batch went through, the other didn't
+            assert res["c"]["response"] == "error"
+            assert res["c"]["data"] == {"accepted": [7], "errors": {"404": "Stage 404 doesn't exist"}}
+            assert res["d"]["response"] == "ack"
+            assert res["w"]["response"] == "ack" and res["w"]["data"]["ontarget"] == {"7": True}
+            assert res["e"]["errortype"] == "malformed_request"
+            # moves happen in order, after the status announced when the stage was configured
+            positions = [e["data"]["position"] for e in self.dashboard.events() if e["event"] == "StageStatus"]
+            assert positions[:4] == [0, 20, 25, 1]
+        finally:
+            await Virtualinterface.settings.removeConfiguration(7)
+
+    async def test_snapshot_on_connect(self):
+        Virtualinterface.EventAnnouncer.event(StageStatus(identifier=1, position=1))
+        Virtualinterface.EventAnnouncer.event(StageStatus(identifier=1, position=2))
+        Virtualinterface.EventAnnouncer.event(StageStatus(identifier=2, position=3))
+        await settle(lambda: len(self.everything.events()) == 3)
+
+        late = FakeWebSocket()
+        await self.api.connect(late)
+        await settle(lambda: len(late.sent) == 1)
+        snapshot = json.loads(late.sent[0])
+        assert snapshot["event"] == "Snapshot" and snapshot["seq"] == self.api.seq
+        # only the latest status per stage
+        assert [(s["identifier"], s["position"]) for s in snapshot["data"]["StageStatus"]] == [(1, 2), (2, 3)]
+
+    async def test_resume(self):
+        for i in range(5):
+            Virtualinterface.EventAnnouncer.event(Notice(identifier=1, message=str(i)))
+        await settle(lambda: len(self.everything.events()) == 5)
+        seqs = [e["seq"] for e in self.everything.events()]
+        assert seqs == list(range(seqs[0], seqs[0] + 5))
+
+        # reconnect after having seen the first two, get exactly the three missed ones
+        resumed = FakeWebSocket()
+        await self.api.connect(resumed, since=seqs[1], epoch=self.api.epoch)
+        await settle(lambda: len(resumed.sent) == 3)
+        assert [e["data"]["message"] for e in resumed.events()] == ["2", "3", "4"]
+        assert len(resumed.sent) == 3
+
+        # nothing missed, nothing sent
+        uptodate = FakeWebSocket()
+        await self.api.connect(uptodate, since=self.api.seq, epoch=self.api.epoch)
+        await settle(timeout=0.1)
+        assert uptodate.sent == []
+
+        # too far behind, or from before a restart, a snapshot instead
+        behind = WebSocketAPI(conflation_window=0, replay_size=2)
+        for i in range(5):
+            Virtualinterface.EventAnnouncer.event(Notice(identifier=1, message=str(i)))
+        await settle(lambda: behind.seq == 5)
+        old, future = FakeWebSocket(), FakeWebSocket()
+        await behind.connect(old, since=1, epoch=behind.epoch)
+        await behind.connect(future, since=100, epoch=behind.epoch)
+        await settle(lambda: len(old.sent) == 1 and len(future.sent) == 1)
+        assert json.loads(old.sent[0])["event"] == json.loads(future.sent[0])["event"] == "Snapshot"
+
+        # from another run, with a seq this one has already passed
+        restarted = FakeWebSocket()
+        await behind.connect(restarted, since=4, epoch=self.api.epoch)
+        await settle(lambda: len(restarted.sent) == 1)
+        snapshot = json.loads(restarted.sent[0])
+        assert snapshot["event"] == "Snapshot" and snapshot["epoch"] == behind.epoch
+        behind.shutdown()
+
+    async def test_ordered_per_client(self):
+        for i in range(50):
+            Virtualinterface.EventAnnouncer.event(Notice(identifier=1, message=str(i)))
+        await settle(lambda: len(self.everything.events()) == 50)
+        assert [e["data"]["message"] for e in self.everything.events()] == [str(i) for i in range(50)]
+
+    async def test_stuck_client_is_reaped(self):
+        api = WebSocketAPI(conflation_window=0, high_water=4, send_timeout=1)
+        healthy = FakeWebSocket()
+        stuck = StuckWebSocket()
+        await api.connect(healthy)
+        await api.connect(stuck)
+        stuckclient = api.clients[stuck]
+
+        for i in range(10):
+            Virtualinterface.EventAnnouncer.event(Notice(identifier=1, message=str(i)))
+            await settle(lambda: len(healthy.events()) == i + 1)
+        # the stuck client doesn't hold up the healthy one, and only holds on to the newest frames
+        assert len(healthy.events()) == 10
+        assert stuckclient.dropped == 6
+
+        await settle(lambda: len(api.clients) == 1, timeout=3)
+        assert list(api.clients.keys()) == [healthy]
+        api.shutdown()
+
+    async def test_disconnect_policy(self):
+        api = WebSocketAPI(conflation_window=0, high_water=2, slow_client_policy=SlowClientPolicy.disconnect)
+        stuck = StuckWebSocket()
+        await api.connect(stuck)
+        for i in range(5):
+            Virtualinterface.EventAnnouncer.event(Notice(identifier=1, message=str(i)))
+        await settle(lambda: len(api.clients) == 0)
+        assert api.clients == {}
+        api.shutdown()
@@ -66,6 +66,11 @@ const settingsStore = useSettingsStore();
 
 class WSClient {
 
+    // sequence number of the last event we got, so we can pick up where we left off after reconnecting
+    private lastSeq: number | null = null
+    // which run of the server lastSeq is from, it means nothing to another one
+    private epoch: string | null = null
+
     constructor(private ws: WebSocket) {
         this.ws = ws
         this.init_ws_behavior()
@@ -81,6 +86,8 @@ class WSClient {
 
     init_ws_behavior(){
         // assign functions to the new websocket
+        // binary frames (packed StageStatus) arrive as ArrayBuffers
+        this.ws.binaryType = "arraybuffer"
         this.ws.onopen = () => {
             // update the state
             settingsStore.websocket_got_connected().then(r => {
@@ -90,6 +97,14 @@ class WSClient {
 
         this.ws.onmessage = (event) => {
             //console.log(`Message from server: ${event.data}`);
+            if (event.data instanceof ArrayBuffer) {
+                try {
+                    this.receive(decodeBinaryFrame(event.data))
+                } catch (e) {
+                    console.log("Error decoding binary frame " + e)
+                }
+                return
+            }
             try {
                 const parsed = <WSMessage>JSON.parse(event.data)
                 console.log("received WS: ", parsed)
@@ -105,8 +120,12 @@ class WSClient {
             settingsStore.websocketConnected = false
             // try to reconnect
             setTimeout(function(wsclient: WSClient){
-                // extract the current url
-                const url = wsclient.ws.url
+                // extract the current url, and ask for just the events we missed
+                const url = new URL(wsclient.ws.url)
+                if (wsclient.lastSeq != null && wsclient.epoch != null) {
+                    url.searchParams.set("since", String(wsclient.lastSeq))
+                    url.searchParams.set("epoch", wsclient.epoch)
+                }
                 // create a new websocket
                 wsclient.ws = new WebSocket(url)
                 // give it the proper functions it needs
@@ -117,17 +136,30 @@ class WSClient {
     }
 
     receive(message: WSMessage) {
-        if (message.event == "StageStatus") {
+        if (message.seq != undefined) {
+            this.lastSeq = message.seq
+        }
+        if (message.epoch != undefined) {
+            this.epoch = message.epoch
+        }
+        if (message.event == "Snapshot") {
+            // the latest of everything, sent when we connect or are too far behind to catch up
+            for (const event of ["StageInfo", "StageStatus", "ConfigurationUpdate"]) {
+                for (const data of message.data[event] ?? []) {
+                    this.receive({event: event, data: data})
+                }
+            }
+        } else if (message.event == "StageStatus") {
             // try parse it
             try {
-                const msg = JSON.parse(message.data) as StageStatus
+                const msg = message.data as StageStatus
                 stagestore.receiveStageStatus(msg)
             } catch (e) {
                 console.log(e)
             }
         } else if (message.event == "StageInfo") {
             try {
-                const msg = JSON.parse(message.data) as StageInfo
+                const msg = message.data as StageInfo
                 console.log(typeof msg)
                 stagestore.receiveStageInfo(msg)
             } catch (e) {
@@ -135,7 +167,7 @@ class WSClient {
             }
         } else if (message.event == "StageRemoved") {
             try {
-                const msg = JSON.parse(message.data) as StageRemoved
+                const msg = message.data as StageRemoved
                 stagestore.receiveStageRemoved(msg)
             } catch (e) {
                 console.log(e)
@@ -152,10 +184,34 @@ class WSClient {
     }
 }
 
-// Start up websocket handling
-const wsclient = new WSClient(new WebSocket('/ws/'))
+// Start up websocket handling, stage positions come in as binary frames to save on parsing and bandwidth
+const wsclient = new WSClient(new WebSocket('/ws/?encoding=binary'))
 
 interface WSMessage {
+    seq?: number;
+    epoch?: string;
     event: string;
     data: any;
+}
+
+// Frame type of a binary StageStatus, layout is in STAGESTATUS_FRAME in server/API/WebSocketAPI.py
+const STAGESTATUS_TYPE = 1
+
+function decodeBinaryFrame(buffer: ArrayBuffer): WSMessage {
+    // little endian: type uint8, seq uint64, identifier int64, position float64,
+    // flags uint8 (connected, ready, ontarget)
+    const view = new DataView(buffer)
+    const type = view.getUint8(0)
+    if (type != STAGESTATUS_TYPE) {
+        throw new Error("unknown binary frame type " + type)
+    }
+    const flags = view.getUint8(25)
+    const status: StageStatus = {
+        identifier: Number(view.getBigInt64(9, true)),
+        position: view.getFloat64(17, true),
+        connected: (flags & 1) != 0,
+        ready: (flags & 2) != 0,
+        ontarget: (flags & 4) != 0,
+    }
+    return {seq: Number(view.getBigUint64(1, true)), event: "StageStatus", data: status}
 }
\ No newline at end of file